@@ -0,0 +1,428 @@
+# audio-offset-finder
+#
+# Copyright (c) 2014-24 British Broadcasting Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from .audio_offset_finder import (
+    PCM_FORMATS,
+    InsufficientAudioException,
+    _IncrementalFeatures,
+    _Profiler,
+    _cache_key,
+    _chunked_wav_features,
+    _decode_ranges,
+    _features,
+    _ffmpeg_command,
+    _find_offset_between_features,
+    _search_lag_range,
+    _settled,
+    _shift_results,
+    find_offset_between_buffers,
+)
+from asyncio.subprocess import DEVNULL, PIPE
+from contextlib import asynccontextmanager
+from functools import partial
+import asyncio
+import os
+import tempfile
+import numpy as np
+
+
+class AsyncOffsetFinder:
+    """Finds offsets between audio files (or buffers) from asyncio code, without blocking the event loop.
+
+    FFmpeg is run using asyncio.create_subprocess_exec(), and the MFCCs and cross-correlations are calculated in an
+    executor, as are reads from and writes to the feature cache.  Cancelling a search kills any FFmpeg processes that it
+    started and deletes its temporary files.  (Calculations that are already running in the executor can't be
+    interrupted, but their results are discarded.)
+
+    Parameters
+    ----------
+    executor: concurrent.futures.Executor
+        The executor in which to calculate MFCCs and cross-correlations.  The default is the event loop's default
+        executor.  A ProcessPoolExecutor may be used to run the calculations for several searches in parallel.
+    max_concurrent: int
+        The maximum number of searches to run at once.  Further searches wait until one of them finishes.  The default
+        is no limit.
+    """
+
+    def __init__(self, executor=None, max_concurrent=None):
+        self.executor = executor
+        self.max_concurrent = max_concurrent
+        # The semaphore is created by the first search, as it belongs to the event loop that is running then
+        self._semaphore = None
+        self._semaphore_loop = None
+
+    async def find_offset_between_files(
+        self,
+        file1,
+        file2,
+        fs=8000,
+        trim=None,
+        hop_length=128,
+        win_length=256,
+        nfft=512,
+        max_frames=2000,
+        engine="fft",
+        decoder="pipe",
+        cache=None,
+        coarse_factor=None,
+        top_k=3,
+        expected_offset=None,
+        max_offset=None,
+        profile=False,
+        on_metrics=None,
+        dtype=np.float32,
+        chunk_frames=None,
+        min_score=None,
+    ):
+        """Find the offset between two audio files.  The parameters and results are as described for
+        audio_offset_finder.find_offset_between_files(), which this is equivalent to.  With a process pool executor, the
+        cache must be one that can be pickled, such as a FeatureCache."""
+        async with self._slot():
+            profiler = _Profiler()
+            time_scale = hop_length / fs
+            lag_range = _search_lag_range(expected_offset, max_offset, time_scale)
+            if min_score is not None:
+                if lag_range is not None:
+                    raise ValueError("A minimum score can't be used with a maximum offset")
+                results = await self._find_offset_progressively(
+                    file1,
+                    file2,
+                    fs,
+                    trim,
+                    hop_length,
+                    win_length,
+                    nfft,
+                    max_frames,
+                    engine,
+                    coarse_factor,
+                    top_k,
+                    min_score,
+                    dtype,
+                    profiler,
+                )
+                return profiler.finish(results, profile, on_metrics)
+            decode_ranges, start_frames, lag_range = _decode_ranges(
+                lag_range, trim, hop_length, nfft, max_frames, coarse_factor, fs
+            )
+            # The two files are decoded by independent FFmpeg processes, so decode them concurrently
+            mfcc1, mfcc2 = await _gather(
+                *(
+                    self._file_features(
+                        afile,
+                        fs,
+                        duration,
+                        hop_length,
+                        win_length,
+                        nfft,
+                        decoder,
+                        cache,
+                        offset,
+                        dtype,
+                        chunk_frames,
+                        profiler,
+                        label,
+                    )
+                    for afile, (offset, duration), label in zip((file1, file2), decode_ranges, ("1", "2"))
+                )
+            )
+            results, metrics = await self._run(
+                _find_offset_with_metrics, mfcc1, mfcc2, fs, hop_length, max_frames, engine, coarse_factor, top_k, lag_range
+            )
+            profiler.merge(metrics)
+        if start_frames:
+            _shift_results(results, start_frames * time_scale)
+        return profiler.finish(results, profile, on_metrics)
+
+    async def find_offset_between_buffers(self, buffer1, buffer2, fs, **kwargs):
+        """Find the offset between two audio buffers in the executor.  The parameters and results are as described for
+        audio_offset_finder.find_offset_between_buffers()."""
+        async with self._slot():
+            return await self._run(partial(find_offset_between_buffers, buffer1, buffer2, fs, **kwargs))
+
+    @asynccontextmanager
+    async def _slot(self):
+        """Waits until fewer than max_concurrent searches are running"""
+        if self.max_concurrent is None:
+            yield
+            return
+        loop = asyncio.get_running_loop()
+        if self._semaphore_loop is not loop:
+            self._semaphore, self._semaphore_loop = asyncio.Semaphore(self.max_concurrent), loop
+        async with self._semaphore:
+            yield
+
+    async def _run(self, function, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, partial(function, *args))
+
+    async def _file_features(
+        self, afile, fs, trim, hop_length, win_length, nfft, decoder, cache, offset, dtype, chunk_frames, profiler, label
+    ):
+        profiler.metrics["cache_hits"][label] = False
+        if cache is not None:
+            key = await self._run(_cache_key, cache, afile, fs, trim, hop_length, win_length, nfft, offset, dtype)
+            features = await self._run(cache.get, key)
+            if features is not None:
+                profiler.metrics["cache_hits"][label] = True
+                profiler.metrics["mfcc_frames"][label] = len(features)
+                return features
+        if chunk_frames:
+            with profiler.stage("decode_" + label):
+                tmp = await convert_and_trim(afile, fs, trim, offset=offset)
+            try:
+                features, metrics = await self._run(
+                    _chunked_wav_features_with_metrics, tmp, fs, hop_length, win_length, nfft, label, dtype, chunk_frames
+                )
+            finally:
+                os.remove(tmp)
+        else:
+            with profiler.stage("decode_" + label):
+                audio = profiler.array(await self._load_audio(afile, fs, trim, decoder, offset, dtype))
+            profiler.metrics["decoded_samples"][label] = len(audio)
+            features, metrics = await self._run(_features_with_metrics, audio, fs, hop_length, win_length, nfft, label)
+            del audio
+        profiler.merge(metrics)
+        if cache is not None:
+            await self._run(cache.put, key, features)
+        return features
+
+    async def _find_offset_progressively(
+        self,
+        file1,
+        file2,
+        fs,
+        trim,
+        hop_length,
+        win_length,
+        nfft,
+        max_frames,
+        engine,
+        coarse_factor,
+        top_k,
+        min_score,
+        dtype,
+        profiler,
+    ):
+        """Like audio_offset_finder._find_offset_progressively(), streaming the files using stream_audio()"""
+        time_scale = hop_length / fs
+        streams = [stream_audio(afile, fs, fs, trim) for afile in (file1, file2)]
+        increments = [
+            _stream_increments(stream, 2 * max_frames * hop_length, profiler, label)
+            for stream, label in zip(streams, ("1", "2"))
+        ]
+        try:
+            features = [_IncrementalFeatures(fs, hop_length, win_length, nfft, dtype) for _ in range(2)]
+            mfccs = [None, None]
+            complete = [False, False]
+            previous_offset = None
+            while True:
+                # Once the whole of an input has been used, keep its MFCCs rather than calculating them again.  The
+                # files are decoded by independent FFmpeg processes, so read the next block of each concurrently.
+                extending = [i for i in range(2) if not complete[i]]
+                blocks = await _gather(*(increments[i].__anext__() for i in extending))
+                for i, (audio, complete[i]) in zip(extending, blocks):
+                    # The features are returned, as they may have been extended in another process
+                    features[i], mfccs[i], metrics = await self._run(
+                        _extend_with_metrics, features[i], audio, complete[i], str(i + 1)
+                    )
+                    profiler.merge(metrics)
+                del audio, blocks
+                try:
+                    results, metrics = await self._run(
+                        _find_offset_with_metrics, *mfccs, fs, hop_length, max_frames, engine, coarse_factor, top_k, None
+                    )
+                except InsufficientAudioException:
+                    if all(complete):
+                        raise
+                    continue
+                profiler.merge(metrics)
+                if all(complete) or _settled(results, previous_offset, min_score, time_scale):
+                    return results
+                previous_offset = results["time_offset"]
+        finally:
+            for generator in increments + streams:
+                await generator.aclose()
+
+    async def _load_audio(self, afile, fs, trim, decoder, offset, dtype):
+        if decoder == "pipe":
+            return (await decode_audio(afile, fs, trim, offset=offset)).astype(dtype)
+        elif decoder == "file":
+            tmp = await convert_and_trim(afile, fs, trim, offset=offset)
+            try:
+                return await self._run(_read_wav, tmp, dtype)
+            finally:
+                os.remove(tmp)
+        raise ValueError("Unknown decoder: %s" % decoder)
+
+
+async def decode_audio(afile, fs, trim=None, sample_format="s16le", offset=None):
+    """Decodes the input media to mono PCM samples without blocking the event loop.  The parameters and results are as
+    described for audio_offset_finder.decode_audio().  If the coroutine is cancelled, FFmpeg is killed."""
+    if sample_format not in PCM_FORMATS:
+        raise ValueError("Unknown sample format: %s" % sample_format)
+    ffmpeg_command = _ffmpeg_command(afile, fs, trim, offset)
+    ffmpeg_command += ["-f", sample_format, "-acodec", "pcm_" + sample_format, "-"]
+    output = await _run_ffmpeg(ffmpeg_command, read_output=True)
+    dtype = np.dtype(PCM_FORMATS[sample_format])
+    # Discard any incomplete trailing sample
+    return np.frombuffer(output, dtype=dtype, count=len(output) // dtype.itemsize)
+
+
+async def stream_audio(afile, fs, chunk_samples, trim=None, sample_format="s16le", offset=None):
+    """Decodes the input media incrementally without blocking the event loop, as an asynchronous generator of chunks
+    of samples.  The parameters and results are as described for audio_offset_finder.stream_audio().  If the generator
+    is closed before the end of the media, or the coroutine using it is cancelled, FFmpeg is killed."""
+    if sample_format not in PCM_FORMATS:
+        raise ValueError("Unknown sample format: %s" % sample_format)
+    ffmpeg_command = _ffmpeg_command(afile, fs, trim, offset)
+    ffmpeg_command += ["-f", sample_format, "-acodec", "pcm_" + sample_format, "-"]
+    dtype = np.dtype(PCM_FORMATS[sample_format])
+
+    process = await asyncio.create_subprocess_exec(*ffmpeg_command, stdout=PIPE, stderr=PIPE)
+    # Read stderr at the same time as the output, so that FFmpeg can't block on it
+    stderr = asyncio.ensure_future(process.stderr.read())
+    try:
+        while True:
+            try:
+                data = await process.stdout.readexactly(chunk_samples * dtype.itemsize)
+            except asyncio.IncompleteReadError as e:
+                data = e.partial
+            if len(data) < dtype.itemsize:
+                break
+            yield np.frombuffer(data, dtype=dtype, count=len(data) // dtype.itemsize)
+        await process.wait()
+    finally:
+        if process.returncode is None:
+            process.kill()
+            # asyncio only reports that FFmpeg has exited once its output has been read to the end
+            await process.stdout.read()
+            await process.wait()
+        await asyncio.gather(stderr, return_exceptions=True)
+    if process.returncode != 0:
+        raise Exception("FFMpeg failed:\n" + stderr.result().decode("utf-8", errors="replace").strip())
+
+
+async def _stream_increments(chunks, first_samples, profiler, label):
+    """Like audio_offset_finder._stream_increments(), but for an asynchronous generator of chunks"""
+    audio, total, size = [], 0, first_samples
+    while True:
+        with profiler.stage("decode_" + label):
+            try:
+                chunk = await chunks.__anext__()
+            except StopAsyncIteration:
+                break
+        audio.append(chunk)
+        total += len(chunk)
+        if total >= size:
+            yield np.concatenate(audio), False
+            audio = []
+            size *= 2
+    yield np.concatenate(audio) if audio else np.empty(0, dtype=np.int16), True
+
+
+async def convert_and_trim(afile, fs, trim=None, offset=None):
+    """Converts the input media to a temporary 16-bit WAV file without blocking the event loop.  The parameters and
+    results are as described for audio_offset_finder.convert_and_trim().  If the coroutine is cancelled (or FFmpeg
+    fails), FFmpeg is killed and the temporary file is deleted."""
+    tmp = tempfile.NamedTemporaryFile(mode="r+b", prefix="offset_", suffix=".wav")
+    tmp_name = tmp.name
+    tmp.close()
+
+    ffmpeg_command = _ffmpeg_command(afile, fs, trim, offset)
+    ffmpeg_command += ["-acodec", "pcm_s16le"]
+    ffmpeg_command += [tmp_name]
+    try:
+        await _run_ffmpeg(ffmpeg_command, read_output=False)
+    except BaseException:
+        if os.path.exists(tmp_name):
+            os.remove(tmp_name)
+        raise
+    return tmp_name
+
+
+async def _run_ffmpeg(ffmpeg_command, read_output):
+    """Runs FFmpeg, returning its output (if read_output is True), and making sure that it has exited before returning
+    or raising an exception, including when the coroutine is cancelled"""
+    process = await asyncio.create_subprocess_exec(*ffmpeg_command, stdout=PIPE if read_output else DEVNULL, stderr=PIPE)
+    try:
+        if read_output:
+            # Read stderr at the same time as the output, so that FFmpeg can't block on it
+            output, stderr = await asyncio.gather(_read_stream(process.stdout), process.stderr.read())
+        else:
+            output, stderr = None, await process.stderr.read()
+        await process.wait()
+    finally:
+        if process.returncode is None:
+            process.kill()
+            await process.wait()
+    if process.returncode != 0:
+        raise Exception("FFMpeg failed:\n" + stderr.decode("utf-8", errors="replace").strip())
+    return output
+
+
+async def _read_stream(stream):
+    """Reads a stream to the end into a (writable) bytearray"""
+    data = bytearray()
+    while True:
+        chunk = await stream.read(1 << 16)
+        if not chunk:
+            return data
+        data += chunk
+
+
+async def _gather(*coroutines):
+    """Like asyncio.gather(), but if any of the coroutines fails, the others are cancelled (and waited for)"""
+    tasks = [asyncio.ensure_future(coroutine) for coroutine in coroutines]
+    try:
+        return await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+
+
+# These run in the executor, possibly in another process, so they return the metrics they collect rather than adding
+# them to the search's profiler
+def _features_with_metrics(audio, fs, hop_length, win_length, nfft, label):
+    profiler = _Profiler()
+    features = _features(audio, fs, hop_length, win_length, nfft, profiler, label)
+    return features, profiler.metrics
+
+
+def _chunked_wav_features_with_metrics(path, fs, hop_length, win_length, nfft, label, dtype, chunk_frames):
+    profiler = _Profiler()
+    features = _chunked_wav_features(path, fs, hop_length, win_length, nfft, profiler, label, dtype, chunk_frames)
+    return features, profiler.metrics
+
+
+def _extend_with_metrics(features, audio, complete, label):
+    profiler = _Profiler()
+    mfccs = features.extend(audio, complete, profiler, label)
+    return features, mfccs, profiler.metrics
+
+
+def _find_offset_with_metrics(mfcc1, mfcc2, fs, hop_length, max_frames, engine, coarse_factor, top_k, lag_range):
+    profiler = _Profiler()
+    results = _find_offset_between_features(
+        mfcc1, mfcc2, fs, hop_length, max_frames, engine, coarse_factor, top_k, lag_range=lag_range, profiler=profiler
+    )
+    return results, profiler.metrics
+
+
+def _read_wav(path, dtype):
+    from scipy.io import wavfile
+
+    return wavfile.read(path, mmap=True)[1].astype(dtype)
@@ -14,11 +14,15 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import lru_cache
+from itertools import combinations
 from subprocess import Popen, PIPE
-from scipy.io import wavfile
-import librosa
 import os
 import tempfile
+import threading
+import time
 import warnings
 import numpy as np
 
@@ -29,16 +33,242 @@ class InsufficientAudioException(Exception):
     pass
 
 
-def mfcc(audio, win_length=256, nfft=512, fs=16000, hop_length=128, numcep=13):
-    """Wraps the librosa MFCC routine.  Somewhat present for historical reasons at this point."""
-    return [
-        np.transpose(
-            librosa.feature.mfcc(y=audio, sr=fs, n_fft=nfft, win_length=win_length, hop_length=hop_length, n_mfcc=numcep)
+class _Profiler:
+    """Collects the timings and sizes reported when profiling a search (see find_offset_between_buffers())"""
+
+    def __init__(self):
+        self.metrics = {
+            "stage_seconds": {},
+            "decoded_samples": {},
+            "mfcc_frames": {},
+            "cache_hits": {},
+            "correlated_frames": None,
+            "lags_evaluated": 0,
+            "peak_array_bytes": 0,
+        }
+        self._start = time.perf_counter()
+
+    @contextmanager
+    def stage(self, name):
+        """Times the code run within the context, adding it to the total time for the named stage"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            stage_seconds = self.metrics["stage_seconds"]
+            stage_seconds[name] = stage_seconds.get(name, 0.0) + time.perf_counter() - start
+
+    def array(self, array):
+        """Records the size of an array, so that the size of the largest array used is known, and returns the array"""
+        self.metrics["peak_array_bytes"] = max(self.metrics["peak_array_bytes"], array.nbytes)
+        return array
+
+    def merge(self, metrics):
+        """Adds the metrics collected by another profiler (e.g. in another process) for part of the same search"""
+        for name, value in metrics["stage_seconds"].items():
+            self.metrics["stage_seconds"][name] = self.metrics["stage_seconds"].get(name, 0.0) + value
+        for name in ("decoded_samples", "mfcc_frames", "cache_hits"):
+            self.metrics[name].update(metrics[name])
+        if metrics["correlated_frames"] is not None:
+            self.metrics["correlated_frames"] = metrics["correlated_frames"]
+        self.metrics["lags_evaluated"] += metrics["lags_evaluated"]
+        self.metrics["peak_array_bytes"] = max(self.metrics["peak_array_bytes"], metrics["peak_array_bytes"])
+
+    def finish(self, results, profile, on_metrics):
+        """Completes the metrics, adding them to the results and passing them to the callback, as requested"""
+        self.metrics["stage_seconds"]["total"] = time.perf_counter() - self._start
+        if profile:
+            results["profile"] = self.metrics
+        if on_metrics is not None:
+            on_metrics(self.metrics)
+        return results
+
+
+def mfcc(audio, win_length=256, nfft=512, fs=16000, hop_length=128, numcep=13, center=True, backend="numpy"):
+    """Calculates the MFCCs of an audio buffer, returning a list containing an array with one row per frame.  (The list
+    is present for historical reasons.)  If the buffer is a 2D array with one row per channel (as returned by
+    decode_tracks()), the MFCCs of all the channels are calculated together, and the list contains an array for each.
+
+    The "numpy" backend (the default) is a NumPy/SciPy implementation that matches librosa.feature.mfcc() (with its
+    default Slaney-style mel filterbank, 128 mel bands and 80dB dynamic range) to within floating-point tolerance.  It
+    caches the mel filterbank and DCT matrices for each set of parameters, and calculates the STFT in batches of frames.
+    The "librosa" backend calls librosa.feature.mfcc() itself.  librosa is only imported if it is used.
+    """
+    if backend == "librosa":
+        import librosa
+
+        features = np.swapaxes(
+            librosa.feature.mfcc(
+                y=audio, sr=fs, n_fft=nfft, win_length=win_length, hop_length=hop_length, n_mfcc=numcep, center=center
+            ),
+            -1,
+            -2,
         )
-    ]
+        return list(features) if audio.ndim > 1 else [features]
+    elif backend != "numpy":
+        raise ValueError("Unknown MFCC backend: %s" % backend)
+    if not np.issubdtype(audio.dtype, np.floating):
+        raise ValueError("Audio data must be floating-point")
+    if center:
+        # Centre the frames on multiples of hop_length by padding with zeros, as librosa does
+        audio = np.pad(audio, [(0, 0)] * (audio.ndim - 1) + [(nfft // 2, nfft // 2)])
+    S_db = _power_to_db(_mel_power_spectrogram(audio, fs, nfft, win_length, hop_length))
+    # The dynamic range is limited separately for each channel
+    np.maximum(S_db, S_db.max(axis=(-2, -1), keepdims=True) - 80.0, out=S_db)
+    features = S_db @ _dct_matrix(numcep, S_db.shape[-1], S_db.dtype).T
+    return list(features) if audio.ndim > 1 else [features]
+
+
+def _mel_power_spectrogram(audio, fs, nfft, win_length, hop_length, block_frames=1024):
+    """Returns the mel power spectrogram of audio (without centring the frames), with one row per frame (and, for 2D
+    audio, one such array per channel).  The STFT is calculated block_frames frames at a time, to limit the size of the
+    temporary arrays."""
+    from scipy import fft
+
+    window = _stft_window(win_length, nfft, audio.dtype)
+    mel_basis = _mel_filterbank(fs, nfft, audio.dtype)
+    frames = np.lib.stride_tricks.sliding_window_view(audio, nfft, axis=-1)[..., ::hop_length, :]
+    S = np.empty(frames.shape[:-1] + (len(mel_basis),), dtype=audio.dtype)
+    for start in range(0, frames.shape[-2], block_frames):
+        spectrum = fft.rfft(frames[..., start : start + block_frames, :] * window, axis=-1)
+        power = np.square(spectrum.real) + np.square(spectrum.imag)
+        np.matmul(power, mel_basis.T, out=S[..., start : start + block_frames, :])
+    return S
+
+
+def _power_to_db(S):
+    """Converts a power spectrogram to decibels in place, as librosa.power_to_db() does (without its top_db limit)"""
+    np.maximum(S, 1e-10, out=S)
+    np.log10(S, out=S)
+    S *= 10.0
+    return S
+
+
+@lru_cache(maxsize=None)
+def _stft_window(win_length, nfft, dtype):
+    """Returns a periodic Hann window of length win_length, padded with zeros on both sides to length nfft"""
+    n = np.arange(win_length)
+    window = np.zeros(nfft, dtype=dtype)
+    offset = (nfft - win_length) // 2
+    window[offset : offset + win_length] = 0.5 - 0.5 * np.cos(2 * np.pi * n / win_length)
+    window.flags.writeable = False
+    return window
+
+
+@lru_cache(maxsize=None)
+def _mel_filterbank(fs, nfft, dtype, n_mels=128):
+    """Returns the Slaney-style, area-normalised mel filterbank used by librosa.filters.mel(), with one row per band"""
+
+    # Slaney's mel scale is linear below 1kHz and logarithmic above it
+    def hz_to_mel(frequencies):
+        return np.where(
+            frequencies >= 1000, 15 + np.log(np.maximum(frequencies, 1e-10) / 1000) / (np.log(6.4) / 27), frequencies * 3 / 200
+        )
+
+    def mel_to_hz(mels):
+        return np.where(mels >= 15, 1000 * np.exp(np.log(6.4) / 27 * (mels - 15)), mels * 200 / 3)
+
+    fft_frequencies = np.fft.rfftfreq(nfft, 1 / fs)
+    mel_frequencies = mel_to_hz(np.linspace(hz_to_mel(np.array(0.0)), hz_to_mel(np.array(fs / 2)), n_mels + 2))
+    ramps = np.subtract.outer(mel_frequencies, fft_frequencies)
+    lower = -ramps[:-2] / np.diff(mel_frequencies)[:-1, None]
+    upper = ramps[2:] / np.diff(mel_frequencies)[1:, None]
+    weights = np.maximum(0, np.minimum(lower, upper))
+    # Normalise each band to constant energy per Hz
+    weights *= (2.0 / (mel_frequencies[2:] - mel_frequencies[:-2]))[:, None]
+    weights = weights.astype(dtype)
+    weights.flags.writeable = False
+    return weights
+
+
+@lru_cache(maxsize=None)
+def _dct_matrix(numcep, n, dtype):
+    """Returns the first numcep rows of the orthonormal DCT-II matrix of size n, as used by librosa.feature.mfcc()"""
+    k = np.arange(numcep)[:, None]
+    matrix = np.cos(np.pi * k * (2 * np.arange(n) + 1) / (2 * n)) * np.sqrt(2 / n)
+    matrix[0] /= np.sqrt(2)
+    matrix = matrix.astype(dtype)
+    matrix.flags.writeable = False
+    return matrix
+
+
+def mfcc_chunked(
+    audio, win_length=256, nfft=512, fs=16000, hop_length=128, numcep=13, chunk_frames=4096, out=None, dtype=np.float32
+):
+    """Calculates the same MFCCs as mfcc() (with center=True and the default backend), a block of frames at a time.
+
+    Only chunk_frames frames' worth of audio and spectra are held in memory at once, so the audio can be a memory-mapped
+    array of any length (e.g. from scipy.io.wavfile.read(..., mmap=True)), and the MFCCs can be written to a
+    memory-mapped array too.  Each block of audio is converted to dtype as it is read.  As the dynamic range of the mel
+    spectrogram is limited relative to its loudest point, the audio is read twice: once to find the loudest point, and
+    once to calculate the MFCCs.
+
+    Parameters
+    ----------
+    audio: numpy array
+        The audio samples, of any numeric type
+    chunk_frames: int
+        The number of MFCC frames to calculate at once.  This is rounded up to a multiple of 16, as the FFT library
+        processes frames in groups, and keeping the groups aligned makes the results identical to those of mfcc().
+    out: numpy array
+        If supplied, the MFCCs are written to this array, which must have shape (1 + len(audio) // hop_length, numcep).
+        It can be a memory-mapped array, e.g. from numpy.lib.format.open_memmap().
+    dtype: numpy dtype
+        The floating-point type used for the calculations, and for the MFCCs if out is not supplied
+
+    The remaining parameters are as described for mfcc().
+
+    Returns
+    -------
+    A 2D numpy array containing the MFCCs, with one row per frame (out, if it was supplied).
+    """
+    chunk_frames = -(-chunk_frames // 16) * 16
+    nframes = 1 + len(audio) // hop_length
+    if out is None:
+        out = np.empty((nframes, numcep), dtype=dtype)
+    elif out.shape != (nframes, numcep):
+        raise ValueError("The output array must have shape %s" % str((nframes, numcep)))
+
+    def mel_spectrograms():
+        for start in range(0, nframes, chunk_frames):
+            stop = min(start + chunk_frames, nframes)
+            # Pad the block with zeros beyond the ends of the audio, as mfcc() does when centring the frames
+            first_sample = start * hop_length - nfft // 2
+            block = np.zeros((stop - start - 1) * hop_length + nfft, dtype=dtype)
+            available = audio[max(first_sample, 0) : first_sample + len(block)]
+            block[max(-first_sample, 0) : max(-first_sample, 0) + len(available)] = available
+            yield start, stop, _mel_power_spectrogram(block, fs, nfft, win_length, hop_length)
+
+    # Equivalent to the 80dB dynamic range limit applied by mfcc() to the whole mel spectrogram
+    min_db = _power_to_db(np.full(1, max(S.max() for _, _, S in mel_spectrograms())))[0] - 80.0
+    for start, stop, S in mel_spectrograms():
+        S_db = np.maximum(_power_to_db(S), min_db, out=S)
+        out[start:stop] = S_db @ _dct_matrix(numcep, S_db.shape[1], S_db.dtype).T
+    return out
 
 
-def find_offset_between_files(file1, file2, fs=8000, trim=None, hop_length=128, win_length=256, nfft=512, max_frames=2000):
+def find_offset_between_files(
+    file1,
+    file2,
+    fs=8000,
+    trim=None,
+    hop_length=128,
+    win_length=256,
+    nfft=512,
+    max_frames=2000,
+    engine="fft",
+    decoder="pipe",
+    cache=None,
+    coarse_factor=None,
+    top_k=3,
+    expected_offset=None,
+    max_offset=None,
+    profile=False,
+    on_metrics=None,
+    dtype=np.float32,
+    chunk_frames=None,
+    min_score=None,
+):
     """Find the offset time offset between two audio files.
 
     This function takes in two file paths, and (assuming they are media files with a valid audio track)
@@ -61,6 +291,42 @@ def find_offset_between_files(file1, file2, fs=8000, trim=None, hop_length=128,
         The length of the window function used to avoid transients adding spurious high frequencies to the MFCCs
     nfft: int
         The number of samples to use in the FFTs used to generate the MFCCs
+    max_frames: int
+        The maximum number of MFCC frames of file2 to use in the cross-correlation
+    engine: string
+        The cross-correlation engine to use - "fft" (the default) or "loop".  See cross_correlation().
+    decoder: string
+        How decoded audio is passed from FFmpeg - "pipe" (the default) streams it through a pipe into memory using
+        decode_audio(), "file" writes it to a temporary WAV file using convert_and_trim() and reads it back
+    cache: FeatureCache
+        An optional cache of MFCCs (see audio_offset_finder.cache).  Files whose features are found in the cache are
+        not decoded again.
+    coarse_factor: int
+        If set, search coarse-to-fine rather than exhaustively.  See find_offset_between_buffers().
+    top_k: int
+        The number of coarse candidates to refine when coarse_factor is set
+    expected_offset: float
+        The offset of file2 compared to file1 that is expected, in seconds (0 if not given).  Only used with max_offset.
+    max_offset: float
+        If set, only offsets within this many seconds of expected_offset are searched, and only the parts of the two
+        files needed to cover those offsets are decoded.  This makes the search much faster for long files.
+    profile: bool
+        If True, add a profile of the time and memory taken by each stage of the search to the results.  See
+        find_offset_between_buffers() for details.
+    on_metrics: callable
+        If set, this is called with the profile of the search (whether or not profile is True) before returning.
+    dtype: numpy dtype
+        The floating-point type used for the decoded audio, the MFCCs and the cross-correlation.  The default,
+        float32, halves the memory used compared to float64 and gives the same offsets.
+    chunk_frames: int
+        If set, each file is decoded to a temporary WAV file, and its MFCCs are calculated this many frames at a time
+        from a memory map of it using mfcc_chunked(), so that very long files can be processed without holding all of
+        their audio in memory.  The decoder parameter is ignored.
+    min_score: float
+        If set, search progressively longer parts of the files, stopping early once the standard score reaches this
+        value.  See find_offset_between_buffers().  The files are decoded incrementally using stream_audio(), and
+        FFmpeg is stopped as soon as the search does, so easy pairs of long files are only partly decoded.  The cache,
+        decoder and chunk_frames parameters are ignored, and it can't be used with max_offset.
 
     Returns
     -------
@@ -71,24 +337,238 @@ def find_offset_between_files(file1, file2, fs=8000, trim=None, hop_length=128,
     standard_score (float): the standard score of the highest correlation coefficient in the cross-correlation curve
     correlation (numpy int array): the 1D array of correlation coefficients calculated for the two input files
     time_scale: the scalar factor that is multiplied to frame offsets to convert them to time offsets
-    earliest_frame_offset (int): the earliest offset searched for a correlation.  Always negative.
-    latest_frame_offset (int): the latest offset searched for a correlation.  Always positive.
+    earliest_frame_offset (int): the earliest offset searched for a correlation.  Negative unless max_offset is used.
+    latest_frame_offset (int): the latest offset searched for a correlation.  Positive unless max_offset is used.
 
     Throws
     ------
     InsufficientAudioException if the audio supplied is too short to analyse.
     """
-    tmp1 = convert_and_trim(file1, fs, trim)
-    tmp2 = convert_and_trim(file2, fs, trim)
-    a1 = wavfile.read(tmp1, mmap=True)[1].astype(float)
-    a2 = wavfile.read(tmp2, mmap=True)[1].astype(float)
-    offset_dict = find_offset_between_buffers(a1, a2, fs, hop_length, win_length, nfft)
-    os.remove(tmp1)
-    os.remove(tmp2)
-    return offset_dict
+    profiler = _Profiler()
+    time_scale = hop_length / fs
+    lag_range = _search_lag_range(expected_offset, max_offset, time_scale)
+    if min_score is not None:
+        if lag_range is not None:
+            raise ValueError("A minimum score can't be used with a maximum offset")
+        # Stream the files in chunks of a second, and stop FFmpeg if the search finishes before the end of them
+        streams = [stream_audio(afile, fs, fs, trim) for afile in (file1, file2)]
+        try:
+            first_samples = 2 * max_frames * hop_length
+            results = _find_offset_progressively(
+                *(_stream_increments(stream, first_samples, profiler, label) for stream, label in zip(streams, ("1", "2"))),
+                fs,
+                hop_length,
+                win_length,
+                nfft,
+                max_frames,
+                engine,
+                coarse_factor,
+                top_k,
+                min_score,
+                dtype,
+                profiler,
+            )
+        finally:
+            for stream in streams:
+                stream.close()
+        return profiler.finish(results, profile, on_metrics)
+    decode_ranges, start_frames, lag_range = _decode_ranges(lag_range, trim, hop_length, nfft, max_frames, coarse_factor, fs)
+
+    # The two files are decoded by independent FFmpeg processes, so decode them (and calculate their MFCCs) concurrently
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        futures = [
+            executor.submit(
+                _file_features,
+                afile,
+                fs,
+                duration,
+                hop_length,
+                win_length,
+                nfft,
+                decoder,
+                cache,
+                offset,
+                profiler,
+                label,
+                dtype,
+                chunk_frames,
+            )
+            for afile, (offset, duration), label in zip((file1, file2), decode_ranges, ("1", "2"))
+        ]
+        mfcc1, mfcc2 = [future.result() for future in futures]
+    results = _find_offset_between_features(
+        mfcc1, mfcc2, fs, hop_length, max_frames, engine, coarse_factor, top_k, lag_range=lag_range, profiler=profiler
+    )
+    if start_frames:
+        _shift_results(results, start_frames * time_scale)
+    return profiler.finish(results, profile, on_metrics)
+
+
+def _decode_ranges(lag_range, trim, hop_length, nfft, max_frames, coarse_factor, fs):
+    """Works out which parts of two files need to be decoded to search a range of offsets between them (or the whole
+    of them, if lag_range is None).
+
+    Returns the (offset, duration) to decode of each file, the number of frames skipped at the start of the first
+    file, and the range of offsets to search relative to the audio decoded.
+    """
+    if lag_range is None:
+        return [(None, trim), (None, trim)], 0, None
+    # Only decode the audio needed to cover the search window: the part of file1 that the start of file2 could
+    # overlap with, and the start of file2 (including any part of it that could come before the start of file1)
+    time_scale = hop_length / fs
+    clip_frames = max_frames + int(np.ceil(nfft / hop_length))
+    start_frames = max(0, lag_range[0])
+    if coarse_factor:
+        start_frames -= start_frames % coarse_factor
+    file1_frames = max(lag_range[1] - start_frames + clip_frames, 3 * clip_frames)
+    file2_frames = max(0, -lag_range[0]) + clip_frames
+    decode_ranges = [
+        _decode_range(start_frames, file1_frames, time_scale, trim),
+        _decode_range(0, file2_frames, time_scale, trim),
+    ]
+    return decode_ranges, start_frames, (lag_range[0] - start_frames, lag_range[1] - start_frames)
+
+
+def _decode_range(start_frames, nframes, time_scale, trim):
+    """Returns the (offset, duration) in seconds of the audio to decode to cover a range of MFCC frames"""
+    offset, duration = start_frames * time_scale, nframes * time_scale
+    if trim:
+        duration = min(duration, trim - offset)
+        if duration <= 0:
+            raise InsufficientAudioException("Not enough audio to analyse around the expected offset.")
+    return offset or None, duration
+
+
+def _shift_results(results, shift):
+    """Adjusts a results dict for a search in which the start of the first file was skipped by shift seconds"""
+    frames = int(round(shift / results["time_scale"]))
+    results["time_offset"] += shift
+    results["frame_offset"] += frames
+    results["earliest_frame_offset"] += frames
+    results["latest_frame_offset"] += frames
+    # Keep the coefficients laid out in the same way as cross_correlation() does
+    results["correlation"] = np.roll(results["correlation"], frames)
+    for candidate in results.get("refined_candidates", []):
+        candidate["coarse_time_offset"] += shift
+        candidate["time_offset"] += shift
+
+
+def _file_features(
+    afile,
+    fs,
+    trim,
+    hop_length,
+    win_length,
+    nfft,
+    decoder,
+    cache=None,
+    offset=None,
+    profiler=None,
+    label="1",
+    dtype=np.float32,
+    chunk_frames=None,
+):
+    """Decodes a media file and returns its standardised MFCCs, using the cache if one is supplied"""
+    profiler = profiler or _Profiler()
+    profiler.metrics["cache_hits"][label] = False
+    if cache is not None:
+        key = _cache_key(cache, afile, fs, trim, hop_length, win_length, nfft, offset, dtype)
+        features = cache.get(key)
+        if features is not None:
+            profiler.metrics["cache_hits"][label] = True
+            profiler.metrics["mfcc_frames"][label] = len(features)
+            return features
+    if chunk_frames:
+        features = _chunked_file_features(
+            afile, fs, trim, hop_length, win_length, nfft, offset, profiler, label, dtype, chunk_frames
+        )
+    else:
+        with profiler.stage("decode_" + label):
+            audio = profiler.array(_load_audio(afile, fs, trim, decoder, offset, dtype))
+        profiler.metrics["decoded_samples"][label] = len(audio)
+        features = _features(audio, fs, hop_length, win_length, nfft, profiler, label)
+        del audio
+    if cache is not None:
+        cache.put(key, features)
+    return features
+
+
+def _cache_key(cache, afile, fs, trim, hop_length, win_length, nfft, offset, dtype):
+    """Returns the key of a media file's standardised MFCCs in a FeatureCache"""
+    params = dict(
+        fs=fs, trim=trim, hop_length=hop_length, win_length=win_length, nfft=nfft, numcep=26, dtype=np.dtype(dtype).name
+    )
+    if offset:
+        params["offset"] = offset
+    return cache.key(afile, **params)
 
 
-def find_offset_between_buffers(buffer1, buffer2, fs, hop_length=128, win_length=256, nfft=512, max_frames=2000):
+def _chunked_file_features(afile, fs, trim, hop_length, win_length, nfft, offset, profiler, label, dtype, chunk_frames):
+    """Decodes a media file to a temporary WAV file, and calculates its standardised MFCCs a block at a time from a
+    memory map of it, so that the decoded audio never has to fit in memory"""
+    with profiler.stage("decode_" + label):
+        tmp = convert_and_trim(afile, fs, trim, offset=offset)
+    try:
+        return _chunked_wav_features(tmp, fs, hop_length, win_length, nfft, profiler, label, dtype, chunk_frames)
+    finally:
+        os.remove(tmp)
+
+
+def _chunked_wav_features(path, fs, hop_length, win_length, nfft, profiler, label, dtype, chunk_frames):
+    """Calculates the standardised MFCCs of a WAV file a block at a time from a memory map of it"""
+    from scipy.io import wavfile
+
+    audio = wavfile.read(path, mmap=True)[1]
+    profiler.metrics["decoded_samples"][label] = len(audio)
+    with profiler.stage("mfcc_" + label):
+        features = mfcc_chunked(audio, win_length, nfft, fs, hop_length, numcep=26, chunk_frames=chunk_frames, dtype=dtype)
+    del audio
+    with profiler.stage("standardise_" + label):
+        # Equivalent to std_mfcc(), but without allocating another array of the same size
+        mean = np.mean(features, axis=0, dtype=np.float64)
+        squares = np.zeros(features.shape[1])
+        for start in range(0, len(features), chunk_frames):
+            block = features[start : start + chunk_frames]
+            block -= mean.astype(features.dtype)
+            squares += np.sum(np.square(block, dtype=np.float64), axis=0)
+        features /= np.sqrt(squares / len(features)).astype(features.dtype)
+    profiler.metrics["mfcc_frames"][label] = len(features)
+    return profiler.array(features)
+
+
+def _load_audio(afile, fs, trim, decoder, offset=None, dtype=np.float32):
+    """Decodes a media file to a floating-point numpy array of the given type using the given decoder ("pipe" or "file")"""
+    if decoder == "pipe":
+        return decode_audio(afile, fs, trim, offset=offset).astype(dtype)
+    elif decoder == "file":
+        from scipy.io import wavfile
+
+        tmp = convert_and_trim(afile, fs, trim, offset=offset)
+        try:
+            return wavfile.read(tmp, mmap=True)[1].astype(dtype)
+        finally:
+            os.remove(tmp)
+    raise ValueError("Unknown decoder: %s" % decoder)
+
+
+def find_offset_between_buffers(
+    buffer1,
+    buffer2,
+    fs,
+    hop_length=128,
+    win_length=256,
+    nfft=512,
+    max_frames=2000,
+    engine="fft",
+    coarse_factor=None,
+    top_k=3,
+    expected_offset=None,
+    max_offset=None,
+    profile=False,
+    on_metrics=None,
+    dtype=np.float32,
+    min_score=None,
+):
     """Find the offset time offset between two audio files.
 
     This function takes in two numpy arrays (assumed to be PCM audio) and compares them using cross-correlation of
@@ -109,6 +589,39 @@ def find_offset_between_buffers(buffer1, buffer2, fs, hop_length=128, win_length
         The length of the window function used to avoid transients adding spurious high frequencies to the MFCCs
     nfft: int
         The number of samples to use in the FFTs used to generate the MFCCs
+    max_frames: int
+        The maximum number of MFCC frames of buffer2 to use in the cross-correlation
+    engine: string
+        The cross-correlation engine to use - "fft" (the default) or "loop".  See cross_correlation().
+    coarse_factor: int
+        If set, search coarse-to-fine rather than exhaustively: the whole range of offsets is first searched using
+        only every coarse_factor'th MFCC frame (equivalent to a hop length coarse_factor times longer), and then the
+        top_k highest peaks found are refined by searching a few coarse frames either side of them at full resolution.
+        This is much faster for long buffers and small hop lengths, but may miss the best offset if it does not stand
+        out at the coarse resolution.
+    top_k: int
+        The number of coarse candidates to refine when coarse_factor is set
+    expected_offset: float
+        The offset of buffer2 compared to buffer1 that is expected, in seconds (0 if not given).  Only used with max_offset.
+    max_offset: float
+        If set, only offsets within this many seconds of expected_offset are searched
+    profile: bool
+        If True, add a profile of the time and memory taken by each stage of the search to the results
+    on_metrics: callable
+        If set, this is called with the profile of the search (whether or not profile is True) before returning.  It
+        can be used to forward the profile to a telemetry system.
+    dtype: numpy dtype
+        The floating-point type used for the MFCCs and the cross-correlation.  The buffers are converted to this type
+        if necessary.  The default, float32, halves the memory used compared to float64 and gives the same offsets.
+    min_score: float
+        If set, search progressively rather than all at once: the offset is first found between the first 2 *
+        max_frames MFCC frames of each buffer, then between twice as many, and so on.  The search stops as soon as the
+        standard score reaches min_score and the offset found is the same (to within a frame) as in the previous step,
+        so offsets that are unambiguous near the start of long buffers are found quickly, while others are searched
+        exhaustively as usual.  The MFCCs of each part are only calculated once, so an exhaustive progressive search
+        takes little longer than a single search.  Offsets beyond the part of the buffers that has been searched
+        aren't considered, so this should only be used when such a high score is unlikely to be found at the wrong
+        offset.  It can't be used with max_offset.
 
     Returns
     -------
@@ -119,44 +632,356 @@ def find_offset_between_buffers(buffer1, buffer2, fs, hop_length=128, win_length
     standard_score (float): the standard score of the highest correlation coefficient in the cross-correlation curve
     correlation (numpy int array): the 1D array of correlation coefficients calculated for the two input buffers
     time_scale: the scalar factor that is multiplied to frame offsets to convert them to time offsets
-    earliest_frame_offset (int): the earliest offset searched for a correlation.  Always negative.
-    latest_frame_offset (int): the latest offset searched for a correlation.  Always positive.
+    earliest_frame_offset (int): the earliest offset searched for a correlation.  Negative unless max_offset is used.
+    latest_frame_offset (int): the latest offset searched for a correlation.  Positive unless max_offset is used.
+
+    If the search stopped early because of min_score, all of these describe the last (partial) search.
+
+    When searching coarse-to-fine, time_offset is the refined offset, while frame_offset, standard_score, correlation,
+    time_scale, earliest_frame_offset and latest_frame_offset all describe the coarse search.  The dict also contains:
+    refined_candidates (list of dicts): the candidates that were refined, in order of decreasing coarse peak height.
+                                        Each contains the coarse_time_offset of the coarse peak, the refined
+                                        time_offset, and the refined peak correlation coefficient.
+
+    When profiling, the dict also contains:
+    profile (dict): a dict containing the following:
+        stage_seconds (dict): the wall-clock time taken by each stage, in seconds, keyed by stage name: "decode_1",
+                              "mfcc_1" and "standardise_1" for the first input (and similarly for the second),
+                              "correlation", and "total".  When the inputs are processed concurrently, the total may be
+                              less than the sum of the other stages.
+        decoded_samples (dict): the number of samples decoded from each input, keyed by "1" and "2"
+        mfcc_frames (dict): the number of MFCC frames calculated for each input, keyed by "1" and "2"
+        cache_hits (dict): whether each input's MFCCs were found in the feature cache, keyed by "1" and "2"
+        correlated_frames (int): the number of frames of the second input that were cross-correlated
+        lags_evaluated (int): the total number of offsets at which cross-correlation coefficients were calculated
+        peak_array_bytes (int): the size of the largest array of samples, MFCCs or coefficients used, in bytes
 
     Throws
     ------
     InsufficientAudioException if the audio supplied is too short to analyse.
     """
-    mfcc1 = mfcc(buffer1, win_length=win_length, nfft=nfft, fs=fs, hop_length=hop_length, numcep=26)[0]
-    mfcc2 = mfcc(buffer2, win_length=win_length, nfft=nfft, fs=fs, hop_length=hop_length, numcep=26)[0]
-    mfcc1 = std_mfcc(mfcc1)
-    mfcc2 = std_mfcc(mfcc2)
+    profiler = _Profiler()
+    lag_range = _search_lag_range(expected_offset, max_offset, hop_length / fs)
+    if min_score is not None:
+        if lag_range is not None:
+            raise ValueError("A minimum score can't be used with a maximum offset")
+        first_samples = 2 * max_frames * hop_length
+        results = _find_offset_progressively(
+            *(_buffer_increments(buffer, first_samples) for buffer in (buffer1, buffer2)),
+            fs,
+            hop_length,
+            win_length,
+            nfft,
+            max_frames,
+            engine,
+            coarse_factor,
+            top_k,
+            min_score,
+            dtype,
+            profiler,
+        )
+        return profiler.finish(results, profile, on_metrics)
+    mfccs = []
+    for buffer, label in ((buffer1, "1"), (buffer2, "2")):
+        # Only copies the buffer if it isn't already of the right type
+        buffer = np.asarray(buffer, dtype=dtype)
+        profiler.metrics["decoded_samples"][label] = len(profiler.array(buffer))
+        mfccs.append(_features(buffer, fs, hop_length, win_length, nfft, profiler, label))
+    results = _find_offset_between_features(
+        *mfccs, fs, hop_length, max_frames, engine, coarse_factor, top_k, lag_range=lag_range, profiler=profiler
+    )
+    return profiler.finish(results, profile, on_metrics)
+
+
+def _features(buffer, fs, hop_length, win_length, nfft, profiler=None, label="1"):
+    """Returns the standardised MFCCs of an audio buffer, as used for cross-correlation"""
+    profiler = profiler or _Profiler()
+    with profiler.stage("mfcc_" + label):
+        features = mfcc(buffer, win_length=win_length, nfft=nfft, fs=fs, hop_length=hop_length, numcep=26)[0]
+    with profiler.stage("standardise_" + label):
+        features = profiler.array(std_mfcc(features))
+    profiler.metrics["mfcc_frames"][label] = len(features)
+    return features
+
+
+def _find_offset_progressively(
+    increments1,
+    increments2,
+    fs,
+    hop_length,
+    win_length,
+    nfft,
+    max_frames,
+    engine,
+    coarse_factor,
+    top_k,
+    min_score,
+    dtype,
+    profiler,
+):
+    """Finds the offset between successively longer prefixes of two inputs, stopping once the result is unambiguous.
+
+    increments1 and increments2 yield (audio, complete) pairs, as _buffer_increments() does.  See
+    find_offset_between_buffers() for details.
+    """
+    time_scale = hop_length / fs
+    features = [_IncrementalFeatures(fs, hop_length, win_length, nfft, dtype) for _ in range(2)]
+    mfccs = [None, None]
+    complete = [False, False]
+    previous_offset = None
+    while True:
+        for i, (increments, label) in enumerate(((increments1, "1"), (increments2, "2"))):
+            # Once the whole of an input has been used, keep its MFCCs rather than calculating them again
+            if not complete[i]:
+                audio, complete[i] = next(increments)
+                mfccs[i] = features[i].extend(audio, complete[i], profiler, label)
+                del audio
+        try:
+            results = _find_offset_between_features(
+                *mfccs, fs, hop_length, max_frames, engine, coarse_factor, top_k, profiler=profiler
+            )
+        except InsufficientAudioException:
+            if all(complete):
+                raise
+            continue
+        if all(complete) or _settled(results, previous_offset, min_score, time_scale):
+            return results
+        previous_offset = results["time_offset"]
+
+
+def _settled(results, previous_offset, min_score, time_scale):
+    """Returns whether a step of a progressive search has reached min_score at the same offset (to within a frame) as
+    the previous step"""
+    if results["standard_score"] < min_score or previous_offset is None:
+        return False
+    return abs(results["time_offset"] - previous_offset) <= time_scale * 1.5
+
+
+class _IncrementalFeatures:
+    """Calculates the standardised MFCCs of audio that arrives a block at a time, as _features() would for all of the
+    audio so far, without calculating the spectra of the earlier blocks again.
+
+    Frames are only calculated once all of their audio has arrived, and (until the audio is complete) in multiples of
+    16, as in mfcc_chunked(), so that once the audio is complete the MFCCs are identical to those of _features().  The
+    80dB dynamic range limit is applied relative to the loudest point so far, so the MFCCs of earlier frames are only
+    calculated again when that rises.
+    """
+
+    def __init__(self, fs, hop_length, win_length, nfft, dtype, numcep=26):
+        self.fs = fs
+        self.hop_length = hop_length
+        self.win_length = win_length
+        self.nfft = nfft
+        self.dtype = dtype
+        self.numcep = numcep
+        self.samples = 0
+        # The audio of the frames still to be calculated, starting with the zeros that centre the first frame
+        self._pending = np.zeros(nfft // 2, dtype=dtype)
+        self._spectra = []
+        self._cepstra = []
+        self._max_db = -np.inf
+        self._min_db = None
+
+    def extend(self, audio, complete, profiler, label):
+        """Adds the next block of audio, and returns the standardised MFCCs of all of the audio so far.  If complete is
+        True, this is the last block, and the frames at the end of the audio are calculated too."""
+        nfft, hop_length = self.nfft, self.hop_length
+        with profiler.stage("mfcc_" + label):
+            audio = np.asarray(audio, dtype=self.dtype)
+            self.samples += len(audio)
+            padding = np.zeros(nfft // 2 if complete else 0, dtype=self.dtype)
+            pending = profiler.array(np.concatenate((self._pending, audio, padding)))
+            del audio
+            nframes = max(1 + (len(pending) - nfft) // hop_length, 0)
+            if not complete:
+                nframes -= nframes % 16
+            if nframes:
+                block = pending[: (nframes - 1) * hop_length + nfft]
+                S_db = _power_to_db(_mel_power_spectrogram(block, self.fs, nfft, self.win_length, hop_length))
+                self._spectra.append(S_db)
+                self._cepstra.append(None)
+                self._max_db = max(self._max_db, S_db.max())
+            self._pending = pending[nframes * hop_length :].copy()
+            del pending
+
+            min_db = self._max_db - 80.0
+            dct = _dct_matrix(self.numcep, _mel_filterbank(self.fs, nfft, self.dtype).shape[0], self.dtype)
+            for i, S_db in enumerate(self._spectra):
+                if self._cepstra[i] is None or min_db != self._min_db:
+                    self._cepstra[i] = np.maximum(S_db, min_db) @ dct.T
+            self._min_db = min_db
+            features = np.concatenate(self._cepstra) if self._cepstra else np.empty((0, self.numcep), dtype=self.dtype)
+        with profiler.stage("standardise_" + label):
+            features = profiler.array(std_mfcc(features))
+        profiler.metrics["decoded_samples"][label] = self.samples
+        profiler.metrics["mfcc_frames"][label] = len(features)
+        return features
+
+
+def _buffer_increments(buffer, first_samples):
+    """Yields successive blocks of an audio buffer, such that the first first_samples samples are yielded first and the
+    length of the audio yielded so far doubles each time, as (audio, complete) pairs, where complete is True for the
+    last block"""
+    start, size = 0, first_samples
+    while size < len(buffer):
+        yield buffer[start:size], False
+        start, size = size, size * 2
+    yield buffer[start:], True
+
+
+def _stream_increments(chunks, first_samples, profiler, label):
+    """Like _buffer_increments(), but for audio read as a sequence of chunks (such as from stream_audio()), which are
+    only read as far as is needed for each block"""
+    chunks = iter(chunks)
+    audio, total, size = [], 0, first_samples
+    while True:
+        with profiler.stage("decode_" + label):
+            chunk = next(chunks, None)
+        if chunk is None:
+            break
+        audio.append(chunk)
+        total += len(chunk)
+        if total >= size:
+            yield np.concatenate(audio), False
+            audio = []
+            size *= 2
+    yield np.concatenate(audio) if audio else np.empty(0, dtype=np.int16), True
+
+
+def _find_offset_between_features(
+    mfcc1, mfcc2, fs, hop_length, max_frames, engine, coarse_factor=None, top_k=3, lag_range=None, profiler=None
+):
+    """Find the offset between two arrays of standardised MFCCs.  See find_offset_between_buffers() for details.
+
+    lag_range optionally limits the search to offsets (in frames) from lag_range[0] up to but excluding lag_range[1].
+    """
+    profiler = profiler or _Profiler()
+    if coarse_factor and coarse_factor > 1:
+        return _find_offset_coarse_to_fine(
+            mfcc1, mfcc2, fs, hop_length, max_frames, engine, coarse_factor, top_k, lag_range=lag_range, profiler=profiler
+        )
+    with profiler.stage("correlation"):
+        c, earliest_frame_offset, latest_frame_offset = _search(mfcc1, mfcc2, max_frames, engine, lag_range, profiler)
+        results = _offset_results(c, earliest_frame_offset, latest_frame_offset, hop_length / fs)
+    return results
 
-    # Derive correl_nframes from the length of audio supplied, to avoid buffer overruns
+
+def _search(mfcc1, mfcc2, max_frames, engine, lag_range, profiler):
+    """Calculates the cross-correlation curve for an exhaustive search, over the given range of offsets if there is one"""
+    correl_nframes = _correl_nframes(mfcc1, mfcc2, max_frames)
+    profiler.metrics["correlated_frames"] = correl_nframes
+    if lag_range is None:
+        c, earliest_frame_offset, latest_frame_offset = cross_correlation(mfcc1, mfcc2, nframes=correl_nframes, engine=engine)
+    else:
+        earliest_frame_offset, latest_frame_offset = _clip_lag_range(mfcc1, mfcc2, correl_nframes, lag_range)
+        if engine == "loop":
+            c = cross_correlation(mfcc1, mfcc2, nframes=correl_nframes, engine=engine)[0]
+            c = c[np.arange(earliest_frame_offset, latest_frame_offset)]
+        else:
+            c = _correlation_for_lags(mfcc1, mfcc2, correl_nframes, earliest_frame_offset, latest_frame_offset)
+        # Lay the coefficients out in the same way as cross_correlation() does
+        c = np.roll(c, earliest_frame_offset)
+    profiler.metrics["lags_evaluated"] += len(c)
+    profiler.array(c)
+    return c, earliest_frame_offset, latest_frame_offset
+
+
+def _clip_lag_range(mfcc1, mfcc2, nframes, lag_range):
+    """Limits a range of offsets to those that can be searched by cross_correlation(), raising an exception if none can"""
+    start = max(lag_range[0], nframes - len(mfcc2))
+    stop = min(lag_range[1], len(mfcc1) - nframes + 1)
+    if start >= stop:
+        raise InsufficientAudioException("Not enough audio to analyse around the expected offset.")
+    return start, stop
+
+
+def _find_offset_coarse_to_fine(
+    mfcc1, mfcc2, fs, hop_length, max_frames, engine, coarse_factor, top_k, refine_window=2, lag_range=None, profiler=None
+):
+    """Search for the offset between two arrays of standardised MFCCs at a coarse resolution, then refine the best
+    candidates at full resolution.  refine_window is the number of coarse frames either side of each candidate to search.
+    """
+    coarse_lag_range = None
+    if lag_range is not None:
+        coarse_lag_range = (lag_range[0] // coarse_factor, -(-lag_range[1] // coarse_factor))
+    # Taking every coarse_factor'th frame gives the same MFCCs as using a hop length coarse_factor times longer
+    results = _find_offset_between_features(
+        mfcc1[::coarse_factor],
+        mfcc2[::coarse_factor],
+        fs,
+        hop_length * coarse_factor,
+        max_frames // coarse_factor,
+        engine,
+        lag_range=coarse_lag_range,
+        profiler=profiler,
+    )
+    c = results["correlation"].copy()
+    earliest_frame_offset, latest_frame_offset = results["earliest_frame_offset"], results["latest_frame_offset"]
+
+    correl_nframes = _correl_nframes(mfcc1, mfcc2, max_frames)
+    o_min, o_max = _clip_lag_range(mfcc1, mfcc2, correl_nframes, lag_range or (-len(mfcc2), len(mfcc1)))
+    time_scale = hop_length / fs
+    candidates = []
+    for _ in range(min(top_k, len(c))):
+        # Pick the highest remaining coarse peak, then suppress its neighbourhood so that the next pick is a distinct peak
+        index = int(np.argmax(c))
+        if c[index] == -np.inf:
+            break
+        coarse_offset = _frame_offset(index, earliest_frame_offset, len(c))
+        for neighbour in range(coarse_offset - refine_window, coarse_offset + refine_window + 1):
+            if earliest_frame_offset <= neighbour < latest_frame_offset:
+                c[neighbour % len(c)] = -np.inf
+
+        start = max(o_min, (coarse_offset - refine_window) * coarse_factor)
+        stop = min(o_max, (coarse_offset + refine_window) * coarse_factor + 1)
+        if start >= stop:
+            continue
+        with profiler.stage("correlation"):
+            fine_c = _correlation_for_lags(mfcc1, mfcc2, correl_nframes, start, stop)
+        profiler.metrics["lags_evaluated"] += len(fine_c)
+        fine_index = int(np.argmax(fine_c))
+        candidate = {
+            "coarse_time_offset": coarse_offset * results["time_scale"],
+            "time_offset": (start + fine_index) * time_scale,
+            "peak": float(fine_c[fine_index]),
+        }
+        if not candidates or candidate["peak"] > max(other["peak"] for other in candidates):
+            results["frame_offset"] = coarse_offset
+            results["time_offset"] = candidate["time_offset"]
+        candidates.append(candidate)
+
+    profiler.metrics["correlated_frames"] = correl_nframes
+    results["refined_candidates"] = candidates
+    return results
+
+
+def _correl_nframes(mfcc1, mfcc2, max_frames):
+    """Returns the number of frames to cross-correlate, derived from the length of audio supplied to avoid buffer overruns"""
     correl_nframes = min(int(len(mfcc1) / 3), len(mfcc2), max_frames)
     if correl_nframes < 10:
         raise InsufficientAudioException(
             "Not enough audio to analyse - try longer clips, less trimming, or higher resolution."
         )
+    return correl_nframes
+
+
+def _frame_offset(index, earliest_frame_offset, n):
+    """Converts an index into a cross-correlation array of length n into the frame offset that it represents"""
+    return earliest_frame_offset + (index - earliest_frame_offset) % n
 
-    c, earliest_frame_offset, latest_frame_offset = cross_correlation(mfcc1, mfcc2, nframes=correl_nframes)
 
+def _offset_results(c, earliest_frame_offset, latest_frame_offset, time_scale):
+    """Builds the results dict returned by find_offset_between_buffers() from a cross-correlation curve"""
     # Find the largest value in the array of cross-correlation results (the most likely offset between the buffers)
     # and then convert it into a time offset (see also the documentation for the cross_correlation() function)
     max_k_index = np.argmax(c)
-    max_k_frame_offset = max_k_index
-    if max_k_frame_offset > latest_frame_offset:
-        max_k_frame_offset -= len(c)
-    time_scale = hop_length / fs
+    max_k_frame_offset = _frame_offset(max_k_index, earliest_frame_offset, len(c))
     time_offset = (max_k_frame_offset) * time_scale
 
-    if np.std(c) < 1e-10:
-        score = np.inf
-    else:
-        score = (c[max_k_index] - np.mean(c)) / np.std(c)  # standard score of peak
     return {
         "time_offset": time_offset,
         "frame_offset": int(max_k_frame_offset),
-        "standard_score": score,
+        "standard_score": _standard_score(c, max_k_index),
         "correlation": c,
         "time_scale": time_scale,
         "earliest_frame_offset": int(earliest_frame_offset),
@@ -164,9 +989,442 @@ def find_offset_between_buffers(buffer1, buffer2, fs, hop_length=128, win_length
     }
 
 
+def _standard_score(c, index):
+    """Returns the standard score of the coefficient at the given index of a cross-correlation curve"""
+    # Accumulate the statistics in double precision, whatever the type of the coefficients
+    mean, std = np.mean(c, dtype=np.float64), np.std(c, dtype=np.float64)
+    if std < 1e-10:
+        return np.inf
+    return float((c[index] - mean) / std)
+
+
+def _search_lag_range(expected_offset, max_offset, time_scale):
+    """Converts an expected offset and maximum deviation from it (in seconds) into a range of frame offsets to search"""
+    if max_offset is None:
+        if expected_offset is not None:
+            raise ValueError("An expected offset can only be used with a maximum offset")
+        return None
+    expected_offset = expected_offset or 0
+    return (
+        int(np.floor((expected_offset - max_offset) / time_scale)),
+        int(np.ceil((expected_offset + max_offset) / time_scale)) + 1,
+    )
+
+
+def find_offsets_in_reference(
+    reference,
+    clips,
+    fs=8000,
+    trim=None,
+    hop_length=128,
+    win_length=256,
+    nfft=512,
+    max_frames=2000,
+    engine="fft",
+    decoder="pipe",
+    cache=None,
+    max_workers=None,
+    return_exceptions=False,
+    dtype=np.float32,
+):
+    """Find the offsets of several clips within a single reference file.
+
+    This is equivalent to calling find_offset_between_files(reference, clip) for each clip, but the reference file is
+    only decoded once and its MFCCs are only calculated once.  The clips are decoded concurrently, and (with the "fft"
+    engine) clips that are correlated over the same number of frames are correlated against the reference together.
+
+    Parameters
+    ----------
+    reference: string
+        A path to the reference file, in any format that FFMPEG can read
+    clips: list of strings
+        Paths to the files to find within the reference file, in any format that FFMPEG can read
+    max_workers: int
+        The maximum number of files to decode at once.  The default is chosen by concurrent.futures.ThreadPoolExecutor.
+    return_exceptions: bool
+        If False (the default) the first error encountered while processing a clip is raised.  If True, the exception
+        is returned in place of that clip's results instead, and the remaining clips are still processed.
+
+    The remaining parameters are as described for find_offset_between_files().
+
+    Returns
+    -------
+    A list with an entry for each clip, in the same order as the clips parameter.  Each entry is a dict of results, as
+    described for find_offset_between_files(), or (if return_exceptions is True) an exception.
+
+    Throws
+    ------
+    InsufficientAudioException if the audio supplied is too short to analyse.
+    """
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        feature_args = (fs, trim, hop_length, win_length, nfft, decoder, cache, None, None, "1", dtype)
+        reference_future = executor.submit(_file_features, reference, *feature_args)
+        clip_futures = [executor.submit(_file_features, clip, *feature_args) for clip in clips]
+        mfcc1 = reference_future.result()
+
+        results = [None] * len(clips)
+        clip_mfccs = {}  # Indexed by number of frames to correlate, then by clip index
+        for i, future in enumerate(clip_futures):
+            try:
+                mfcc2 = future.result()
+                clip_mfccs.setdefault(_correl_nframes(mfcc1, mfcc2, max_frames), {})[i] = mfcc2
+            except Exception as e:
+                if not return_exceptions:
+                    raise
+                results[i] = e
+
+    time_scale = hop_length / fs
+    for nframes, mfccs in clip_mfccs.items():
+        if engine == "fft":
+            for i, clip_results in zip(mfccs, _batched_offset_results(mfcc1, list(mfccs.values()), nframes, time_scale)):
+                results[i] = clip_results
+        else:
+            for i, mfcc2 in mfccs.items():
+                results[i] = _offset_results(*cross_correlation(mfcc1, mfcc2, nframes, engine=engine), time_scale)
+    return results
+
+
+def _batched_offset_results(mfcc1, mfcc2s, nframes, time_scale):
+    """Finds the offset of each of a list of arrays of standardised MFCCs within mfcc1, correlating nframes frames"""
+    # Offsets of each array within mfcc1 share the spectrum of mfcc1, so calculate them as a batch
+    templates = np.stack([mfcc2[:nframes] for mfcc2 in mfcc2s])
+    results = []
+    for mfcc2, positive in zip(mfcc2s, _batched_lagged_dot_products(mfcc1, templates)):
+        c = _correlation_from_products(positive, _lagged_dot_products(mfcc2, mfcc1[:nframes]))
+        results.append(_offset_results(c, nframes - len(mfcc2), len(mfcc1) - nframes + 1, time_scale))
+    return results
+
+
+def find_track_offsets(
+    file1,
+    file2,
+    streams=(0,),
+    channels=False,
+    fs=8000,
+    trim=None,
+    hop_length=128,
+    win_length=256,
+    nfft=512,
+    max_frames=2000,
+    decoder="pipe",
+    cache=None,
+    dtype=np.float32,
+):
+    """Find the offset of each of several audio tracks of one media file within another file.
+
+    This is equivalent to calling find_offset_between_files(file1, track) for each track of file2, but all the tracks
+    are decoded together by a single FFmpeg process (see decode_tracks()), their MFCCs are calculated together, and
+    they are correlated against file1 as a batch that shares the spectrum of file1.
+
+    Parameters
+    ----------
+    file1: string
+        A path to the reference file, in any format that FFMPEG can read.  It is downmixed to mono.
+    file2: string
+        A path to the media file containing the tracks, in any format that FFMPEG can read
+    streams: list of ints
+        The indices of the audio streams of file2 to use, counting only audio streams (so 0 is the first audio stream)
+    channels: bool
+        If False (the default), each stream is downmixed to mono and treated as one track.  If True, every channel of
+        each stream is treated as a separate track.
+
+    The remaining parameters are as described for find_offset_between_files().  The cache is only used for file1.
+
+    Returns
+    -------
+    A list with an entry for each track, in the order returned by decode_tracks().  Each entry is a dict of results, as
+    described for find_offset_between_files(), which also contains the "stream" index of the track, or if channels is
+    True, the "channel" index of the track counting across the channels of all the streams given.
+
+    Throws
+    ------
+    InsufficientAudioException if the audio supplied is too short to analyse.
+    """
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        # Decode the reference while the tracks are decoded
+        reference_future = executor.submit(
+            _file_features, file1, fs, trim, hop_length, win_length, nfft, decoder, cache, None, None, "1", dtype
+        )
+        tracks = decode_tracks(file2, fs, trim, streams, channels).astype(dtype)
+        mfcc1 = reference_future.result()
+    mfcc2s = [std_mfcc(features) for features in mfcc(tracks, win_length, nfft, fs, hop_length, numcep=26)]
+    del tracks
+
+    results = _batched_offset_results(mfcc1, mfcc2s, _correl_nframes(mfcc1, mfcc2s[0], max_frames), hop_length / fs)
+    for track, track_results in enumerate(results):
+        if channels:
+            track_results["channel"] = track
+        else:
+            track_results["stream"] = streams[track]
+    return results
+
+
+def align_set(
+    files,
+    fs=8000,
+    trim=None,
+    hop_length=128,
+    win_length=256,
+    nfft=512,
+    max_frames=2000,
+    decoder="pipe",
+    cache=None,
+    max_workers=None,
+    min_score=10,
+    dtype=np.float32,
+):
+    """Find a consistent timeline for a set of recordings of the same event, such as from several cameras or recorders.
+
+    Each file is decoded and its MFCCs are calculated only once.  The offset between every pair of files is then found
+    (with the longer file of each pair as the reference, and the pairs that share a reference correlated against it as
+    a batch), and the start time of each file is found from the pairwise offsets by weighted least squares, weighting
+    each pair by its standard score.  Pairs whose standard score is below min_score are assumed not to overlap, and
+    are left out.
+
+    Parameters
+    ----------
+    files: list of strings
+        Paths to the files, in any format that FFMPEG can read
+    max_workers: int
+        The maximum number of files to decode at once.  The default is chosen by concurrent.futures.ThreadPoolExecutor.
+    min_score: float
+        The lowest standard score for which a pairwise offset is used
+
+    The remaining parameters are as described for find_offset_between_files().
+
+    Returns
+    -------
+    A dict, suitable for converting to JSON, containing the following:
+    files (list): a dict for each file, in the same order as the files parameter, containing:
+        file (string): the path of the file
+        start (float): the time at which the file starts on the timeline, in seconds.  The earliest file of each group
+                       starts at 0.
+        group (int): the number of the group that the file belongs to.  Files are only aligned with the others in
+                     their group, as no pairs of files in different groups were found to overlap.  Groups are numbered
+                     from 0 in order of their first file.
+    pairs (list): a dict for each pair of files, containing:
+        file1, file2 (string): the paths of the files
+        time_offset (float): the offset of file2 compared to file1 that was found, in seconds
+        standard_score (float): the standard score of the highest correlation coefficient for the pair
+        residual (float): the difference between the offset of the pair on the timeline and time_offset, in seconds, or
+                          None if the pair was left out
+
+    Throws
+    ------
+    InsufficientAudioException if the audio supplied is too short to analyse.
+    """
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        feature_args = (fs, trim, hop_length, win_length, nfft, decoder, cache, None, None, "1", dtype)
+        mfccs = list(executor.map(lambda afile: _file_features(afile, *feature_args), files))
+
+    time_scale = hop_length / fs
+    pair_mfccs = {}  # Indexed by the reference file and the number of frames to correlate, then by the other file
+    for i, j in combinations(range(len(files)), 2):
+        reference, other = (i, j) if len(mfccs[i]) >= len(mfccs[j]) else (j, i)
+        nframes = _correl_nframes(mfccs[reference], mfccs[other], max_frames)
+        pair_mfccs.setdefault((reference, nframes), {})[other] = mfccs[other]
+    pairs = {}
+    for (reference, nframes), others in pair_mfccs.items():
+        for other, results in zip(
+            others, _batched_offset_results(mfccs[reference], list(others.values()), nframes, time_scale)
+        ):
+            # Record the offset of the later file of the pair compared to the earlier one
+            sign = 1 if reference < other else -1
+            pairs[min(reference, other), max(reference, other)] = (sign * results["time_offset"], results["standard_score"])
+
+    starts, groups = _solve_timeline(len(files), pairs, min_score)
+    return {
+        "files": [{"file": afile, "start": start, "group": group} for afile, start, group in zip(files, starts, groups)],
+        "pairs": [
+            {
+                "file1": files[i],
+                "file2": files[j],
+                "time_offset": float(offset),
+                "standard_score": score,
+                "residual": float(starts[j] - starts[i] - offset) if score >= min_score else None,
+            }
+            for (i, j), (offset, score) in sorted(pairs.items())
+        ],
+    }
+
+
+def _solve_timeline(nfiles, pairs, min_score):
+    """Finds the start times of a set of files from the offsets between pairs of them, as described for align_set().
+
+    pairs maps (i, j) to (the offset of file j compared to file i, standard score).  Returns the start times and the
+    group numbers of the files.
+    """
+    # Group the files that are connected by pairs that are good enough to use
+    groups = list(range(nfiles))
+
+    def group_of(i):
+        while groups[i] != i:
+            i = groups[i]
+        return i
+
+    for (i, j), (offset, score) in pairs.items():
+        if score >= min_score:
+            groups[max(group_of(i), group_of(j))] = min(group_of(i), group_of(j))
+    groups = [group_of(i) for i in range(nfiles)]
+
+    starts = np.zeros(nfiles)
+    for group in sorted(set(groups)):
+        members = [i for i in range(nfiles) if groups[i] == group]
+        if len(members) == 1:
+            continue
+        # Solve for the starts of the members other than the first (which starts at 0), minimising the sum of the
+        # squared differences between the pairwise offsets and those implied by the starts, weighted by score
+        column = {member: index - 1 for index, member in enumerate(members)}
+        rows, values = [], []
+        for (i, j), (offset, score) in pairs.items():
+            if score >= min_score and groups[i] == group:
+                weight = np.sqrt(min(score, 1e6))
+                row = np.zeros(len(members) - 1)
+                if column[j] >= 0:
+                    row[column[j]] += weight
+                if column[i] >= 0:
+                    row[column[i]] -= weight
+                rows.append(row)
+                values.append(weight * offset)
+        starts[members[1:]] = np.linalg.lstsq(np.array(rows), np.array(values), rcond=None)[0]
+        starts[members] -= starts[members].min()
+    return [float(start) for start in starts], [sorted(set(groups)).index(group) for group in groups]
+
+
+def find_offset_timeline(
+    file1,
+    file2,
+    window=30,
+    stride=10,
+    fs=8000,
+    trim=None,
+    hop_length=128,
+    win_length=256,
+    nfft=512,
+    decoder="pipe",
+    cache=None,
+    expected_offset=None,
+    max_offset=None,
+    dtype=np.float32,
+    min_score=10,
+):
+    """Find how the offset between two audio files changes over time, e.g. because of clock drift between recorders.
+
+    The MFCCs of each file are only calculated once.  Windows of file2 of the given length, starting every stride
+    seconds, are then each correlated against the whole of file1 (sharing the spectrum of file1 between them), and a
+    straight line is fitted to the offsets found to give the rate of drift.
+
+    Parameters
+    ----------
+    file1: string
+        A path to the reference file, in any format that FFMPEG can read
+    file2: string
+        A path to the comparison file, in any format that FFMPEG can read
+    window: float
+        The length of each window of file2, in seconds
+    stride: float
+        The time between the starts of successive windows, in seconds
+    expected_offset: float
+        The expected offset between the files, in seconds (default 0).  Only used with max_offset.
+    max_offset: float
+        If set, the offset of each window is only searched for within this many seconds of expected_offset
+    min_score: float
+        The lowest standard score for which a window is considered to match file1.  Windows with lower scores (e.g.
+        because that part of file2 isn't in file1 at all) are still reported, but their offsets are left out of the
+        fitted line.
+
+    The remaining parameters are as described for find_offset_between_files().
+
+    Returns
+    -------
+    A dict containing the following:
+    windows (list): a dict for each window, in order, containing:
+        position (float): the time of the centre of the window within file2, in seconds
+        time_offset (float): the most likely offset of file2 compared to file1 during the window, in seconds
+        standard_score (float): the standard score of the highest correlation coefficient for the window
+    drift (float): the rate at which the offset changes, in seconds per second of file2, from a straight line fitted to
+                   the offsets of the matching windows weighted by their standard scores.  None if there are fewer than
+                   two matching windows.
+    intercept (float): the offset at the start of file2 according to the fitted line, in seconds (or None)
+    time_scale (float): the number of seconds represented by each MFCC frame
+
+    Throws
+    ------
+    InsufficientAudioException if either file is too short to contain a window.
+    """
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        futures = [
+            executor.submit(
+                _file_features, afile, fs, trim, hop_length, win_length, nfft, decoder, cache, None, None, label, dtype
+            )
+            for afile, label in ((file1, "1"), (file2, "2"))
+        ]
+        mfcc1, mfcc2 = [future.result() for future in futures]
+    time_scale = hop_length / fs
+    lag_range = _search_lag_range(expected_offset, max_offset, time_scale)
+    return _timeline_between_features(
+        mfcc1,
+        mfcc2,
+        int(round(window / time_scale)),
+        max(1, int(round(stride / time_scale))),
+        time_scale,
+        lag_range,
+        min_score,
+    )
+
+
+def _timeline_between_features(mfcc1, mfcc2, window_frames, stride_frames, time_scale, lag_range=None, min_score=10):
+    """Correlates sliding windows of mfcc2 against mfcc1.  See find_offset_timeline() for details."""
+    if window_frames < 10 or window_frames > len(mfcc1) or window_frames > len(mfcc2):
+        raise InsufficientAudioException("Not enough audio to analyse - try longer files or a shorter window.")
+    starts = range(0, len(mfcc2) - window_frames + 1, stride_frames)
+    windows = []
+    # c[j] is the coefficient for the start of the window being aligned with frame first + j of mfcc1
+    for start, first, c in _window_correlations(mfcc1, mfcc2, starts, window_frames, lag_range):
+        index = int(np.argmax(c))
+        windows.append(
+            {
+                "position": (start + window_frames / 2) * time_scale,
+                "time_offset": (first + index - start) * time_scale,
+                "standard_score": _standard_score(c, index),
+            }
+        )
+
+    drift = intercept = None
+    # Windows that don't match anything have arbitrary offsets, which would skew the fit however little they're weighted
+    matches = [w for w in windows if w["standard_score"] >= min_score]
+    if len(matches) >= 2:
+        positions = np.array([w["position"] for w in matches])
+        offsets = np.array([w["time_offset"] for w in matches])
+        # polyfit weights the residuals before squaring them, so weight by the square root of the (finite) scores
+        scores = np.nan_to_num(np.array([w["standard_score"] for w in matches]), posinf=1e6)
+        drift, intercept = (float(x) for x in np.polyfit(positions, offsets, 1, w=np.sqrt(np.maximum(scores, 0) + 1e-6)))
+    return {"windows": windows, "drift": drift, "intercept": intercept, "time_scale": time_scale}
+
+
+def _window_correlations(mfcc1, mfcc2, starts, window_frames, lag_range):
+    """Yields the start of each window of mfcc2, the first frame of mfcc1 it is correlated from, and the coefficients.
+
+    With a lag range, windows that can't be aligned with mfcc1 at any offset within it are left out.
+    """
+    if lag_range is None:
+        # Each window is a template whose lagged dot products with the whole of mfcc1 are calculated in batches.  The
+        # templates are a view of mfcc2, so only the windows in the current batch are copied.
+        templates = np.lib.stride_tricks.sliding_window_view(mfcc2, window_frames, axis=0)[:: starts.step].transpose(0, 2, 1)
+        for start, products in zip(starts, _batched_lagged_dot_products(mfcc1, templates)):
+            yield start, 0, np.linalg.norm(products, axis=1)
+        return
+    # Only the frames of mfcc1 that each window can be aligned with within the lag range are correlated against it
+    for start in starts:
+        first = max(0, start + lag_range[0])
+        stop = min(len(mfcc1) - window_frames + 1, start + lag_range[1])
+        if stop > first:
+            yield start, first, _correlation_for_lags(mfcc1, mfcc2[start:], window_frames, first, stop)
+
+
 # returns an array in which the first half represents an offset of mfcc2 within mfcc1,
 # and the second half (accessed by negative indices) vice-versa.
-def cross_correlation(mfcc1, mfcc2, nframes):
+def cross_correlation(mfcc1, mfcc2, nframes, engine="fft"):
     """Calculate the cross-correlation curve between two numpy arrays (assumed to be MFCCs).
 
     Parameters
@@ -177,6 +1435,10 @@ def cross_correlation(mfcc1, mfcc2, nframes):
         The second array to correlate
     nframes: int
         The number of frames to correlate between the two arrays
+    engine: string
+        "fft" (the default) computes the lagged dot products for every offset at once using FFT-based (overlap-add)
+        convolution.  "loop" computes them one offset at a time, which is much slower on long inputs but is kept as a
+        reference implementation.  Both engines return the same results to within floating-point tolerance.
 
     Returns
     -------
@@ -194,22 +1456,119 @@ def cross_correlation(mfcc1, mfcc2, nframes):
     o_min = nframes - n2
     o_max = n1 - nframes + 1
     n = o_max - o_min
-    c = np.zeros(n)
-    for k in range(o_min, 0):
-        cc = np.sum(np.multiply(mfcc1[:nframes], mfcc2[-k : nframes - k]), axis=0)
-        c[k] = np.linalg.norm(cc)
-    for k in range(0, o_max):
-        cc = np.sum(np.multiply(mfcc1[k : k + nframes], mfcc2[:nframes]), axis=0)
-        c[k] = np.linalg.norm(cc)
+    if engine == "fft":
+        c = _correlation_from_products(
+            _lagged_dot_products(mfcc1, mfcc2[:nframes]), _lagged_dot_products(mfcc2, mfcc1[:nframes])
+        )
+    elif engine == "loop":
+        c = np.zeros(n)
+        for k in range(o_min, 0):
+            cc = np.sum(np.multiply(mfcc1[:nframes], mfcc2[-k : nframes - k]), axis=0)
+            c[k] = np.linalg.norm(cc)
+        for k in range(0, o_max):
+            cc = np.sum(np.multiply(mfcc1[k : k + nframes], mfcc2[:nframes]), axis=0)
+            c[k] = np.linalg.norm(cc)
+    else:
+        raise ValueError("Unknown cross-correlation engine: %s" % engine)
     return c, o_min, o_max
 
 
+def _lagged_dot_products(signal, template):
+    """Returns the per-coefficient dot products of template with signal[k : k + len(template)], for every valid k.
+
+    The result has one row per lag (len(signal) - len(template) + 1 of them) and one column per coefficient.
+    """
+    from scipy.signal import oaconvolve
+
+    # Correlation is convolution with a time-reversed template
+    return oaconvolve(signal, template[::-1], mode="valid", axes=0)
+
+
+def _correlation_for_lags(mfcc1, mfcc2, nframes, start, stop):
+    """Calculates cross-correlation coefficients as cross_correlation() does, but only for offsets start to stop - 1.
+
+    The offsets must lie within the range o_min to o_max described for cross_correlation().  Unlike cross_correlation(),
+    the coefficients are returned in order of offset, so the first element is the coefficient for the offset start.
+    """
+    c = np.empty(stop - start, dtype=np.result_type(mfcc1, mfcc2))
+    if start < 0:
+        # Offsets start..min(stop, 0)-1 slide the start of mfcc1 along mfcc2, as for the negative half of cross_correlation()
+        negative_stop = min(stop, 0)
+        products = _lagged_dot_products(mfcc2[1 - negative_stop : nframes - start], mfcc1[:nframes])
+        c[: negative_stop - start] = np.linalg.norm(products[::-1], axis=1)
+    if stop > 0:
+        positive_start = max(start, 0)
+        products = _lagged_dot_products(mfcc1[positive_start : stop - 1 + nframes], mfcc2[:nframes])
+        c[positive_start - start :] = np.linalg.norm(products, axis=1)
+    return c
+
+
+def _batched_lagged_dot_products(signal, templates, max_batch_bytes=256 * 1024 * 1024, signal_spectrum=None):
+    """Equivalent to calling _lagged_dot_products(signal, template) for each of a stack of equal-length templates.
+
+    The spectrum of the signal is only calculated once (or not at all, if signal_spectrum is supplied from an earlier
+    call to _signal_spectrum()).  Templates are processed in batches limited by the size of the spectra involved, and
+    the results are yielded one template at a time.
+    """
+    from scipy import fft
+
+    n, m = len(signal), templates.shape[1]
+    size, spectrum = signal_spectrum or _signal_spectrum(signal, m)
+    batch_size = max(1, max_batch_bytes // spectrum.nbytes)
+    for start in range(0, len(templates), batch_size):
+        spectra = fft.rfft(templates[start : start + batch_size, ::-1], size, axis=1)
+        spectra *= spectrum
+        # Keep only the lags at which the template lies entirely within the signal (as for mode="valid")
+        yield from fft.irfft(spectra, size, axis=1)[:, m - 1 : n]
+
+
+def _signal_spectrum(signal, max_template_length):
+    """Returns the FFT size and the spectrum of a signal, for use by _batched_lagged_dot_products() with templates of up
+    to max_template_length frames"""
+    from scipy import fft
+
+    size = fft.next_fast_len(len(signal) + max_template_length - 1, real=True)
+    return size, fft.rfft(signal, size, axis=0)
+
+
+def _correlation_from_products(positive, negative):
+    """Assembles a cross-correlation curve (laid out as described for cross_correlation()) from lagged dot products.
+
+    positive holds the products for offsets of mfcc2 within mfcc1, from zero upwards, and negative holds those for
+    offsets of mfcc1 within mfcc2, also from zero upwards (the zero offset is taken from positive).
+    """
+    return np.concatenate((np.linalg.norm(positive, axis=1), np.linalg.norm(negative[:0:-1], axis=1)))
+
+
 def std_mfcc(array):
     """Returns the standard score for each offset of a given numpy array"""
-    return (array - np.mean(array, axis=0)) / np.std(array, axis=0)
+    # Divide in place, so that only one array the size of the input is allocated
+    standardised = array - np.mean(array, axis=0)
+    standardised /= np.std(array, axis=0)
+    return standardised
 
 
-def convert_and_trim(afile, fs, trim=None):
+def _ffmpeg_command(afile, fs, trim=None, offset=None, filter_graph=None):
+    """Returns the start of an FFmpeg command line that reads afile, downmixes it to mono, resamples and trims it.  If a
+    filter graph is given, its "[out]" output is used instead of the downmixed default audio stream."""
+    ffmpeg_command = ["ffmpeg"]
+    ffmpeg_command += ["-loglevel", "error"]
+    if offset:
+        # Seeking the input (rather than discarding output) avoids decoding the audio before the offset
+        ffmpeg_command += ["-ss", str(offset)]
+    ffmpeg_command += ["-i", afile]
+    if filter_graph:
+        ffmpeg_command += ["-filter_complex", filter_graph, "-map", "[out]"]
+    else:
+        ffmpeg_command += ["-ac", "1"]
+    ffmpeg_command += ["-ar", str(fs)]
+    ffmpeg_command += ["-ss", "0"]
+    if trim:
+        ffmpeg_command += ["-t", str(trim)]
+    return ffmpeg_command
+
+
+def convert_and_trim(afile, fs, trim=None, offset=None):
     """Converts the input media to a temporary 16-bit WAV file and trims it to length.
 
     Parameters
@@ -221,6 +1580,8 @@ def convert_and_trim(afile, fs, trim=None):
     trim: float
         The length to which the output audio should be trimmed, in seconds.  (Audio beyond this point will be discarded.)
         A value of "None" implies no trimming.
+    offset: float
+        The position in the input media at which to start converting, in seconds.  A value of "None" implies the start.
 
     Returns
     -------
@@ -230,14 +1591,7 @@ def convert_and_trim(afile, fs, trim=None):
     tmp_name = tmp.name
     tmp.close()
 
-    ffmpeg_command = ["ffmpeg"]
-    ffmpeg_command += ["-loglevel", "error"]
-    ffmpeg_command += ["-i", afile]
-    ffmpeg_command += ["-ac", "1"]
-    ffmpeg_command += ["-ar", str(fs)]
-    ffmpeg_command += ["-ss", "0"]
-    if trim:
-        ffmpeg_command += ["-t", str(trim)]
+    ffmpeg_command = _ffmpeg_command(afile, fs, trim, offset)
     ffmpeg_command += ["-acodec", "pcm_s16le"]
     ffmpeg_command += [tmp_name]
 
@@ -247,3 +1601,210 @@ def convert_and_trim(afile, fs, trim=None):
     if psox.returncode != 0:
         raise Exception("FFMpeg failed:\n" + stderr.strip())
     return tmp_name
+
+
+# Raw PCM formats that decode_audio() can ask FFmpeg for, and the numpy types they map to
+PCM_FORMATS = {"s16le": np.int16, "f32le": np.float32}
+
+
+def decode_audio(afile, fs, trim=None, sample_format="s16le", offset=None):
+    """Decodes the input media to mono PCM samples, read directly from FFmpeg's output without using a temporary file.
+
+    Parameters
+    ----------
+    afile: string
+        The input media file to process.  It must contain at least one audio track.
+    fs: int
+        The sample rate that the audio should be converted to during decoding
+    trim: float
+        The length to which the output audio should be trimmed, in seconds.  (Audio beyond this point will be discarded.)
+        A value of "None" implies no trimming.
+    sample_format: string
+        The raw sample format that FFmpeg should produce - "s16le" (the default) for 16-bit integers, or "f32le" for
+        32-bit floats in the range -1 to 1
+    offset: float
+        The position in the input media at which to start decoding, in seconds.  A value of "None" implies the start.
+
+    Returns
+    -------
+    A 1D numpy array containing the decoded samples, of type int16 or float32 depending on sample_format.
+    """
+    if sample_format not in PCM_FORMATS:
+        raise ValueError("Unknown sample format: %s" % sample_format)
+    ffmpeg_command = _ffmpeg_command(afile, fs, trim, offset)
+    ffmpeg_command += ["-f", sample_format, "-acodec", "pcm_" + sample_format, "-"]
+
+    expected_samples = int(np.ceil(fs * trim)) + 1 if trim else 60 * fs
+    return _ffmpeg_output(
+        ffmpeg_command, lambda stdout: _read_samples(stdout, np.dtype(PCM_FORMATS[sample_format]), expected_samples)
+    )
+
+
+def decode_tracks(afile, fs, trim=None, streams=(0,), channels=False, sample_format="s16le", offset=None):
+    """Decodes several audio streams of the input media, or all of their channels, as separate tracks in a single pass.
+
+    This is much quicker than calling decode_audio() once per track for media with several audio streams, such as
+    masters with separate stems or language tracks, as the media is only read and demultiplexed once.
+
+    Parameters
+    ----------
+    afile: string
+        The input media file to process
+    fs: int
+        The sample rate that the audio should be converted to during decoding
+    trim: float
+        The length to which the output audio should be trimmed, in seconds.  (Audio beyond this point will be discarded.)
+        A value of "None" implies no trimming.
+    streams: list of ints
+        The indices of the audio streams to decode, counting only audio streams (so 0 is the first audio stream)
+    channels: bool
+        If False (the default), each stream is downmixed to mono to give one track per stream.  If True, every channel
+        of each stream is a separate track.  In this case, all the streams must have the same sample rate.
+    sample_format, offset:
+        As described for decode_audio()
+
+    Returns
+    -------
+    A 2D numpy array with a row of samples for each track, of type int16 or float32 depending on sample_format.  The
+    tracks are in the order of the streams given (and of the channels within each stream).  If the streams are of
+    different lengths, they are all truncated to the length of the shortest.
+    """
+    if sample_format not in PCM_FORMATS:
+        raise ValueError("Unknown sample format: %s" % sample_format)
+    if not streams:
+        raise ValueError("At least one audio stream must be selected")
+    # Merge the channels of the streams into a single stream, downmixing each stream to mono first if necessary
+    if channels:
+        inputs = "".join("[0:a:%d]" % stream for stream in streams)
+    else:
+        filter_graph = ";".join(
+            "[0:a:%d]aresample=%d,aformat=channel_layouts=mono[a%d]" % (stream, fs, i) for i, stream in enumerate(streams)
+        )
+        inputs = filter_graph + ";" + "".join("[a%d]" % i for i in range(len(streams)))
+    filter_graph = inputs + ("amerge=inputs=%d[out]" % len(streams) if len(streams) > 1 else "anull[out]")
+    ffmpeg_command = _ffmpeg_command(afile, fs, trim, offset, filter_graph)
+    # The number of channels isn't known in advance, so ask for a WAV file, whose header gives it
+    ffmpeg_command += ["-f", "wav", "-bitexact", "-acodec", "pcm_" + sample_format, "-"]
+    dtype = np.dtype(PCM_FORMATS[sample_format])
+
+    def read(stdout):
+        nchannels = _read_wav_header(stdout)
+        expected_samples = int(np.ceil(fs * trim)) + 1 if trim else 60 * fs
+        return nchannels, _read_samples(stdout, dtype, expected_samples * nchannels)
+
+    nchannels, samples = _ffmpeg_output(ffmpeg_command, read)
+    return np.ascontiguousarray(samples[: len(samples) - len(samples) % nchannels].reshape(-1, nchannels).T)
+
+
+def _ffmpeg_output(ffmpeg_command, read):
+    """Runs FFmpeg, returning the result of calling read() with its output stream, or raising an exception if it fails"""
+    process = Popen(ffmpeg_command, stdout=PIPE, stderr=PIPE)
+    # Drain stderr in the background, so that FFmpeg can't block on it while we are reading its output
+    stderr = []
+    stderr_reader = threading.Thread(target=lambda: stderr.append(process.stderr.read()))
+    stderr_reader.start()
+    try:
+        output = read(process.stdout)
+    except EOFError:
+        output = None  # FFmpeg failed before writing anything
+    finally:
+        process.stdout.close()
+        process.wait()
+        stderr_reader.join()
+        process.stderr.close()
+    if process.returncode != 0:
+        raise Exception("FFMpeg failed:\n" + stderr[0].decode("utf-8", errors="replace").strip())
+    if output is None:
+        raise Exception("FFMpeg produced no output")
+    return output
+
+
+def _read_wav_header(stream):
+    """Reads the header of a WAV file from a binary stream, up to the start of its audio data, returning its number of
+    channels.  (The sizes in the header are ignored, as they are not filled in when FFmpeg writes to a pipe.)"""
+    header = stream.read(12)
+    if len(header) < 12 or header[:4] != b"RIFF" or header[8:] != b"WAVE":
+        raise EOFError("No WAV header")
+    nchannels = None
+    while True:
+        chunk_header = stream.read(8)
+        if len(chunk_header) < 8:
+            raise EOFError("No WAV data")
+        chunk_id, size = chunk_header[:4], int.from_bytes(chunk_header[4:], "little")
+        if chunk_id == b"data":
+            if nchannels is None:
+                raise EOFError("No WAV format")
+            return nchannels
+        chunk = stream.read(size + size % 2)  # Chunks are padded to an even length
+        if chunk_id == b"fmt ":
+            nchannels = int.from_bytes(chunk[2:4], "little")
+
+
+def _read_samples(stream, dtype, expected_samples):
+    """Reads samples of the given type from a binary stream into a preallocated numpy array, growing it if needed"""
+    samples = np.empty(max(expected_samples, 1), dtype=dtype)
+    nbytes = 0
+    while True:
+        if nbytes == samples.nbytes:
+            samples = np.concatenate((samples, np.empty(len(samples), dtype=dtype)))
+        view = memoryview(samples).cast("B")
+        count = stream.readinto(view[nbytes:])
+        view.release()
+        if not count:
+            break
+        nbytes += count
+    # Shrink the array in place to fit the samples actually read, discarding any incomplete trailing sample
+    samples.resize(nbytes // dtype.itemsize, refcheck=False)
+    return samples
+
+
+def stream_audio(afile, fs, chunk_samples, trim=None, sample_format="s16le", offset=None):
+    """Decodes the input media incrementally, yielding chunks of mono PCM samples as FFmpeg produces them.
+
+    This is suitable for sources that are too long to decode in one go, or that never end, such as live streams.
+    Closing the generator before the end of the media stops FFmpeg.
+
+    Parameters
+    ----------
+    afile: string
+        The input media to process, in any form that FFmpeg accepts as an input (including URLs, and "-" for stdin)
+    fs: int
+        The sample rate that the audio should be converted to during decoding
+    chunk_samples: int
+        The number of samples in each chunk.  The last chunk may be shorter.
+    trim, sample_format, offset:
+        As described for decode_audio()
+
+    Returns
+    -------
+    A generator of 1D numpy arrays containing the decoded samples, of type int16 or float32 depending on sample_format.
+    """
+    if sample_format not in PCM_FORMATS:
+        raise ValueError("Unknown sample format: %s" % sample_format)
+    ffmpeg_command = _ffmpeg_command(afile, fs, trim, offset)
+    ffmpeg_command += ["-f", sample_format, "-acodec", "pcm_" + sample_format, "-"]
+    dtype = np.dtype(PCM_FORMATS[sample_format])
+
+    process = Popen(ffmpeg_command, stdout=PIPE, stderr=PIPE)
+    stderr = []
+    stderr_reader = threading.Thread(target=lambda: stderr.append(process.stderr.read()))
+    stderr_reader.start()
+    finished = False
+    try:
+        while True:
+            chunk = np.empty(chunk_samples, dtype=dtype)
+            nbytes = process.stdout.readinto(memoryview(chunk).cast("B"))
+            if not nbytes:
+                finished = True
+                break
+            yield chunk[: nbytes // dtype.itemsize]
+    finally:
+        # FFmpeg may still be exiting after the end of its output, so it is only stopped if the stream was closed early
+        if not finished and process.poll() is None:
+            process.kill()
+        process.stdout.close()
+        process.wait()
+        stderr_reader.join()
+        process.stderr.close()
+    if process.returncode != 0:
+        raise Exception("FFMpeg failed:\n" + stderr[0].decode("utf-8", errors="replace").strip())
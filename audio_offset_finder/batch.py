@@ -0,0 +1,115 @@
+# audio-offset-finder
+#
+# Copyright (c) 2014-24 British Broadcasting Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+import csv
+import json
+import os
+
+PAIR_FIELDS = ("within", "find_offset_of")
+
+
+def read_pairs(lines):
+    """Reads pairs of files to compare from CSV or JSON lines.
+
+    Each line should either be a JSON object with "within" and "find_offset_of" members, or a CSV row with the
+    "within" file in the first column and the "find_offset_of" file in the second.  (A CSV header row naming the two
+    columns may be used to put them in a different order.)  Blank lines and lines starting with "#" are ignored.
+
+    Parameters
+    ----------
+    lines: iterable of strings
+        The lines to read, e.g. an open file
+
+    Returns
+    -------
+    A generator of dicts, each containing the "within" and "find_offset_of" files of one pair, or (if a line could
+    not be parsed) the "line" number and an "error" message.
+    """
+    columns = (0, 1)
+    for line_number, line in enumerate(lines, 1):
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        try:
+            if line.startswith("{"):
+                record = json.loads(line)
+                yield {field: str(record[field]) for field in PAIR_FIELDS}
+                continue
+            row = [column.strip() for column in next(csv.reader([line]))]
+            if set(PAIR_FIELDS) <= set(row):
+                columns = tuple(row.index(field) for field in PAIR_FIELDS)
+                continue
+            yield {field: row[column] for field, column in zip(PAIR_FIELDS, columns)}
+        except (ValueError, KeyError, IndexError) as e:
+            yield {"line": line_number, "error": "Could not parse line: %s" % str(e)}
+
+
+def run_batch(pairs, jobs=None, **kwargs):
+    """Finds the offsets for a sequence of pairs of files, using a pool of worker processes.
+
+    The worker processes are started once and reused for every pair, and results are produced in the order that they
+    are completed.  Only a few pairs per worker are read ahead of the results, so pairs may be supplied by a generator
+    that reads from an unbounded source such as a pipe.
+
+    Parameters
+    ----------
+    pairs: iterable of dicts
+        The pairs of files to compare, as produced by read_pairs()
+    jobs: int
+        The number of worker processes to use.  The default is the number of processors on the machine.
+    kwargs:
+        Any other parameters to pass to find_offset_between_files()
+
+    Returns
+    -------
+    A generator of dicts containing the "within" and "find_offset_of" files of each pair, and either their
+    "time_offset" and "standard_score" (and "profile", if profile=True is passed), or an "error" message if they could
+    not be compared.
+    """
+    jobs = jobs or os.cpu_count() or 1
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        max_pending = 2 * jobs
+        pending = set()
+        for pair in pairs:
+            if "error" in pair:
+                yield pair
+                continue
+            pending.add(executor.submit(_process_pair, pair, kwargs))
+            if len(pending) >= max_pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield future.result()
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield future.result()
+
+
+def _process_pair(pair, kwargs):
+    """Runs in a worker process to compare one pair of files, reporting any failure in the results"""
+    from .audio_offset_finder import find_offset_between_files
+
+    results = dict(pair)
+    try:
+        offset_results = find_offset_between_files(pair["within"], pair["find_offset_of"], **kwargs)
+        results["time_offset"] = offset_results["time_offset"]
+        results["standard_score"] = float(offset_results["standard_score"])
+        if "profile" in offset_results:
+            results["profile"] = offset_results["profile"]
+    except Exception as e:
+        results["error"] = str(e)
+    return results
@@ -0,0 +1,118 @@
+# audio-offset-finder
+#
+# Copyright (c) 2014-24 British Broadcasting Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import hashlib
+import json
+import os
+import tempfile
+import numpy as np
+
+# Bump this whenever a change to the feature calculations would make previously cached features invalid
+CACHE_FORMAT_VERSION = 2
+
+
+class FeatureCache:
+    """An on-disk cache of standardised MFCCs, so that files that are compared repeatedly are only decoded once.
+
+    Features are stored as .npy files in a directory, and are memory-mapped when read back.  Entries are keyed by the
+    identity of the media file and the parameters used to calculate the features.  When the total size of the cache
+    exceeds max_size bytes, the least recently used entries are deleted.
+
+    Parameters
+    ----------
+    directory: string
+        The directory in which to store cached features.  It is created if it does not exist, and can be shared by
+        several processes.
+    max_size: int
+        The maximum total size of the cached features, in bytes
+    hash_content: bool
+        If True (the default) media files are identified by a hash of their content.  If False, they are identified
+        by their path, modification time and size, which is much quicker for large files but will miss changes that
+        preserve all three.
+    """
+
+    def __init__(self, directory, max_size=1024**3, hash_content=True):
+        self.directory = directory
+        self.max_size = max_size
+        self.hash_content = hash_content
+        os.makedirs(directory, exist_ok=True)
+
+    def key(self, afile, **params):
+        """Returns the cache key for the features of a media file, calculated using the given parameters"""
+        digest = hashlib.sha256()
+        if self.hash_content:
+            with open(afile, "rb") as f:
+                for block in iter(lambda: f.read(1024 * 1024), b""):
+                    digest.update(block)
+        else:
+            stat = os.stat(afile)
+            digest.update(json.dumps([os.path.abspath(afile), stat.st_mtime_ns, stat.st_size]).encode())
+        digest.update(json.dumps([CACHE_FORMAT_VERSION, sorted(params.items())]).encode())
+        return digest.hexdigest()
+
+    def get(self, key):
+        """Returns the (memory-mapped, read-only) cached features for a key, or None if they are not in the cache"""
+        path = self._path(key)
+        try:
+            features = np.load(path, mmap_mode="r")
+        except (OSError, EOFError, ValueError):
+            # The entry is missing or unreadable (an empty file raises EOFError, a truncated or corrupted one ValueError
+            # or OSError) - treat it as a cache miss and overwrite it later
+            return None
+        # Modification times are used to track recency, as access times are often not updated by the filesystem
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return features
+
+    def put(self, key, features):
+        """Adds features to the cache, and evicts old entries if the cache is now too large"""
+        # Write to a temporary file and then rename it, so that other processes never see a partially written entry
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, prefix=".tmp_", suffix=".npy")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                np.save(f, features)
+            os.replace(tmp_path, self._path(key))
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+        self.evict()
+
+    def evict(self):
+        """Deletes the least recently used entries until the cache is no larger than max_size"""
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(".npy") and not entry.name.startswith("."):
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue  # Deleted by another process
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            except OSError:
+                continue  # e.g. still memory-mapped on Windows
+            total_size -= size
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + ".npy")
@@ -14,12 +14,19 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from .audio_offset_finder import find_offset_between_files
+# Only lightweight modules are imported here, so that --help and argument errors are reported quickly.  The modules
+# that need numpy, scipy etc. are imported once the arguments have been checked.
 import argparse
 import sys
 
 
 def main(argv):
+    if argv and argv[0] == "index":
+        return index_main(argv[1:])
+    if argv and argv[0] == "serve":
+        return serve_main(argv[1:])
+    if argv and argv[0] == "align":
+        return align_main(argv[1:])
     parser = argparse.ArgumentParser(
         description=(
             "Find the offset of one audio file within another.\n"
@@ -30,13 +37,87 @@ def main(argv):
         ),
         formatter_class=argparse.ArgumentDefaultsHelpFormatter,
     )
-    parser.add_argument("--find-offset-of", metavar="audio file", type=str, help="Find the offset of this file...")
+    parser.add_argument(
+        "--find-offset-of",
+        metavar="audio file",
+        type=str,
+        action="append",
+        help="Find the offset of this file... (can be given more than once)",
+    )
+    parser.add_argument(
+        "--find-offsets-of-list",
+        metavar="list file",
+        type=str,
+        dest="find_offsets_of_list",
+        help="Find the offsets of the files listed (one per line) in this file...",
+    )
     parser.add_argument("--within", metavar="audio file", type=str, help="...within this file.")
+    parser.add_argument(
+        "--batch",
+        metavar="pairs file",
+        type=str,
+        help="Find the offsets of all the pairs of files in this CSV or JSON lines file ('-' to read from stdin)",
+    )
+    parser.add_argument(
+        "--jobs", metavar="processes", type=int, help="Number of worker processes to use in batch mode (default: one per CPU)"
+    )
     parser.add_argument("--sr", metavar="sample rate", type=int, default=8000, help="Resample to this rate before searching")
     parser.add_argument("--trim", metavar="seconds", type=int, help="Only consider the first n seconds of the audio files")
     parser.add_argument(
         "--resolution", metavar="samples", type=int, default=128, help="Resolution (maximum accuracy) of search in samples"
     )
+    parser.add_argument(
+        "--coarse-factor",
+        metavar="factor",
+        type=int,
+        help="Search at a resolution this many times coarser first, then refine the best candidates at full resolution",
+    )
+    parser.add_argument(
+        "--candidates",
+        metavar="count",
+        type=int,
+        help="Number of coarse candidates to refine (with --coarse-factor, default: 3)",
+    )
+    parser.add_argument(
+        "--max-offset",
+        metavar="seconds",
+        type=float,
+        help="Only search for offsets within this many seconds of the expected offset, and only decode the audio needed",
+    )
+    parser.add_argument(
+        "--expected-offset", metavar="seconds", type=float, help="The expected offset (with --max-offset, default: 0)"
+    )
+    parser.add_argument(
+        "--min-score",
+        metavar="score",
+        type=float,
+        help="Search progressively longer parts of the files, stopping as soon as the offset has this standard score",
+    )
+    parser.add_argument(
+        "--timeline",
+        action="store_true",
+        help="Find the offset of each window of the 'offset-of' file, and the rate at which the offset drifts",
+    )
+    parser.add_argument("--window", metavar="seconds", type=float, default=30, help="Length of each window (with --timeline)")
+    parser.add_argument(
+        "--stride", metavar="seconds", type=float, default=10, help="Time between the starts of windows (with --timeline)"
+    )
+    parser.add_argument(
+        "--streams",
+        metavar="indices",
+        type=str,
+        help="Find the offset of each of these audio streams of the 'offset-of' file (comma-separated, counting from 0)",
+    )
+    parser.add_argument(
+        "--channels",
+        action="store_true",
+        help="Find the offset of each channel of the 'offset-of' file's audio streams separately",
+    )
+    parser.add_argument(
+        "--follow",
+        action="store_true",
+        help="Treat the 'offset-of' file as a live stream, and print updated offsets as it is decoded",
+    )
     parser.add_argument("--show-plot", action="store_true", dest="show_plot", help="Display plot of cross-correlation results")
     parser.add_argument(
         "--save-plot",
@@ -46,41 +127,503 @@ def main(argv):
         help=("Save a plot of cross-correlation results to a file " "(format matches extension - png, ps, pdf, svg)"),
     )
     parser.add_argument("--json", action="store_true", dest="output_json", help="Output in JSON for further processing")
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="Also output the time and memory taken by each stage of the search (single 'offset-of' file or batch mode)",
+    )
+    parser.add_argument(
+        "--cache-dir",
+        metavar="directory",
+        type=str,
+        help="Cache audio features in this directory, to speed up repeated searches",
+    )
+    parser.add_argument(
+        "--cache-size", metavar="megabytes", type=int, default=1024, help="Maximum size of the feature cache directory"
+    )
     args = parser.parse_args(argv)
-    if not (args.find_offset_of and args.within):
+    if args.expected_offset is not None and args.max_offset is None:
+        parser.error("--expected-offset can only be used with --max-offset")
+    if args.batch:
+        if args.find_offset_of or args.find_offsets_of_list or args.within or args.show_plot or args.plot_file is not None:
+            parser.error("Input audio files and plots cannot be used in batch mode")
+        if args.timeline or args.streams is not None or args.channels or args.follow:
+            parser.error("--timeline, --streams, --channels and --follow cannot be used in batch mode")
+        if args.min_score is not None and args.max_offset is not None:
+            parser.error("--min-score cannot be used with --max-offset")
+        return run_batch_mode(args)
+    if not ((args.find_offset_of or args.find_offsets_of_list) and args.within):
         parser.error("Please provide input audio files")
 
+    clips = list(args.find_offset_of or [])
+    if args.find_offsets_of_list:
+        with open(args.find_offsets_of_list) as list_file:
+            clips += [line.strip() for line in list_file if line.strip()]
+    multiple_clips = len(clips) > 1 or args.find_offsets_of_list is not None
+    if multiple_clips and (args.show_plot or args.plot_file is not None):
+        parser.error("Plots can only be produced when finding the offset of a single file")
+    if args.min_score is not None and (args.max_offset is not None or multiple_clips or args.timeline or args.follow):
+        parser.error("--min-score can only be used with a single 'offset-of' file, and without --max-offset or other modes")
+    if args.profile and multiple_clips:
+        parser.error("--profile can only be used when finding the offset of a single file")
+    if args.max_offset is not None and (multiple_clips or args.streams is not None or args.channels or args.follow):
+        parser.error("--max-offset can only be used with a single 'offset-of' file, with --timeline, or in batch mode")
+    coarse = args.coarse_factor is not None or args.candidates is not None
+    if coarse and (multiple_clips or args.timeline or args.streams is not None or args.channels or args.follow):
+        parser.error("--coarse-factor and --candidates can only be used with a single 'offset-of' file, or in batch mode")
+    if args.follow:
+        if multiple_clips or args.show_plot or args.plot_file is not None:
+            parser.error("--follow can only be used with a single 'offset-of' file, and without plots")
+        return follow_stream(args, clips[0])
+    if args.timeline and (multiple_clips or args.show_plot or args.plot_file is not None or args.profile):
+        parser.error("--timeline can only be used with a single 'offset-of' file, and without plots or profiling")
+    tracks = args.streams is not None or args.channels
+    if tracks and (
+        multiple_clips
+        or args.show_plot
+        or args.plot_file is not None
+        or args.profile
+        or args.timeline
+        or args.min_score is not None
+    ):
+        parser.error("--streams and --channels can only be used with a single 'offset-of' file, and without other modes")
+    streams = [0]
+    if args.streams is not None:
+        try:
+            streams = [int(stream) for stream in args.streams.split(",")]
+        except ValueError:
+            parser.error("--streams must be a comma-separated list of stream indices")
+
+    from .audio_offset_finder import find_offset_between_files, find_offsets_in_reference, find_offset_timeline
+    from .audio_offset_finder import find_track_offsets
+    from .cache import FeatureCache
+
     try:
         trim = None
         if args.trim:
             trim = int(args.trim)
 
-        results = find_offset_between_files(
-            args.within, args.find_offset_of, fs=int(args.sr), trim=trim, hop_length=int(args.resolution)
-        )
+        cache = None
+        if args.cache_dir:
+            cache = FeatureCache(args.cache_dir, max_size=args.cache_size * 1024 * 1024)
+
+        if args.timeline:
+            results = find_offset_timeline(
+                args.within,
+                clips[0],
+                window=args.window,
+                stride=args.stride,
+                fs=int(args.sr),
+                trim=trim,
+                hop_length=int(args.resolution),
+                cache=cache,
+                expected_offset=args.expected_offset,
+                max_offset=args.max_offset,
+            )
+        elif tracks:
+            all_results = find_track_offsets(
+                args.within,
+                clips[0],
+                streams=streams,
+                channels=args.channels,
+                fs=int(args.sr),
+                trim=trim,
+                hop_length=int(args.resolution),
+                cache=cache,
+            )
+        elif multiple_clips:
+            all_results = find_offsets_in_reference(
+                args.within,
+                clips,
+                fs=int(args.sr),
+                trim=trim,
+                hop_length=int(args.resolution),
+                cache=cache,
+                return_exceptions=True,
+            )
+        else:
+            results = find_offset_between_files(
+                args.within,
+                clips[0],
+                fs=int(args.sr),
+                trim=trim,
+                hop_length=int(args.resolution),
+                cache=cache,
+                coarse_factor=args.coarse_factor,
+                top_k=3 if args.candidates is None else args.candidates,
+                expected_offset=args.expected_offset,
+                max_offset=args.max_offset,
+                profile=args.profile,
+                min_score=args.min_score,
+            )
     except Exception as e:
         print(e, file=sys.stderr)
         return 1
 
+    if args.timeline:
+        return print_timeline(args, results)
+    if tracks:
+        return print_tracks(args, all_results)
+    if multiple_clips:
+        return print_json_lines(clips, all_results)
+
     if args.output_json:
         import json
 
         json_results = {"time_offset": results["time_offset"], "standard_score": results["standard_score"]}
+        if args.profile:
+            json_results["profile"] = results["profile"]
         print(json.dumps(json_results))
     else:
         print("Offset: %s (seconds)" % str(results["time_offset"]))
         print("Standard score: %s" % str(results["standard_score"]))
+        if args.profile:
+            print_profile(results["profile"])
 
     if args.show_plot or args.plot_file is not None:
         plot_results(args, results)
 
 
+def print_profile(profile):
+    for stage, seconds in profile["stage_seconds"].items():
+        print("Time for %s: %.3f (seconds)" % (stage, seconds))
+    for name in ("decoded_samples", "mfcc_frames", "cache_hits"):
+        for label, value in profile[name].items():
+            print("%s (file %s): %s" % (name.replace("_", " ").capitalize(), label, value))
+    print("Correlated frames: %s" % profile["correlated_frames"])
+    print("Lags evaluated: %s" % profile["lags_evaluated"])
+    print("Peak array size: %s (bytes)" % profile["peak_array_bytes"])
+
+
+def print_timeline(args, results):
+    if args.output_json:
+        import json
+
+        print(json.dumps({name: results[name] for name in ("windows", "drift", "intercept")}))
+        return
+    for window in results["windows"]:
+        print(
+            "Position: %s (seconds), offset: %s (seconds), standard score: %s"
+            % (str(window["position"]), str(window["time_offset"]), str(window["standard_score"]))
+        )
+    if results["drift"] is not None:
+        print("Drift: %s (seconds per second)" % str(results["drift"]))
+        print("Offset at start: %s (seconds)" % str(results["intercept"]))
+
+
+def print_tracks(args, all_results):
+    for results in all_results:
+        track = "channel" if args.channels else "stream"
+        if args.output_json:
+            import json
+
+            print(
+                json.dumps(
+                    {
+                        track: results[track],
+                        "time_offset": results["time_offset"],
+                        "standard_score": results["standard_score"],
+                    }
+                )
+            )
+        else:
+            print("%s: %s" % (track.capitalize(), results[track]))
+            print("Offset: %s (seconds)" % str(results["time_offset"]))
+            print("Standard score: %s" % str(results["standard_score"]))
+
+
+# Build or query a fingerprint index ("audio-offset-finder index build|query ...")
+def index_main(argv):
+    parser = argparse.ArgumentParser(
+        prog="audio-offset-finder index",
+        description="Find which of a large collection of recordings contain a clip, and where, using a fingerprint index.",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    build_parser = subparsers.add_parser("build", help="Add recordings to an index, creating the index if necessary")
+    build_parser.add_argument("index", metavar="index file", type=str, help="The index to add the recordings to")
+    build_parser.add_argument("recordings", metavar="audio file", type=str, nargs="*", help="Recordings to add")
+    build_parser.add_argument(
+        "--files-from", metavar="list file", type=str, help="Also add the recordings listed (one per line) in this file"
+    )
+    build_parser.add_argument(
+        "--sr", metavar="sample rate", type=int, help="Resample to this rate (new indexes, default: 8000)"
+    )
+    build_parser.add_argument(
+        "--resolution", metavar="samples", type=int, help="Resolution of the index in samples (new indexes, default: 128)"
+    )
+    build_parser.add_argument(
+        "--step", metavar="frames", type=int, help="Only index every n'th frame of each recording (new indexes, default: 2)"
+    )
+    query_parser = subparsers.add_parser("query", help="Find which indexed recordings contain a clip, and where")
+    query_parser.add_argument("index", metavar="index file", type=str, help="The index to search")
+    query_parser.add_argument("clip", metavar="audio file", type=str, help="The clip to search for")
+    query_parser.add_argument(
+        "--candidates", metavar="count", type=int, default=5, help="Number of candidate matches to verify"
+    )
+    query_parser.add_argument(
+        "--max-offset",
+        metavar="seconds",
+        type=float,
+        default=2.0,
+        help="Verify each candidate by searching this many seconds either side of its offset",
+    )
+    query_parser.add_argument("--trim", metavar="seconds", type=int, help="Only consider the first n seconds of the clip")
+    query_parser.add_argument("--json", action="store_true", dest="output_json", help="Output in JSON for further processing")
+    args = parser.parse_args(argv)
+
+    from .index import FingerprintIndex
+
+    if args.command == "build":
+        recordings = list(args.recordings)
+        if args.files_from:
+            with open(args.files_from) as list_file:
+                recordings += [line.strip() for line in list_file if line.strip()]
+        status = None
+        try:
+            with FingerprintIndex(args.index, fs=args.sr, hop_length=args.resolution, step=args.step) as index:
+                for recording in recordings:
+                    try:
+                        if index.add(recording):
+                            print("Added: %s" % recording, flush=True)
+                        else:
+                            print("Unchanged: %s" % recording, flush=True)
+                    except Exception as e:
+                        print("%s: %s" % (recording, e), file=sys.stderr)
+                        status = 1
+        except ValueError as e:
+            print(e, file=sys.stderr)
+            return 1
+        return status
+
+    try:
+        with FingerprintIndex(args.index) as index:
+            all_results = index.query(args.clip, max_candidates=args.candidates, max_offset=args.max_offset, trim=args.trim)
+    except Exception as e:
+        print(e, file=sys.stderr)
+        return 1
+    if not all_results:
+        print("No matches found", file=sys.stderr)
+        return 1
+    for results in all_results:
+        if args.output_json:
+            import json
+
+            print(json.dumps(results))
+        else:
+            print("Recording: %s" % results["recording"])
+            print("Offset: %s (seconds)" % str(results["time_offset"]))
+            print("Standard score: %s" % str(results["standard_score"]))
+
+
+# Align a set of recordings of the same event ("audio-offset-finder align ...")
+def align_main(argv):
+    parser = argparse.ArgumentParser(
+        prog="audio-offset-finder align",
+        description=(
+            "Find the offset between every pair of a set of recordings of the same event, and print a consistent "
+            "timeline of them in JSON."
+        ),
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument("files", metavar="audio file", type=str, nargs="*", help="Recordings to align")
+    parser.add_argument(
+        "--files-from", metavar="list file", type=str, help="Also align the recordings listed (one per line) in this file"
+    )
+    parser.add_argument("--sr", metavar="sample rate", type=int, default=8000, help="Resample to this rate before searching")
+    parser.add_argument("--trim", metavar="seconds", type=int, help="Only consider the first n seconds of the audio files")
+    parser.add_argument(
+        "--resolution", metavar="samples", type=int, default=128, help="Resolution (maximum accuracy) of search in samples"
+    )
+    parser.add_argument(
+        "--min-score",
+        metavar="score",
+        type=float,
+        default=10,
+        help="Treat pairs of recordings whose standard score is lower than this as not overlapping",
+    )
+    parser.add_argument(
+        "--cache-dir",
+        metavar="directory",
+        type=str,
+        help="Cache audio features in this directory, to speed up repeated searches",
+    )
+    parser.add_argument(
+        "--cache-size", metavar="megabytes", type=int, default=1024, help="Maximum size of the feature cache directory"
+    )
+    args = parser.parse_args(argv)
+    files = list(args.files)
+    if args.files_from:
+        with open(args.files_from) as list_file:
+            files += [line.strip() for line in list_file if line.strip()]
+    if len(files) < 2:
+        parser.error("Please provide at least two audio files")
+
+    import json
+    from .audio_offset_finder import align_set
+    from .cache import FeatureCache
+
+    cache = None
+    if args.cache_dir:
+        cache = FeatureCache(args.cache_dir, max_size=args.cache_size * 1024 * 1024)
+    try:
+        results = align_set(
+            files, fs=args.sr, trim=args.trim, hop_length=args.resolution, cache=cache, min_score=args.min_score
+        )
+    except Exception as e:
+        print(e, file=sys.stderr)
+        return 1
+    print(json.dumps(results))
+
+
+# Run a local HTTP service ("audio-offset-finder serve ...")
+def serve_main(argv):
+    parser = argparse.ArgumentParser(
+        prog="audio-offset-finder serve",
+        description=(
+            "Find offsets between audio files (or uploaded PCM) requested over a local HTTP/JSON API, using a pool of "
+            "worker processes.  POST requests to /offset, and GET /metrics for queue depth and latencies."
+        ),
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument("--host", metavar="address", type=str, default="127.0.0.1", help="Address to listen on")
+    parser.add_argument("--port", metavar="port", type=int, default=8000, help="Port to listen on")
+    parser.add_argument(
+        "--jobs", metavar="processes", type=int, help="Number of worker processes to use (default: one per CPU)"
+    )
+    parser.add_argument(
+        "--max-queue",
+        metavar="requests",
+        type=int,
+        help="Number of requests that can wait for a worker before further requests are rejected (default: 2 per worker)",
+    )
+    parser.add_argument(
+        "--reference-cache-size",
+        metavar="references",
+        type=int,
+        default=16,
+        help="Number of references whose features each worker keeps in memory",
+    )
+    parser.add_argument(
+        "--cache-dir",
+        metavar="directory",
+        type=str,
+        help="Cache audio features in this directory, shared by all the workers",
+    )
+    parser.add_argument(
+        "--cache-size", metavar="megabytes", type=int, default=1024, help="Maximum size of the feature cache directory"
+    )
+    parser.add_argument("--quiet", action="store_true", help="Don't log requests")
+    args = parser.parse_args(argv)
+
+    from .cache import FeatureCache
+    from .server import serve
+
+    cache = None
+    if args.cache_dir:
+        cache = FeatureCache(args.cache_dir, max_size=args.cache_size * 1024 * 1024)
+    try:
+        serve(
+            args.host,
+            args.port,
+            jobs=args.jobs,
+            max_queue=args.max_queue,
+            reference_cache_size=args.reference_cache_size,
+            cache=cache,
+            quiet=args.quiet,
+        )
+    except OSError as e:
+        print(e, file=sys.stderr)
+        return 1
+
+
+# Process the pairs listed in a batch file, printing one line of JSON results per pair as they complete
+def run_batch_mode(args):
+    import json
+    from .batch import read_pairs, run_batch
+    from .cache import FeatureCache
+
+    trim = None
+    if args.trim:
+        trim = int(args.trim)
+    cache = None
+    if args.cache_dir:
+        cache = FeatureCache(args.cache_dir, max_size=args.cache_size * 1024 * 1024)
+
+    pairs_file = sys.stdin if args.batch == "-" else open(args.batch)
+    status = None
+    try:
+        for results in run_batch(
+            read_pairs(pairs_file),
+            jobs=args.jobs,
+            fs=int(args.sr),
+            trim=trim,
+            hop_length=int(args.resolution),
+            cache=cache,
+            coarse_factor=args.coarse_factor,
+            top_k=3 if args.candidates is None else args.candidates,
+            expected_offset=args.expected_offset,
+            max_offset=args.max_offset,
+            min_score=args.min_score,
+            profile=args.profile,
+        ):
+            if "error" in results:
+                status = 1
+            print(json.dumps(results), flush=True)
+    finally:
+        if pairs_file is not sys.stdin:
+            pairs_file.close()
+    return status
+
+
+# Find the offset of a live stream within a file, printing updated results as the stream is decoded
+def follow_stream(args, stream):
+    from .audio_offset_finder import decode_audio, stream_audio
+    from .streaming import StreamingOffsetFinder
+    import json
+
+    try:
+        fs, hop_length = int(args.sr), int(args.resolution)
+        trim = None
+        if args.trim:
+            trim = int(args.trim)
+        finder = StreamingOffsetFinder(decode_audio(args.within, fs, trim), fs, hop_length=hop_length)
+        for chunk in stream_audio(stream, fs, hop_length * finder.update_interval):
+            results = finder.push(chunk)
+            if results is None:
+                continue
+            if args.output_json:
+                print(json.dumps(results), flush=True)
+            else:
+                print("Offset: %s (seconds)" % str(results["time_offset"]))
+                print("Standard score: %s" % str(results["standard_score"]), flush=True)
+    except KeyboardInterrupt:
+        pass
+    except Exception as e:
+        print(e, file=sys.stderr)
+        return 1
+
+
+# Print one line of JSON results per clip, returning 1 if any of them failed
+def print_json_lines(clips, all_results):
+    import json
+
+    status = None
+    for clip, results in zip(clips, all_results):
+        if isinstance(results, Exception):
+            json_results = {"file": clip, "error": str(results)}
+            status = 1
+        else:
+            json_results = {"file": clip, "time_offset": results["time_offset"], "standard_score": results["standard_score"]}
+        print(json.dumps(json_results))
+    return status
+
+
 # Re-order the cross-correlation array so that the index of the earliest frame offset is at one end of the range
 def reorder_correlations(cc, earliest_frame_offset):
-    from numpy import concatenate
+    from numpy import roll
 
-    num_elements = len(cc)
-    return concatenate((cc[earliest_frame_offset:], cc[:earliest_frame_offset]))
+    return roll(cc, -earliest_frame_offset)
 
 
 def plot_results(args, results):
@@ -106,7 +649,7 @@ def plot_results(args, results):
     ax.set(yticklabels=[])
     ax.tick_params(left=False)
 
-    plot_title = "Offset of %s in %s" % (args.find_offset_of, args.within)
+    plot_title = "Offset of %s in %s" % (args.find_offset_of[0], args.within)
     pyplot.title(plot_title, fontsize=14)
 
     peak_xvalue = results["frame_offset"]
@@ -0,0 +1,320 @@
+# audio-offset-finder
+#
+# Copyright (c) 2014-24 British Broadcasting Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from .audio_offset_finder import (
+    _decode_ranges,
+    _file_features,
+    _find_offset_between_features,
+    _search_lag_range,
+    _shift_results,
+    InsufficientAudioException,
+)
+import json
+import os
+import sqlite3
+import numpy as np
+
+# Bump this whenever a change to the fingerprints would make existing indexes invalid
+INDEX_FORMAT_VERSION = 2
+
+# The number of bits in each fingerprint.  Half of them record the changes over time of as many MFCCs (after the
+# zeroth) at one frame, and the other half the changes PAIR_FRAMES frames later.
+FINGERPRINT_BITS = 32
+
+# The distance between the two frames whose changes make up each fingerprint
+PAIR_FRAMES = 8
+
+# The number of frames over which MFCCs are averaged before comparing them, to make fingerprints robust to noise
+SMOOTHING_FRAMES = 4
+
+DEFAULT_SETTINGS = {"fs": 8000, "hop_length": 128, "win_length": 256, "nfft": 512, "step": 2}
+
+# SQLite limits the number of parameters in a statement, so look up the postings of a clip's hashes in chunks
+QUERY_CHUNK_SIZE = 500
+
+# The number of frames of a clip to cross-correlate when verifying a candidate, as in find_offset_between_files()
+VERIFY_FRAMES = 2000
+
+
+def fingerprints(features, step=1):
+    """Quantises standardised MFCCs into FINGERPRINT_BITS-bit fingerprints, one per frame.
+
+    Each bit of a fingerprint records whether one MFCC increases or decreases from one group of SMOOTHING_FRAMES
+    frames to the next, either at the fingerprinted frame or PAIR_FRAMES frames later.  As these are signs of changes
+    over time, they are unaffected by the per-coefficient scaling applied by std_mfcc(), so a clip and a recording that
+    contains it give the same fingerprints even though they are standardised separately.  Combining two frames makes
+    the fingerprints specific enough that each is shared by few frames of even a large collection of recordings, but
+    also means that both frames' changes must match exactly, so clips are found in recordings of the same source
+    (re-encoded, or with moderate noise added), but rarely in separate recordings of the same sound.
+
+    Parameters
+    ----------
+    features: numpy array
+        Standardised MFCCs with at least FINGERPRINT_BITS // 2 + 1 coefficients, as calculated by
+        find_offset_between_files()
+    step: int
+        Only every step'th frame is fingerprinted
+
+    Returns
+    -------
+    A tuple of two 1D numpy arrays: the frame numbers that were fingerprinted, and their fingerprints.  Frames for which
+    none of the MFCCs change at either of the two frames (e.g. in digital silence) are left out.
+    """
+    frame_bits = FINGERPRINT_BITS // 2
+    sums = np.cumsum(features[:, 1 : frame_bits + 1], axis=0, dtype=np.float64)
+    smoothed = sums[SMOOTHING_FRAMES:] - sums[:-SMOOTHING_FRAMES]
+    changes = smoothed[SMOOTHING_FRAMES:] - smoothed[:-SMOOTHING_FRAMES]
+    changing = np.any(np.abs(changes) > 1e-3, axis=1)
+    halves = (changes > 0) @ (1 << np.arange(frame_bits, dtype=np.int64))
+    hashes = (halves[:-PAIR_FRAMES] << frame_bits) | halves[PAIR_FRAMES:]
+    frames = np.arange(0, len(hashes), step)
+    frames = frames[changing[frames] & changing[frames + PAIR_FRAMES]]
+    return frames, hashes[frames]
+
+
+class FingerprintIndex:
+    """An on-disk index of the fingerprints of a collection of recordings, for finding which of them contain a clip, and
+    where, without cross-correlating the clip against every one of them.
+
+    The index is an inverted index in a SQLite database, mapping each fingerprint (see fingerprints()) to the
+    recordings and frames in which it occurs.  Recordings can be added to it at any time.  To search it, the
+    fingerprints of a clip are looked up, and each match votes for the offset between the clip and the recording that
+    would align them.  The offsets with the most votes are then verified by cross-correlating the clip against the
+    recording around each of them, as find_offset_between_files() does with max_offset.
+
+    Parameters
+    ----------
+    path: string
+        The path of the index file.  It is created if it does not exist.
+    fs, hop_length, win_length, nfft:
+        The parameters used to calculate MFCCs, as described for find_offset_between_files().  They are stored in the
+        index when it is created, and cannot be changed afterwards.  If omitted, the stored values (or the defaults,
+        for a new index) are used.
+    step: int
+        Only every step'th frame of each recording is indexed.  Larger values make the index smaller, but leave fewer
+        fingerprints to match each clip.
+
+    Throws
+    ------
+    ValueError if the index already exists and was built with different parameters.
+    """
+
+    def __init__(self, path, fs=None, hop_length=None, win_length=None, nfft=None, step=None):
+        self.path = path
+        self._connection = sqlite3.connect(path)
+        requested = {"fs": fs, "hop_length": hop_length, "win_length": win_length, "nfft": nfft, "step": step}
+        with self._connection:
+            self._connection.execute("CREATE TABLE IF NOT EXISTS settings (name TEXT PRIMARY KEY, value TEXT)")
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS recordings "
+                "(id INTEGER PRIMARY KEY, path TEXT UNIQUE, signature TEXT, frames INTEGER)"
+            )
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS postings "
+                "(hash INTEGER, recording INTEGER, frame INTEGER, PRIMARY KEY (hash, recording, frame)) WITHOUT ROWID"
+            )
+            stored = self._connection.execute("SELECT value FROM settings WHERE name = 'settings'").fetchone()
+            if stored is None:
+                settings = {name: DEFAULT_SETTINGS[name] if value is None else value for name, value in requested.items()}
+                settings["version"] = INDEX_FORMAT_VERSION
+                self._connection.execute("INSERT INTO settings VALUES ('settings', ?)", (json.dumps(settings),))
+            else:
+                settings = json.loads(stored[0])
+                if settings["version"] != INDEX_FORMAT_VERSION:
+                    raise ValueError("The index %s was built by a different version, and must be rebuilt" % path)
+                for name, value in requested.items():
+                    if value is not None and value != settings[name]:
+                        raise ValueError("The index %s was built with %s=%s" % (path, name, settings[name]))
+        self.fs = settings["fs"]
+        self.hop_length = settings["hop_length"]
+        self.win_length = settings["win_length"]
+        self.nfft = settings["nfft"]
+        self.step = settings["step"]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __len__(self):
+        return self._connection.execute("SELECT COUNT(*) FROM recordings").fetchone()[0]
+
+    def close(self):
+        self._connection.close()
+
+    def recordings(self):
+        """Returns the paths of the indexed recordings"""
+        return [row[0] for row in self._connection.execute("SELECT path FROM recordings ORDER BY id")]
+
+    def add(self, afile, decoder="pipe", cache=None):
+        """Adds a recording to the index, replacing it if it was indexed before and has changed since.
+
+        Parameters
+        ----------
+        afile: string
+            A path to the recording, in any format that FFMPEG can read
+        decoder: string
+            How decoded audio is passed from FFmpeg (see find_offset_between_files())
+        cache: FeatureCache
+            If supplied, the recording's MFCCs are read from (or added to) this cache
+
+        Returns
+        -------
+        True if the recording was added, or False if it was already indexed and has not changed.
+        """
+        path = os.path.abspath(afile)
+        stat = os.stat(path)
+        signature = json.dumps([stat.st_mtime_ns, stat.st_size])
+        existing = self._connection.execute("SELECT id, signature FROM recordings WHERE path = ?", (path,)).fetchone()
+        if existing is not None and existing[1] == signature:
+            return False
+
+        features = _file_features(path, self.fs, None, self.hop_length, self.win_length, self.nfft, decoder, cache)
+        frames, hashes = fingerprints(features, self.step)
+        with self._connection:
+            if existing is not None:
+                self._connection.execute("DELETE FROM postings WHERE recording = ?", (existing[0],))
+                self._connection.execute("DELETE FROM recordings WHERE id = ?", (existing[0],))
+            recording = self._connection.execute(
+                "INSERT INTO recordings (path, signature, frames) VALUES (?, ?, ?)", (path, signature, len(features))
+            ).lastrowid
+            self._connection.executemany(
+                "INSERT INTO postings VALUES (?, ?, ?)",
+                ((int(h), recording, int(frame)) for h, frame in zip(hashes, frames)),
+            )
+        return True
+
+    def candidates(self, features, max_candidates=5, min_votes=2):
+        """Finds the recordings and offsets whose fingerprints best match those of a clip, without verifying them.
+
+        Parameters
+        ----------
+        features: numpy array
+            The standardised MFCCs of the clip, calculated with the index's parameters
+        max_candidates: int
+            The maximum number of candidates to return
+        min_votes: int
+            The minimum number of matching fingerprints needed for a candidate to be returned
+
+        Returns
+        -------
+        A list of dicts, in descending order of votes, each containing the "recording" path, the "time_offset" of the
+        clip within it in seconds, and the number of matching fingerprints ("votes") that support that offset.  Only
+        the best offset within SMOOTHING_FRAMES frames either side is returned.
+        """
+        frames, hashes = fingerprints(features)
+        order = np.argsort(hashes, kind="stable")
+        hashes, frames = hashes[order], frames[order]
+        unique_hashes = np.unique(hashes).tolist()
+        postings = []
+        for start in range(0, len(unique_hashes), QUERY_CHUNK_SIZE):
+            chunk = unique_hashes[start : start + QUERY_CHUNK_SIZE]
+            postings += self._connection.execute(
+                "SELECT hash, recording, frame FROM postings WHERE hash IN (%s)" % ",".join("?" * len(chunk)), chunk
+            ).fetchall()
+        if not postings:
+            return []
+
+        # Pair every posting with every frame of the clip that has the same fingerprint, and count the votes for the
+        # offset that each pair implies
+        postings = np.array(postings, dtype=np.int64)
+        first = np.searchsorted(hashes, postings[:, 0], side="left")
+        counts = np.searchsorted(hashes, postings[:, 0], side="right") - first
+        clip_frames = frames[np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts - first, counts)]
+        offsets = np.repeat(postings[:, 2], counts) - clip_frames
+        votes, vote_counts = np.unique(np.stack((np.repeat(postings[:, 1], counts), offsets)), axis=1, return_counts=True)
+
+        paths = dict(self._connection.execute("SELECT id, path FROM recordings"))
+        time_scale = self.hop_length / self.fs
+        candidates, chosen = [], []
+        for i in np.argsort(-vote_counts, kind="stable"):
+            if vote_counts[i] < min_votes:
+                break
+            recording, offset = int(votes[0, i]), int(votes[1, i])
+            if any(other == recording and abs(other_offset - offset) <= SMOOTHING_FRAMES for other, other_offset in chosen):
+                continue
+            chosen.append((recording, offset))
+            candidates.append(
+                {"recording": paths[recording], "time_offset": offset * time_scale, "votes": int(vote_counts[i])}
+            )
+            if len(candidates) == max_candidates:
+                break
+        return candidates
+
+    def query(self, clip, max_candidates=5, min_votes=2, max_offset=2.0, trim=None, decoder="pipe", cache=None):
+        """Finds which of the indexed recordings contain a clip, and where.
+
+        Parameters
+        ----------
+        clip: string
+            A path to the clip, in any format that FFMPEG can read
+        max_candidates: int
+            The maximum number of candidate recordings and offsets to verify
+        min_votes: int
+            The minimum number of matching fingerprints needed for a candidate to be verified
+        max_offset: float
+            Each candidate is verified by searching for the clip within this many seconds of the candidate's offset
+        trim: float
+            Only fingerprint the first trim seconds of the clip
+        decoder, cache:
+            As described for find_offset_between_files().  The cache is used for the clip and for the parts of the
+            recordings decoded to verify the candidates.
+
+        Returns
+        -------
+        A list of dicts, one per verified candidate in descending order of standard score, each containing the
+        "recording" path, the "time_offset" of the clip within it and the "standard_score" as returned by
+        find_offset_between_files() with max_offset, and the number of "votes" for the candidate from the index.  When
+        several candidates are verified to the same offset, only the one with the most votes is included.
+        """
+        features = _file_features(clip, self.fs, trim, self.hop_length, self.win_length, self.nfft, decoder, cache)
+        results = {}
+        for candidate in self.candidates(features, max_candidates, min_votes):
+            try:
+                verified = self._verify(candidate, features, max_offset, decoder, cache)
+            except InsufficientAudioException:
+                continue  # e.g. the candidate offset is too close to the end of the recording to verify
+            results.setdefault(
+                (candidate["recording"], verified["frame_offset"]),
+                {
+                    "recording": candidate["recording"],
+                    "time_offset": verified["time_offset"],
+                    "standard_score": verified["standard_score"],
+                    "votes": candidate["votes"],
+                },
+            )
+        return sorted(results.values(), key=lambda verified: verified["standard_score"], reverse=True)
+
+    def _verify(self, candidate, features, max_offset, decoder, cache):
+        """Cross-correlates the MFCCs of a clip against the part of a recording around a candidate offset, as
+        find_offset_between_files() does with max_offset, but reusing the clip's MFCCs rather than decoding the clip
+        again (so that trimming only applies to the clip)"""
+        time_scale = self.hop_length / self.fs
+        lag_range = _search_lag_range(candidate["time_offset"], max_offset, time_scale)
+        decode_ranges, start_frames, lag_range = _decode_ranges(
+            lag_range, None, self.hop_length, self.nfft, VERIFY_FRAMES, None, self.fs
+        )
+        offset, duration = decode_ranges[0]
+        recording_features = _file_features(
+            candidate["recording"], self.fs, duration, self.hop_length, self.win_length, self.nfft, decoder, cache, offset
+        )
+        results = _find_offset_between_features(
+            recording_features, features, self.fs, self.hop_length, VERIFY_FRAMES, "fft", lag_range=lag_range
+        )
+        if start_frames:
+            _shift_results(results, start_frames * time_scale)
+        return results
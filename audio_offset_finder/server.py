@@ -0,0 +1,320 @@
+# audio-offset-finder
+#
+# Copyright (c) 2014-24 British Broadcasting Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from collections import OrderedDict
+from concurrent.futures import Future, ProcessPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import base64
+import hashlib
+import json
+import os
+import threading
+import time
+
+# The parameters of find_offset_between_files() that can be given in a request, and their defaults
+REQUEST_PARAMS = {
+    "fs": 8000,
+    "trim": None,
+    "hop_length": 128,
+    "win_length": 256,
+    "nfft": 512,
+    "max_frames": 2000,
+    "coarse_factor": None,
+    "top_k": 3,
+    "expected_offset": None,
+    "max_offset": None,
+}
+
+# The parameters that a reference's MFCCs depend on (the others only affect the search)
+FEATURE_PARAMS = ("fs", "trim", "hop_length", "win_length", "nfft")
+
+# The two inputs of a request, each given as a file path or as base64-encoded 16-bit little-endian mono PCM
+REQUEST_INPUTS = ("within", "find_offset_of")
+
+
+class OffsetServer(ThreadingHTTPServer):
+    """A local HTTP server that finds offsets between audio files (or uploaded PCM) using a pool of worker processes.
+
+    The worker processes are started when the server is, and import everything they need straight away, so requests
+    don't pay for interpreter startup or library imports.  Each worker keeps the MFCCs of the references it has used
+    most recently in memory, and if a cache directory is given, all the workers share a FeatureCache in it.  When all
+    the workers are busy and max_queue requests are waiting, further requests are rejected with "503 Service
+    Unavailable" until the queue has room.
+
+    The API is:
+    POST /offset: finds the offset of "find_offset_of" within "within", given in a JSON object.  Each of the two can be
+                  a file path, or can be given as base64-encoded 16-bit little-endian mono PCM at the sample rate fs in
+                  "within_pcm" or "find_offset_of_pcm" instead.  The parameters fs, trim, hop_length, win_length,
+                  nfft, max_frames, coarse_factor, top_k, expected_offset and max_offset of find_offset_between_files()
+                  can also be given.  If "profile" is true, the profile of the search is included in the results.
+                  Responds with a JSON object containing "time_offset" and "standard_score", or an "error" message.
+    GET /metrics: responds with a JSON object containing request counts, the number of requests queued and in
+                  progress, and the count, total and maximum time of each stage of processing (as described for
+                  find_offset_between_buffers(), with "queue" for the time spent waiting for a worker).
+    GET /health: responds with {"status": "ok"}
+
+    Parameters
+    ----------
+    address: tuple
+        The (host, port) to listen on.  Use port 0 to pick a free port, which can then be found from server_address.
+    jobs: int
+        The number of worker processes to use.  The default is the number of processors on the machine.
+    max_queue: int
+        The maximum number of requests waiting for a worker.  The default is twice the number of workers.
+    reference_cache_size: int
+        The number of references whose MFCCs each worker keeps in memory
+    cache: FeatureCache
+        If supplied, the MFCCs of files are read from (or added to) this cache
+    quiet: bool
+        If True, requests are not logged to stderr
+    """
+
+    daemon_threads = True
+
+    def __init__(self, address, jobs=None, max_queue=None, reference_cache_size=16, cache=None, quiet=False):
+        super().__init__(address, _RequestHandler)
+        self.jobs = jobs or os.cpu_count() or 1
+        self.max_queue = 2 * self.jobs if max_queue is None else max_queue
+        self.quiet = quiet
+        self._lock = threading.Lock()
+        self._in_progress = 0
+        self._counts = {"requests": 0, "completed": 0, "failed": 0, "rejected": 0}
+        self._stages = {}
+        # The pool's futures that haven't finished, so that any still queued can be cancelled when the server closes
+        self._pending = set()
+        self._executor = ProcessPoolExecutor(
+            max_workers=self.jobs, initializer=_init_worker, initargs=(reference_cache_size, cache)
+        )
+        # Start the workers now, rather than when the first requests arrive
+        for future in [self._executor.submit(_warm_up) for _ in range(self.jobs)]:
+            future.result()
+
+    def submit(self, request):
+        """Queues a parsed request for a worker, returning a future for its results, or None if the queue is full"""
+        with self._lock:
+            self._counts["requests"] += 1
+            if self._in_progress >= self.jobs + self.max_queue:
+                self._counts["rejected"] += 1
+                return None
+            self._in_progress += 1
+        # Only complete the future returned once the metrics have been updated, so that they are never out of date
+        results = Future()
+        future = self._executor.submit(_align, request, time.time())
+        with self._lock:
+            self._pending.add(future)
+        future.add_done_callback(lambda future: self._request_done(future, results))
+        return results
+
+    def _request_done(self, future, results):
+        with self._lock:
+            self._pending.discard(future)
+            self._in_progress -= 1
+            if future.cancelled() or future.exception() is not None:
+                self._counts["failed"] += 1
+            else:
+                self._counts["completed"] += 1
+                for stage, seconds in future.result()["profile"]["stage_seconds"].items():
+                    stats = self._stages.setdefault(stage, {"count": 0, "total_seconds": 0.0, "max_seconds": 0.0})
+                    stats["count"] += 1
+                    stats["total_seconds"] += seconds
+                    stats["max_seconds"] = max(stats["max_seconds"], seconds)
+        if future.cancelled():
+            results.cancel()
+        elif future.exception() is not None:
+            results.set_exception(future.exception())
+        else:
+            results.set_result(future.result())
+
+    def metrics(self):
+        """Returns the metrics reported by GET /metrics"""
+        with self._lock:
+            metrics = dict(self._counts)
+            metrics["workers"] = self.jobs
+            metrics["in_progress"] = min(self._in_progress, self.jobs)
+            metrics["queue_depth"] = max(0, self._in_progress - self.jobs)
+            metrics["max_queue"] = self.max_queue
+            metrics["stages"] = {stage: dict(stats) for stage, stats in self._stages.items()}
+        return metrics
+
+    def server_close(self):
+        super().server_close()
+        # Equivalent to shutdown(cancel_futures=True), which needs Python 3.9
+        with self._lock:
+            pending = list(self._pending)
+        for future in pending:
+            future.cancel()
+        self._executor.shutdown()
+
+
+def serve(host="127.0.0.1", port=8000, **kwargs):
+    """Runs an OffsetServer (see above for the other parameters) until interrupted"""
+    with OffsetServer((host, port), **kwargs) as server:
+        print("Listening on http://%s:%d/" % server.server_address[:2], flush=True)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+
+
+class _RequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path == "/metrics":
+            self._send(200, self.server.metrics())
+        elif self.path == "/health":
+            self._send(200, {"status": "ok"})
+        else:
+            self._send(404, {"error": "Not found: %s" % self.path})
+
+    def do_POST(self):
+        if self.path != "/offset":
+            self._send(404, {"error": "Not found: %s" % self.path})
+            return
+        try:
+            request = _parse_request(json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0)))))
+        except (ValueError, TypeError) as e:
+            self._send(400, {"error": "Invalid request: %s" % str(e)})
+            return
+        future = self.server.submit(request)
+        if future is None:
+            self._send(503, {"error": "Too many requests queued - try again later"}, {"Retry-After": "1"})
+            return
+        try:
+            results = future.result()
+        except Exception as e:
+            self._send(422, {"error": str(e)})
+            return
+        if not request["profile"]:
+            del results["profile"]
+        self._send(200, results)
+
+    def _send(self, status, body, headers=None):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        if not self.server.quiet:
+            super().log_message(format, *args)
+
+
+def _parse_request(body):
+    """Checks a request's JSON body, and converts it into the form passed to the workers"""
+    if not isinstance(body, dict):
+        raise ValueError("the request must be a JSON object")
+    unknown = set(body) - set(REQUEST_PARAMS) - set(REQUEST_INPUTS) - {name + "_pcm" for name in REQUEST_INPUTS} - {"profile"}
+    if unknown:
+        raise ValueError("unknown parameters: %s" % ", ".join(sorted(unknown)))
+    request = {"params": {name: body.get(name, default) for name, default in REQUEST_PARAMS.items()}}
+    for name in REQUEST_INPUTS:
+        if name in body:
+            request[name] = ("path", str(body[name]))
+        elif name + "_pcm" in body:
+            request[name] = ("pcm", base64.b64decode(body[name + "_pcm"], validate=True))
+        else:
+            raise ValueError("either %s or %s_pcm is required" % (name, name))
+    request["profile"] = bool(body.get("profile", False))
+    return request
+
+
+# The state of each worker process, set up by _init_worker()
+_worker = {}
+
+
+def _init_worker(reference_cache_size, cache):
+    from . import audio_offset_finder
+
+    _worker["references"] = OrderedDict()
+    _worker["reference_cache_size"] = reference_cache_size
+    _worker["cache"] = cache
+    _worker["module"] = audio_offset_finder
+
+
+def _warm_up():
+    # Calculate some MFCCs, so that the mel filterbank etc. for the default parameters are ready for the first request
+    import numpy as np
+
+    _worker["module"].mfcc(np.zeros(REQUEST_PARAMS["fs"], dtype=np.float32), fs=REQUEST_PARAMS["fs"], numcep=26)
+
+
+def _align(request, submitted):
+    """Runs in a worker process to find the offset for one request"""
+    module = _worker["module"]
+    started = time.time()
+    params = request["params"]
+    profiler = module._Profiler()
+    mfcc1 = _reference_features(request["within"], params, profiler)
+    mfcc2 = _input_features(request["find_offset_of"], params, profiler, "2")
+    time_scale = params["hop_length"] / params["fs"]
+    results = module._find_offset_between_features(
+        mfcc1,
+        mfcc2,
+        params["fs"],
+        params["hop_length"],
+        params["max_frames"],
+        "fft",
+        params["coarse_factor"],
+        params["top_k"],
+        lag_range=module._search_lag_range(params["expected_offset"], params["max_offset"], time_scale),
+        profiler=profiler,
+    )
+    profile = profiler.finish(results, True, None)["profile"]
+    profile["stage_seconds"]["queue"] = max(0.0, started - submitted)
+    return {"time_offset": results["time_offset"], "standard_score": results["standard_score"], "profile": profile}
+
+
+def _reference_features(source, params, profiler):
+    """Returns the MFCCs of a reference, from the worker's in-memory cache if possible"""
+    kind, value = source
+    if kind == "path":
+        stat = os.stat(value)
+        key = (kind, os.path.abspath(value), stat.st_mtime_ns, stat.st_size)
+    else:
+        key = (kind, hashlib.sha256(value).hexdigest())
+    key += tuple(params[name] for name in FEATURE_PARAMS)
+    references = _worker["references"]
+    if key in references:
+        references.move_to_end(key)
+        profiler.metrics["cache_hits"]["1"] = True
+        return references[key]
+    features = _input_features(source, params, profiler, "1")
+    references[key] = features
+    while len(references) > _worker["reference_cache_size"]:
+        references.popitem(last=False)
+    return features
+
+
+def _input_features(source, params, profiler, label):
+    """Returns the MFCCs of a file or of uploaded PCM"""
+    import numpy as np
+
+    module = _worker["module"]
+    fs, trim, hop_length, win_length, nfft = (params[name] for name in FEATURE_PARAMS)
+    kind, value = source
+    if kind == "path":
+        return module._file_features(
+            value, fs, trim, hop_length, win_length, nfft, "pipe", _worker["cache"], None, profiler, label
+        )
+    profiler.metrics["cache_hits"][label] = False
+    samples = np.frombuffer(value[: len(value) - len(value) % 2], dtype="<i2")
+    if trim:
+        samples = samples[: int(trim * fs)]
+    profiler.metrics["decoded_samples"][label] = len(samples)
+    return module._features(samples.astype(np.float32), fs, hop_length, win_length, nfft, profiler, label)
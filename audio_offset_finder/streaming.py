@@ -0,0 +1,180 @@
+# audio-offset-finder
+#
+# Copyright (c) 2014-24 British Broadcasting Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from .audio_offset_finder import (
+    std_mfcc,
+    _batched_lagged_dot_products,
+    _dct_matrix,
+    _features,
+    _mel_power_spectrogram,
+    _power_to_db,
+    _signal_spectrum,
+    _standard_score,
+)
+import numpy as np
+
+
+class StreamingOffsetFinder:
+    """Finds the offset of a live audio stream within a reference recording, as the stream arrives.
+
+    Audio from the stream is supplied in chunks of any size using push().  The mel spectrum of each frame is calculated
+    as soon as enough audio has arrived for it, with the remainder carried over to the next chunk.  Only the most recent
+    max_frames frames of the stream are kept, and their MFCCs are correlated against the reference (whose spectrum is
+    only calculated once) every update_interval frames, so memory use stays bounded however long the stream runs.  The
+    80dB dynamic range limit is applied relative to the loudest point of the stream so far, so the MFCCs are the same
+    as mfcc() would calculate for the whole of the stream so far.
+
+    Parameters
+    ----------
+    reference: numpy array
+        The reference audio buffer
+    fs: int
+        The sampling rate of the reference and the stream, in Hz
+    hop_length: int
+        The number of samples to skip between each calculated MFCC frame
+    win_length: int
+        The length of the window function used to avoid transients adding spurious high frequencies to the MFCCs
+    nfft: int
+        The number of samples to use in the FFTs used to generate the MFCCs
+    max_frames: int
+        The maximum number of recent MFCC frames of the stream to correlate against the reference.  (No more than a
+        third of the number of frames in the reference are used.)
+    min_frames: int
+        The number of MFCC frames of the stream that must arrive before the first estimate is made
+    update_interval: int
+        The number of new MFCC frames of the stream that must arrive before each subsequent estimate is made
+    dtype: numpy dtype
+        The floating-point type used for the MFCCs and the cross-correlation
+    """
+
+    def __init__(
+        self,
+        reference,
+        fs,
+        hop_length=128,
+        win_length=256,
+        nfft=512,
+        max_frames=2000,
+        min_frames=500,
+        update_interval=50,
+        dtype=np.float32,
+    ):
+        if min_frames > max_frames:
+            raise ValueError("min_frames (%d) cannot be greater than max_frames (%d)" % (min_frames, max_frames))
+        self.fs = fs
+        self.hop_length = hop_length
+        self.win_length = win_length
+        self.nfft = nfft
+        self.min_frames = min_frames
+        self.update_interval = update_interval
+        self.dtype = dtype
+        self.latest_estimate = None
+
+        self._reference = _features(np.asarray(reference, dtype=dtype), fs, hop_length, win_length, nfft)
+        # As in find_offset_between_buffers(), correlate no more than a third of the length of the reference
+        self.max_frames = min(max_frames, len(self._reference) // 3)
+        if self.min_frames > self.max_frames:
+            raise ValueError("The reference is too short to find the offset of %d frames within it" % min_frames)
+        self._reference_spectrum = _signal_spectrum(self._reference, self.max_frames)
+
+        # Pad the start of the stream in the same way as librosa does, so that stream frame i is centred on sample
+        # i * hop_length just as reference frame i is
+        self._pending = np.zeros(nfft // 2, dtype=dtype)
+        # The mel spectra of the most recent frames in dB, and the loudest point of the whole stream so far
+        self._spectra = None
+        self._max_db = -np.inf
+        self._total_frames = 0
+        self._frames_since_estimate = 0
+
+    def push(self, samples):
+        """Adds a chunk of audio from the stream.
+
+        Parameters
+        ----------
+        samples: numpy array
+            The next PCM samples of the stream, at the sampling rate given to the constructor
+
+        Returns
+        -------
+        A dict containing a new estimate (see estimate()) if one was made, or None otherwise.
+        """
+        self._pending = np.concatenate((self._pending, np.asarray(samples, dtype=self.dtype)))
+        if len(self._pending) < self.nfft:
+            return None
+
+        # Calculate the spectra of every complete frame, and carry over the samples needed for the next frame
+        nframes = 1 + (len(self._pending) - self.nfft) // self.hop_length
+        new_spectra = _power_to_db(
+            _mel_power_spectrogram(
+                self._pending[: (nframes - 1) * self.hop_length + self.nfft],
+                self.fs,
+                self.nfft,
+                self.win_length,
+                self.hop_length,
+            )
+        )
+        self._max_db = max(self._max_db, new_spectra.max())
+        self._pending = self._pending[nframes * self.hop_length :]
+        if self._spectra is not None:
+            new_spectra = np.concatenate((self._spectra, new_spectra))
+        self._spectra = new_spectra[-self.max_frames :]
+        self._total_frames += nframes
+        self._frames_since_estimate += nframes
+
+        if len(self._spectra) < self.min_frames:
+            return None
+        if self.latest_estimate is not None and self._frames_since_estimate < self.update_interval:
+            return None
+        return self.estimate()
+
+    def estimate(self):
+        """Estimates the offset of the stream within the reference, using the most recent frames of the stream.
+
+        Returns
+        -------
+        A dict containing the following:
+        time_offset (float): the most likely offset of the start of the stream compared to the start of the reference,
+                             in seconds.  A positive value indicates that the stream starts after the reference.
+        frame_offset (int): the same offset, measured in MFCC frames
+        standard_score (float): the standard score of the highest correlation coefficient in the cross-correlation curve
+        reference_time (float): the position in the reference that matches the most recent audio from the stream
+        stream_time (float): the amount of audio from the stream that has been analysed, in seconds
+        """
+        window = std_mfcc(self._mfcc())
+        c = np.linalg.norm(
+            next(_batched_lagged_dot_products(self._reference, window[None], signal_spectrum=self._reference_spectrum)),
+            axis=1,
+        )
+        # c[j] is the coefficient for the start of the window being aligned with reference frame j
+        window_start = self._total_frames - len(window)
+        max_index = int(np.argmax(c))
+        score = _standard_score(c, max_index)
+
+        time_scale = self.hop_length / self.fs
+        self._frames_since_estimate = 0
+        self.latest_estimate = {
+            "time_offset": (max_index - window_start) * time_scale,
+            "frame_offset": max_index - window_start,
+            "standard_score": score,
+            "reference_time": (max_index + len(window)) * time_scale,
+            "stream_time": self._total_frames * time_scale,
+        }
+        return self.latest_estimate
+
+    def _mfcc(self):
+        """Returns the MFCCs of the most recent frames of the stream"""
+        S_db = np.maximum(self._spectra, self._max_db - 80.0)
+        return S_db @ _dct_matrix(self._reference.shape[1], S_db.shape[1], S_db.dtype).T
@@ -0,0 +1,251 @@
+# audio-offset-finder
+#
+# Copyright (c) 2014-24 British Broadcasting Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Benchmarks for the stages of audio-offset-finder's processing pipeline.
+
+Synthetic audio files of the requested lengths are generated, and then the time taken (and peak memory used) by each
+stage - decoding, MFCC calculation, standardisation and cross-correlation - is measured separately for every
+combination of the parameters given.  The results are written out as JSON, and results from two runs (e.g. from two
+commits) can be compared with --compare.
+
+    $ python benchmarks/run_benchmarks.py --durations 60,600 --sr 8000 --hop 128,64 --output new.json
+    $ python benchmarks/run_benchmarks.py --compare old.json new.json
+"""
+
+import argparse
+import datetime
+import itertools
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import wave
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from audio_offset_finder import audio_offset_finder as aof  # noqa: E402
+
+SOURCE_SAMPLE_RATE = 16000
+
+
+def write_synthetic_audio(path, duration, seed, fs=SOURCE_SAMPLE_RATE, block_seconds=60):
+    """Writes a mono 16-bit WAV file of noise-like audio with a slowly varying spectrum, one block at a time"""
+    rng = np.random.default_rng(seed)
+    with wave.open(path, "wb") as wav_file:
+        wav_file.setnchannels(1)
+        wav_file.setsampwidth(2)
+        wav_file.setframerate(fs)
+        for start in range(0, int(duration * fs), block_seconds * fs):
+            nsamples = min(block_seconds * fs, int(duration * fs) - start)
+            t = (start + np.arange(nsamples)) / fs
+            # Tones that glide and pulse at different rates, over a bed of noise, so that every moment is distinctive
+            audio = 0.1 * rng.standard_normal(nsamples)
+            for k in range(1, 6):
+                frequency = 200 * k + 150 * np.sin(2 * np.pi * t / (7.3 * k))
+                envelope = 0.5 + 0.5 * np.sin(2 * np.pi * t / (0.37 * k + 0.2))
+                audio += 0.15 * envelope * np.sin(2 * np.pi * np.cumsum(frequency) / fs)
+            wav_file.writeframes((np.clip(audio, -1, 1) * 32767).astype("<i2").tobytes())
+
+
+def extract_clip(source, path, offset, duration):
+    """Copies a section of a WAV file into another one"""
+    with wave.open(source, "rb") as source_file, wave.open(path, "wb") as clip_file:
+        clip_file.setparams(source_file.getparams())
+        source_file.setpos(int(offset * source_file.getframerate()))
+        clip_file.writeframes(source_file.readframes(int(duration * source_file.getframerate())))
+
+
+def measure(function, repeat, *args, **kwargs):
+    """Runs a function repeat times to find its best time, then once more to find its peak Python heap allocation.
+
+    Returns the function's result, the best time in seconds and the peak allocation in bytes.
+    """
+    best_time = np.inf
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function(*args, **kwargs)
+        best_time = min(best_time, time.perf_counter() - start)
+        del result
+    tracemalloc.start()
+    try:
+        result = function(*args, **kwargs)
+        peak_memory = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return result, best_time, peak_memory
+
+
+def convert_and_read(afile, fs):
+    """The temporary file decoding route, as used by find_offset_between_files(..., decoder="file")"""
+    return aof._load_audio(afile, fs, None, "file")
+
+
+def benchmark(reference, clip, duration, fs, hop_length, max_frames, engines, repeat):
+    """Yields results for each stage of processing a reference file and a clip with the given parameters"""
+    parameters = {"duration": duration, "fs": fs, "hop_length": hop_length, "max_frames": max_frames}
+
+    def record(stage, seconds, peak_memory, **extra):
+        results = dict(parameters, stage=stage, seconds=seconds, peak_memory_bytes=peak_memory, **extra)
+        print(json.dumps(results), file=sys.stderr)
+        return results
+
+    _, seconds, memory = measure(convert_and_read, repeat, reference, fs)
+    yield record("convert_and_trim", seconds, memory)
+    audio, seconds, memory = measure(aof.decode_audio, repeat, reference, fs)
+    yield record("decode_audio", seconds, memory, samples=len(audio))
+    audio = audio.astype(np.float32)
+    clip_audio = aof.decode_audio(clip, fs).astype(np.float32)
+
+    mfcc_args = dict(win_length=256, nfft=512, fs=fs, hop_length=hop_length, numcep=26)
+    # The first MFCC calculation includes one-off costs (e.g. JIT compilation), which aren't what we want to measure
+    aof.mfcc(clip_audio[:fs], **mfcc_args)
+    mfcc1, seconds, memory = measure(lambda: aof.mfcc(audio, **mfcc_args)[0], repeat)
+    yield record("mfcc", seconds, memory, frames=len(mfcc1))
+    mfcc1, seconds, memory = measure(aof.std_mfcc, repeat, mfcc1)
+    yield record("std_mfcc", seconds, memory)
+    del audio
+
+    mfcc2 = aof.std_mfcc(aof.mfcc(clip_audio, **mfcc_args)[0])
+    nframes = aof._correl_nframes(mfcc1, mfcc2, max_frames)
+    for engine in engines:
+        # Likewise, leave each engine's one-off costs (e.g. planning FFTs or loading libraries) out of its timings
+        aof.cross_correlation(mfcc1, mfcc2, nframes, engine=engine)
+        (c, _, _), seconds, memory = measure(aof.cross_correlation, repeat, mfcc1, mfcc2, nframes, engine=engine)
+        yield record("cross_correlation", seconds, memory, engine=engine, lags=len(c))
+
+
+def metadata():
+    """Describes the code and environment that the benchmarks were run with"""
+    import librosa
+    import scipy
+
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__))
+        ).stdout.strip()
+    except OSError:
+        commit = None
+    return {
+        "commit": commit or None,
+        "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "platform": platform.platform(),
+        "processor": platform.processor(),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "scipy": scipy.__version__,
+        "librosa": librosa.__version__,
+    }
+
+
+def compare(old_path, new_path):
+    """Prints the ratio of new to old times and memory use for every benchmark present in both sets of results"""
+    with open(old_path) as old_file, open(new_path) as new_file:
+        old, new = json.load(old_file), json.load(new_file)
+
+    def key(results):
+        return tuple(results.get(k) for k in ("duration", "fs", "hop_length", "max_frames", "stage", "engine"))
+
+    old_results = {key(results): results for results in old["results"]}
+    print("%-60s %10s %10s %8s %8s" % ("benchmark", "old time", "new time", "time", "memory"))
+    for results in new["results"]:
+        if key(results) not in old_results:
+            continue
+        previous = old_results[key(results)]
+        name = "%s %ss fs=%s hop=%s frames=%s %s" % (
+            results["stage"],
+            results["duration"],
+            results["fs"],
+            results["hop_length"],
+            results["max_frames"],
+            results.get("engine") or "",
+        )
+        print(
+            "%-60s %9.3fs %9.3fs %7.2fx %7.2fx"
+            % (
+                name,
+                previous["seconds"],
+                results["seconds"],
+                results["seconds"] / previous["seconds"],
+                results["peak_memory_bytes"] / max(previous["peak_memory_bytes"], 1),
+            )
+        )
+
+
+def main(argv):
+    def numbers(text):
+        return [int(value) for value in text.split(",")]
+
+    parser = argparse.ArgumentParser(
+        description="Benchmark the stages of audio-offset-finder's processing pipeline",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument("--durations", type=numbers, default=[60, 600], help="Lengths of synthetic audio, in seconds")
+    parser.add_argument("--sr", type=numbers, default=[8000], help="Sample rates to resample to")
+    parser.add_argument("--hop", type=numbers, default=[128], help="Hop lengths (resolutions) in samples")
+    parser.add_argument("--max-frames", type=numbers, default=[2000], help="Maximum numbers of frames to correlate")
+    parser.add_argument("--engines", default="fft", help="Cross-correlation engines to benchmark (fft, loop)")
+    parser.add_argument("--clip-duration", type=int, default=60, help="Length of the clip to find, in seconds")
+    parser.add_argument("--repeat", type=int, default=1, help="Number of timed runs of each stage (the best is kept)")
+    parser.add_argument("--output", help="Write the results to this JSON file, rather than stdout")
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"), help="Compare two results files and exit")
+    args = parser.parse_args(argv)
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    all_results = []
+    with tempfile.TemporaryDirectory(prefix="offset_benchmark_") as temp_dir:
+        for duration in args.durations:
+            reference = os.path.join(temp_dir, "reference_%d.wav" % duration)
+            clip = os.path.join(temp_dir, "clip_%d.wav" % duration)
+            write_synthetic_audio(reference, duration, seed=duration)
+            clip_duration = min(args.clip_duration, duration / 3)
+            extract_clip(reference, clip, duration / 3, clip_duration)
+            for fs, hop_length, max_frames in itertools.product(args.sr, args.hop, args.max_frames):
+                all_results += benchmark(
+                    reference, clip, duration, fs, hop_length, max_frames, args.engines.split(","), args.repeat
+                )
+            os.remove(reference)
+            os.remove(clip)
+
+    # Peak resident memory of this process and its largest FFmpeg child, in bytes (ru_maxrss is in kB except on macOS)
+    peak_rss = None
+    try:
+        import resource
+
+        scale = 1 if sys.platform == "darwin" else 1024
+        peak_rss = {
+            "self": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale,
+            "children": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * scale,
+        }
+    except ImportError:
+        pass  # Not available on Windows
+
+    output = {"metadata": metadata(), "peak_rss_bytes": peak_rss, "results": all_results}
+    if args.output:
+        with open(args.output, "w") as output_file:
+            json.dump(output, output_file, indent=2)
+    else:
+        print(json.dumps(output, indent=2))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
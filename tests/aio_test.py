@@ -0,0 +1,184 @@
+# audio-offset-finder
+#
+# Copyright (c) 2014-24 British Broadcasting Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from audio_offset_finder import aio
+from audio_offset_finder.aio import AsyncOffsetFinder
+from audio_offset_finder.audio_offset_finder import decode_audio, find_offset_between_files
+from audio_offset_finder.cache import FeatureCache
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import numpy as np
+import os
+import pytest
+import tempfile
+from scipy.io import wavfile
+
+
+def path(test_file):
+    return os.path.abspath(os.path.join(os.path.dirname(__file__), "audio", test_file))
+
+
+def test_find_offset_between_files():
+    async def find_offsets():
+        finder = AsyncOffsetFinder()
+        return await asyncio.gather(
+            finder.find_offset_between_files(path("timbl_1.mp3"), path("timbl_2.mp3"), hop_length=160, trim=35, profile=True),
+            finder.find_offset_between_files(path("timbl_1.mp3"), path("timbl_3.mp3"), hop_length=160, decoder="file"),
+            finder.find_offset_between_files(
+                path("timbl_1.mp3"), path("timbl_2.mp3"), hop_length=160, expected_offset=10, max_offset=5
+            ),
+        )
+
+    results = asyncio.run(find_offsets())
+    expected = find_offset_between_files(path("timbl_1.mp3"), path("timbl_2.mp3"), hop_length=160, trim=35)
+    assert results[0]["time_offset"] == expected["time_offset"]
+    assert results[0]["standard_score"] == pytest.approx(expected["standard_score"])
+    np.testing.assert_array_equal(results[0]["correlation"], expected["correlation"])
+    profile = results[0]["profile"]
+    assert set(profile["stage_seconds"]) == {"decode_1", "mfcc_1", "standardise_1", "decode_2", "mfcc_2"} | {
+        "standardise_2",
+        "correlation",
+        "total",
+    }
+    assert profile["mfcc_frames"] == {"1": 1751, "2": 1751}
+    assert profile["lags_evaluated"] == len(results[0]["correlation"])
+    assert results[1]["time_offset"] == pytest.approx(12.24)
+    assert results[2]["time_offset"] == pytest.approx(12.26)
+    assert results[2]["earliest_frame_offset"] == 250
+
+    with pytest.raises(Exception) as exception:
+        asyncio.run(AsyncOffsetFinder().find_offset_between_files(path("timbl_1.mp3"), path("dummy.mp3")))
+    assert exception.value.args[0].startswith("FFMpeg failed:\n")
+
+
+def test_find_offset_between_buffers():
+    audio1 = decode_audio(path("timbl_1.mp3"), 8000)
+    audio2 = decode_audio(path("timbl_2.mp3"), 8000)
+    np.testing.assert_array_equal(asyncio.run(aio.decode_audio(path("timbl_1.mp3"), 8000)), audio1)
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        finder = AsyncOffsetFinder(executor=executor)
+        results = asyncio.run(
+            finder.find_offset_between_buffers(audio1.astype(float), audio2.astype(float), 8000, hop_length=160)
+        )
+    assert results["time_offset"] == pytest.approx(12.26)
+
+
+def test_max_concurrent():
+    async def find_offsets(finder):
+        searches = [
+            finder.find_offset_between_files(path("timbl_1.mp3"), path("timbl_2.mp3"), hop_length=160, trim=20, profile=True)
+            for _ in range(3)
+        ]
+        ends = []
+
+        async def search(coroutine):
+            results = await coroutine
+            ends.append(asyncio.get_running_loop().time())
+            return results
+
+        results = await asyncio.gather(*(search(coroutine) for coroutine in searches))
+        return results, ends
+
+    # The finder can be created outside the event loop, and used from more than one
+    finder = AsyncOffsetFinder(max_concurrent=1)
+    for _ in range(2):
+        results, ends = asyncio.run(find_offsets(finder))
+        # Each search starts timing once it is allowed to run, so its start is its end less its total time
+        intervals = sorted((end - results["profile"]["stage_seconds"]["total"], end) for results, end in zip(results, ends))
+        for (_, end), (start, _) in zip(intervals, intervals[1:]):
+            assert start >= end - 0.01
+
+
+def test_cache_and_chunk_frames():
+    with tempfile.TemporaryDirectory() as temp_dir:
+        cache = FeatureCache(temp_dir)
+        finder = AsyncOffsetFinder()
+        expected = find_offset_between_files(path("timbl_1.mp3"), path("timbl_2.mp3"), hop_length=160, trim=35)
+        for chunk_frames in (None, 300):
+            results = asyncio.run(
+                finder.find_offset_between_files(
+                    path("timbl_1.mp3"), path("timbl_2.mp3"), hop_length=160, trim=35, chunk_frames=chunk_frames, profile=True
+                )
+            )
+            assert results["time_offset"] == expected["time_offset"]
+            assert results["profile"]["mfcc_frames"] == {"1": 1751, "2": 1751}
+
+        args = (path("timbl_1.mp3"), path("timbl_2.mp3"))
+        kwargs = dict(hop_length=160, trim=35, cache=cache, profile=True)
+        results = asyncio.run(finder.find_offset_between_files(*args, **kwargs))
+        assert results["profile"]["cache_hits"] == {"1": False, "2": False}
+        results = asyncio.run(finder.find_offset_between_files(*args, **kwargs))
+        assert results["profile"]["cache_hits"] == {"1": True, "2": True}
+        assert results["time_offset"] == expected["time_offset"]
+
+
+def test_min_score():
+    audio1 = decode_audio(path("timbl_1.mp3"), 8000).astype(float)
+    long_audio1 = np.concatenate((audio1, 300 * np.random.default_rng(3).standard_normal(8000 * 600)))
+    with tempfile.TemporaryDirectory() as temp_dir:
+        long_file = os.path.join(temp_dir, "long.wav")
+        wavfile.write(long_file, 8000, long_audio1.astype(np.int16))
+        finder = AsyncOffsetFinder()
+        kwargs = dict(hop_length=160, max_frames=500, profile=True)
+        results = asyncio.run(finder.find_offset_between_files(long_file, path("timbl_2.mp3"), min_score=10, **kwargs))
+        expected = find_offset_between_files(long_file, path("timbl_2.mp3"), min_score=10, **kwargs)
+        assert results["time_offset"] == pytest.approx(12.26)
+        assert results["profile"]["decoded_samples"] == expected["profile"]["decoded_samples"]
+        assert results["profile"]["decoded_samples"]["1"] < len(long_audio1) / 10
+
+    # If the score is never reached, the whole of both files is searched
+    results = asyncio.run(
+        finder.find_offset_between_files(path("timbl_1.mp3"), path("timbl_2.mp3"), hop_length=160, trim=35, min_score=1000)
+    )
+    expected = find_offset_between_files(path("timbl_1.mp3"), path("timbl_2.mp3"), hop_length=160, trim=35)
+    assert results["time_offset"] == expected["time_offset"]
+    assert results["standard_score"] == pytest.approx(expected["standard_score"])
+
+    with pytest.raises(ValueError):
+        asyncio.run(finder.find_offset_between_files(path("timbl_1.mp3"), path("timbl_2.mp3"), min_score=10, max_offset=5))
+
+
+@pytest.mark.skipif(not hasattr(os, "mkfifo"), reason="needs named pipes")
+def test_cancellation(monkeypatch):
+    processes = []
+    create_subprocess_exec = asyncio.create_subprocess_exec
+
+    async def record_process(*args, **kwargs):
+        processes.append(await create_subprocess_exec(*args, **kwargs))
+        return processes[-1]
+
+    monkeypatch.setattr(asyncio, "create_subprocess_exec", record_process)
+
+    async def cancel(coroutine):
+        task = asyncio.ensure_future(coroutine)
+        await asyncio.sleep(0.5)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        # FFmpeg blocks opening a named pipe that nothing writes to, so it will still be running when cancelled
+        fifo = os.path.join(temp_dir, "input.wav")
+        os.mkfifo(fifo)
+        monkeypatch.setattr(tempfile, "tempdir", temp_dir)
+
+        asyncio.run(cancel(aio.decode_audio(fifo, 8000)))
+        asyncio.run(cancel(aio.convert_and_trim(fifo, 8000)))
+        asyncio.run(cancel(AsyncOffsetFinder().find_offset_between_files(path("timbl_1.mp3"), fifo)))
+        assert len(processes) == 4
+        assert all(process.returncode is not None for process in processes)
+        assert os.listdir(temp_dir) == ["input.wav"]  # The temporary WAV file has been deleted
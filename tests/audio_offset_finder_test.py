@@ -15,10 +15,22 @@
 # limitations under the License.
 
 import pytest
-from audio_offset_finder.audio_offset_finder import find_offset_between_files, std_mfcc, cross_correlation
-from audio_offset_finder.audio_offset_finder import InsufficientAudioException
+from audio_offset_finder.audio_offset_finder import (
+    find_offset_between_files,
+    find_offset_between_buffers,
+    std_mfcc,
+    cross_correlation,
+)
+from audio_offset_finder.audio_offset_finder import convert_and_trim, decode_audio, find_offsets_in_reference
+from audio_offset_finder.audio_offset_finder import mfcc, mfcc_chunked
+from scipy.io import wavfile
+from audio_offset_finder.audio_offset_finder import InsufficientAudioException, _find_offset_between_features
+from audio_offset_finder.audio_offset_finder import _correlation_for_lags, find_offset_timeline, _timeline_between_features
+from audio_offset_finder.audio_offset_finder import decode_tracks, find_track_offsets, align_set, _solve_timeline
 import numpy as np
 import os
+import subprocess
+import tempfile
 
 
 def path(test_file):
@@ -69,6 +81,11 @@ def test_find_offset_between_files():
     assert exception.value.args[0].startswith("FFMpeg failed:\n")
     assert exception.value.args[0].endswith("No such file or directory")
 
+    with pytest.raises(Exception) as exception:
+        find_offset_between_files(path("timbl_2.mp3"), path("dummy.mp3"), hop_length=160, trim=0.1)
+    assert exception.value.args[0].startswith("FFMpeg failed:\n")
+    assert "dummy.mp3" in exception.value.args[0]
+
     results = find_offset_between_files(path("r4.ogg"), path("r4_excerpt.ogg"), hop_length=128, trim=20 * 60)
     assert results["time_offset"] == pytest.approx(334.608)
     assert results["standard_score"] == pytest.approx(43.37, rel=1e-2)
@@ -107,3 +124,316 @@ def test_cross_correlation():
     assert np.argmax(c) == 0
     assert n_min == -1
     assert n_max == 2
+
+
+def test_cross_correlation_engines():
+    rng = np.random.default_rng(0)
+    m1 = std_mfcc(rng.standard_normal((500, 26)))
+    m2 = std_mfcc(rng.standard_normal((300, 26)))
+    for a, b in ((m1, m2), (m2, m1), (m1, m1)):
+        c_loop, n_min_loop, n_max_loop = cross_correlation(a, b, 100, engine="loop")
+        c_fft, n_min_fft, n_max_fft = cross_correlation(a, b, 100, engine="fft")
+        assert (n_min_fft, n_max_fft) == (n_min_loop, n_max_loop)
+        np.testing.assert_allclose(c_fft, c_loop, rtol=1e-9, atol=1e-9)
+        for start, stop in ((n_min_fft, n_max_fft), (-5, 3), (2, 10), (-10, -2), (0, 1)):
+            c_lags = _correlation_for_lags(a, b, 100, start, stop)
+            np.testing.assert_allclose(c_lags, c_loop[np.arange(start, stop)], rtol=1e-9, atol=1e-9)
+
+    with pytest.raises(ValueError):
+        cross_correlation(m1, m2, 100, engine="dummy")
+
+
+def test_decode_audio():
+    tmp = convert_and_trim(path("timbl_2.mp3"), 8000, trim=5)
+    expected = wavfile.read(tmp)[1]
+    os.remove(tmp)
+    decoded = decode_audio(path("timbl_2.mp3"), 8000, trim=5)
+    assert decoded.dtype == np.int16
+    np.testing.assert_array_equal(decoded, expected)
+
+    decoded = decode_audio(path("timbl_2.mp3"), 8000, trim=5, sample_format="f32le")
+    assert decoded.dtype == np.float32
+    assert len(decoded) == len(expected)
+
+    assert len(decode_audio(path("timbl_2.mp3"), 8000)) > len(expected)
+
+    with pytest.raises(Exception) as exception:
+        decode_audio(path("dummy.mp3"), 8000)
+    assert exception.value.args[0].startswith("FFMpeg failed:\n")
+
+
+def test_find_offset_between_files_decoders():
+    pipe_results = find_offset_between_files(path("timbl_1.mp3"), path("timbl_2.mp3"), hop_length=160, trim=35)
+    file_results = find_offset_between_files(path("timbl_1.mp3"), path("timbl_2.mp3"), hop_length=160, trim=35, decoder="file")
+    assert pipe_results["time_offset"] == file_results["time_offset"]
+    assert pipe_results["standard_score"] == pytest.approx(file_results["standard_score"])
+
+
+def test_find_offsets_in_reference():
+    clips = [path("timbl_2.mp3"), path("timbl_3.mp3"), path("timbl_1.mp3"), path("dummy.mp3")]
+    results = find_offsets_in_reference(path("timbl_1.mp3"), clips, hop_length=160, trim=35, return_exceptions=True)
+    assert len(results) == 4
+    for clip, clip_results in zip(clips[:3], results):
+        expected = find_offset_between_files(path("timbl_1.mp3"), clip, hop_length=160, trim=35)
+        assert clip_results["time_offset"] == pytest.approx(expected["time_offset"])
+        assert clip_results["standard_score"] == pytest.approx(expected["standard_score"])
+        np.testing.assert_allclose(clip_results["correlation"], expected["correlation"], rtol=1e-5)
+    assert results[0]["time_offset"] == pytest.approx(12.26)
+    assert isinstance(results[3], Exception)
+
+    results = find_offsets_in_reference(path("timbl_1.mp3"), clips[:2], hop_length=160, trim=35, engine="loop")
+    assert results[1]["time_offset"] == pytest.approx(12.24)
+
+    with pytest.raises(Exception) as exception:
+        find_offsets_in_reference(path("timbl_1.mp3"), clips, hop_length=160, trim=35)
+    assert exception.value.args[0].startswith("FFMpeg failed:\n")
+
+
+def test_coarse_to_fine():
+    # MFCCs change smoothly from frame to frame, so smooth random features over time to make them similar
+    rng = np.random.default_rng(1)
+    m1 = np.cumsum(rng.standard_normal((4008, 26)), axis=0)
+    m1 = std_mfcc(m1[8:] - m1[:-8])
+    for offset in (1234, -321):
+        if offset > 0:
+            m2 = m1[offset : offset + 900] + 0.5 * rng.standard_normal((900, 26))
+            results = _find_offset_between_features(m1, m2, 8000, 128, 2000, "fft", coarse_factor=4)
+        else:
+            m2 = np.concatenate((rng.standard_normal((-offset, 26)), m1))
+            results = _find_offset_between_features(m1[:1500], m2, 8000, 128, 400, "fft", coarse_factor=4, top_k=2)
+        assert results["time_offset"] == pytest.approx(offset * 128 / 8000)
+        assert results["time_scale"] == pytest.approx(4 * 128 / 8000)
+        assert results["frame_offset"] == pytest.approx(offset / 4, abs=1)
+        assert 1 <= len(results["refined_candidates"]) <= 3
+
+    results = find_offset_between_files(path("timbl_1.mp3"), path("timbl_2.mp3"), hop_length=40, trim=35, coarse_factor=4)
+    assert results["time_offset"] == pytest.approx(12.26, abs=0.01)
+    assert len(results["refined_candidates"]) == 3
+
+
+def test_mfcc_backends():
+    audio = decode_audio(path("timbl_1.mp3"), 8000)
+    for dtype in (np.float32, np.float64):
+        for center in (True, False):
+            expected = mfcc(audio.astype(dtype), fs=8000, numcep=26, center=center, backend="librosa")[0]
+            features = mfcc(audio.astype(dtype), fs=8000, numcep=26, center=center)[0]
+            assert features.dtype == dtype
+            np.testing.assert_allclose(features, expected, rtol=1e-4, atol=1e-3)
+    np.testing.assert_allclose(
+        mfcc(audio[:20000].astype(float), win_length=400, nfft=1024, fs=16000, hop_length=160)[0],
+        mfcc(audio[:20000].astype(float), win_length=400, nfft=1024, fs=16000, hop_length=160, backend="librosa")[0],
+        rtol=1e-6,
+        atol=1e-6,
+    )
+
+    with pytest.raises(ValueError):
+        mfcc(audio, fs=8000)
+    with pytest.raises(ValueError):
+        mfcc(audio.astype(float), fs=8000, backend="unknown")
+
+
+def test_mfcc_chunked():
+    audio = decode_audio(path("timbl_1.mp3"), 8000)
+    expected = mfcc(audio.astype(np.float32), fs=8000, numcep=26)[0]
+    for chunk_frames in (1, 333, 5000):
+        np.testing.assert_array_equal(mfcc_chunked(audio, fs=8000, numcep=26, chunk_frames=chunk_frames), expected)
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        out = np.lib.format.open_memmap(os.path.join(temp_dir, "mfcc.npy"), "w+", np.float32, expected.shape)
+        assert mfcc_chunked(audio, fs=8000, numcep=26, chunk_frames=1000, out=out) is out
+        np.testing.assert_array_equal(out, expected)
+        del out
+    with pytest.raises(ValueError):
+        mfcc_chunked(audio, fs=8000, numcep=26, out=np.empty((10, 26)))
+
+    results = find_offset_between_files(path("timbl_1.mp3"), path("timbl_2.mp3"), hop_length=160, trim=35)
+    chunked_results = find_offset_between_files(
+        path("timbl_1.mp3"), path("timbl_2.mp3"), hop_length=160, trim=35, chunk_frames=500
+    )
+    assert chunked_results["time_offset"] == results["time_offset"]
+    np.testing.assert_allclose(chunked_results["correlation"], results["correlation"], rtol=1e-4)
+
+
+def test_find_offset_timeline():
+    # Resample smoothed random features so that the second drifts by one frame every 500 frames against the first
+    rng = np.random.default_rng(2)
+    m1 = np.cumsum(rng.standard_normal((6008, 26)), axis=0)
+    m1 = std_mfcc(m1[8:] - m1[:-8])
+    m2 = m1[np.round(300 + np.arange(5000) * 1.002).astype(int)]
+    results = _timeline_between_features(m1, m2, 500, 250, 0.016)
+    assert len(results["windows"]) == 19
+    assert results["windows"][0]["position"] == pytest.approx(250 * 0.016)
+    for window in results["windows"]:
+        assert window["time_offset"] == pytest.approx((300 + 0.002 * window["position"] / 0.016) * 0.016, abs=0.02)
+    assert results["drift"] == pytest.approx(0.002, abs=2e-4)
+    assert results["intercept"] == pytest.approx(300 * 0.016, abs=0.02)
+
+    # Windows from an unrelated tail of m2 don't match m1, so they're left out of the fit
+    tail = np.cumsum(np.random.default_rng(5).standard_normal((1508, 26)), axis=0)
+    results = _timeline_between_features(m1, np.concatenate((m2, std_mfcc(tail[8:] - tail[:-8]))), 500, 250, 0.016)
+    assert len(results["windows"]) == 25
+    assert min(window["standard_score"] for window in results["windows"][20:]) < 10
+    assert results["drift"] == pytest.approx(0.002, abs=2e-4)
+    assert results["intercept"] == pytest.approx(300 * 0.016, abs=0.02)
+    results = _timeline_between_features(m1, m2, 500, 250, 0.016, min_score=1000)
+    assert results["drift"] is None and results["intercept"] is None
+
+    # Limiting the search to offsets near the start of m1 should leave it unable to find the true offsets
+    results = _timeline_between_features(m1, m2, 500, 250, 0.016, lag_range=(-10, 10))
+    assert all(abs(window["time_offset"]) <= 10 * 0.016 for window in results["windows"])
+    # A range around the true offsets finds the same offsets as the full search
+    full = _timeline_between_features(m1, m2, 500, 250, 0.016)
+    results = _timeline_between_features(m1, m2, 500, 250, 0.016, lag_range=(250, 400))
+    assert [w["time_offset"] for w in results["windows"]] == pytest.approx([w["time_offset"] for w in full["windows"]])
+
+    results = find_offset_timeline(path("timbl_1.mp3"), path("timbl_2.mp3"), window=10, stride=5, hop_length=160)
+    assert [window["time_offset"] for window in results["windows"]] == pytest.approx([12.26] * 6)
+
+    with pytest.raises(InsufficientAudioException):
+        find_offset_timeline(path("timbl_1.mp3"), path("timbl_2.mp3"), window=60, hop_length=160)
+
+
+def test_profile():
+    audio1 = decode_audio(path("timbl_1.mp3"), 8000).astype(float)
+    audio2 = decode_audio(path("timbl_2.mp3"), 8000).astype(float)
+    metrics = []
+    results = find_offset_between_buffers(audio1, audio2, 8000, hop_length=160, on_metrics=metrics.append)
+    assert "profile" not in results
+    assert len(metrics) == 1
+    assert metrics[0]["decoded_samples"] == {"1": len(audio1), "2": len(audio2)}
+    assert metrics[0]["lags_evaluated"] == len(results["correlation"])
+    assert metrics[0]["peak_array_bytes"] == 4 * max(len(audio1), len(audio2))  # float32 samples
+
+    results = find_offset_between_files(
+        path("timbl_1.mp3"), path("timbl_2.mp3"), hop_length=40, trim=35, coarse_factor=4, profile=True
+    )
+    profile = results["profile"]
+    assert profile["mfcc_frames"] == {"1": 7001, "2": 7001}
+    assert profile["lags_evaluated"] > len(results["correlation"])
+    assert profile["stage_seconds"]["total"] >= profile["stage_seconds"]["correlation"] > 0
+
+
+def test_bounded_search():
+    results = find_offset_between_files(
+        path("timbl_1.mp3"), path("timbl_2.mp3"), hop_length=160, expected_offset=10, max_offset=5
+    )
+    assert results["time_offset"] == pytest.approx(12.26)
+    assert results["earliest_frame_offset"] == 250
+    assert results["latest_frame_offset"] == 751
+    assert len(results["correlation"]) == 501
+    assert np.argmax(results["correlation"]) == results["frame_offset"] % 501
+
+    results = find_offset_between_files(path("timbl_2.mp3"), path("timbl_1.mp3"), hop_length=160, max_offset=15)
+    assert results["time_offset"] == pytest.approx(-12.26)
+
+    results = find_offset_between_files(
+        path("timbl_1.mp3"), path("timbl_2.mp3"), hop_length=40, expected_offset=12, max_offset=2, coarse_factor=4
+    )
+    assert results["time_offset"] == pytest.approx(12.26, abs=0.01)
+
+    audio1 = decode_audio(path("timbl_1.mp3"), 8000).astype(float)
+    audio2 = decode_audio(path("timbl_2.mp3"), 8000).astype(float)
+    results = find_offset_between_buffers(audio1, audio2, 8000, hop_length=160, expected_offset=12, max_offset=3)
+    assert results["time_offset"] == pytest.approx(12.26)
+    assert results["earliest_frame_offset"] == 450
+
+    with pytest.raises(ValueError):
+        find_offset_between_buffers(audio1, audio2, 8000, hop_length=160, expected_offset=12)
+    with pytest.raises(InsufficientAudioException):
+        find_offset_between_files(path("timbl_1.mp3"), path("timbl_2.mp3"), trim=35, expected_offset=100, max_offset=5)
+
+
+def test_find_track_offsets():
+    with tempfile.TemporaryDirectory() as temp_dir:
+        # A file with two stereo audio streams, the first containing timbl_1.mp3 and the second timbl_2.mp3
+        multitrack = os.path.join(temp_dir, "multitrack.mkv")
+        subprocess.run(
+            ["ffmpeg", "-loglevel", "error", "-i", path("timbl_1.mp3"), "-i", path("timbl_2.mp3")]
+            + ["-map", "0:a", "-map", "1:a", "-ac", "2", "-c:a", "flac", multitrack],
+            check=True,
+        )
+
+        tracks = decode_tracks(multitrack, 8000, trim=5, streams=[1, 0])
+        assert tracks.shape == (2, 40000)
+        assert tracks.dtype == np.int16
+        np.testing.assert_allclose(tracks[0], decode_audio(path("timbl_2.mp3"), 8000, trim=5), atol=2)
+        assert decode_tracks(multitrack, 8000, trim=5, streams=[0, 1], channels=True).shape == (4, 40000)
+        assert decode_tracks(multitrack, 8000, trim=5, sample_format="f32le").dtype == np.float32
+
+        # The MFCCs of several channels are calculated together, but are the same as those of each channel alone
+        features = mfcc(tracks.astype(np.float32), fs=8000, numcep=26)
+        assert len(features) == 2
+        for track, track_features in zip(tracks, features):
+            np.testing.assert_array_equal(track_features, mfcc(track.astype(np.float32), fs=8000, numcep=26)[0])
+
+        results = find_track_offsets(path("timbl_1.mp3"), multitrack, streams=[0, 1], hop_length=160, trim=35)
+        assert [track_results["stream"] for track_results in results] == [0, 1]
+        assert [track_results["time_offset"] for track_results in results] == pytest.approx([0.0, 12.26])
+        expected = find_offset_between_files(path("timbl_1.mp3"), path("timbl_2.mp3"), hop_length=160, trim=35)
+        assert results[1]["standard_score"] == pytest.approx(expected["standard_score"], rel=1e-2)
+
+        results = find_track_offsets(path("timbl_1.mp3"), multitrack, streams=[1], channels=True, hop_length=160, trim=35)
+        assert [track_results["channel"] for track_results in results] == [0, 1]
+        assert [track_results["time_offset"] for track_results in results] == pytest.approx([12.26, 12.26])
+
+        with pytest.raises(Exception) as exception:
+            decode_tracks(multitrack, 8000, streams=[2])
+        assert exception.value.args[0].startswith("FFMpeg failed:\n")
+    with pytest.raises(ValueError):
+        decode_tracks(path("timbl_1.mp3"), 8000, streams=[])
+
+
+def test_min_score():
+    audio1 = decode_audio(path("timbl_1.mp3"), 8000).astype(float)
+    audio2 = decode_audio(path("timbl_2.mp3"), 8000).astype(float)
+    # Follow the speech with ten minutes of noise, which an exhaustive search would have to correlate against
+    long_audio1 = np.concatenate((audio1, 300 * np.random.default_rng(3).standard_normal(8000 * 600)))
+    results = find_offset_between_buffers(
+        long_audio1, audio2, 8000, hop_length=160, max_frames=500, min_score=10, profile=True
+    )
+    assert results["time_offset"] == pytest.approx(12.26)
+    assert results["standard_score"] >= 10
+    assert results["profile"]["decoded_samples"]["1"] == 4 * 500 * 160
+    assert results["profile"]["mfcc_frames"]["1"] < len(long_audio1) / 160 / 10
+
+    # If the score is never reached, the whole of both buffers is searched, giving the same results as usual
+    expected = find_offset_between_buffers(audio1, audio2, 8000, hop_length=160, max_frames=500)
+    results = find_offset_between_buffers(audio1, audio2, 8000, hop_length=160, max_frames=500, min_score=1000)
+    assert results["time_offset"] == expected["time_offset"]
+    assert results["standard_score"] == expected["standard_score"]
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        long_file = os.path.join(temp_dir, "long.wav")
+        wavfile.write(long_file, 8000, long_audio1.astype(np.int16))
+        results = find_offset_between_files(
+            long_file, path("timbl_2.mp3"), hop_length=160, max_frames=500, min_score=10, profile=True
+        )
+        assert results["time_offset"] == pytest.approx(12.26)
+        assert results["profile"]["decoded_samples"]["1"] == 4 * 500 * 160
+    results = find_offset_between_files(path("timbl_1.mp3"), path("timbl_2.mp3"), hop_length=160, trim=35, min_score=1000)
+    assert results["time_offset"] == pytest.approx(12.26)
+
+    with pytest.raises(ValueError):
+        find_offset_between_buffers(audio1, audio2, 8000, min_score=10, max_offset=20)
+
+
+def test_align_set():
+    files = [path("timbl_2.mp3"), path("timbl_1.mp3"), path("timbl_3.mp3"), path("r4_excerpt.ogg")]
+    results = align_set(files, hop_length=160)
+    assert [entry["file"] for entry in results["files"]] == files
+    assert [entry["start"] for entry in results["files"]] == pytest.approx([12.26, 0.0, 12.24, 0.0], abs=1e-6)
+    assert [entry["group"] for entry in results["files"]] == [0, 0, 0, 1]  # r4_excerpt.ogg doesn't overlap the others
+    assert len(results["pairs"]) == 6
+    pair = results["pairs"][0]
+    assert (pair["file1"], pair["file2"]) == (files[0], files[1])
+    expected = find_offset_between_files(files[1], files[0], hop_length=160)
+    assert pair["time_offset"] == pytest.approx(-expected["time_offset"])
+    assert pair["standard_score"] == pytest.approx(expected["standard_score"])
+    assert [pair["residual"] is None for pair in results["pairs"]] == [False, False, True, False, True, True]
+
+    # An inconsistent offset is shared out according to the scores of the pairs
+    pairs = {(0, 1): (1.0, 20.0), (1, 2): (2.0, 20.0), (0, 2): (3.3, 10.0), (2, 3): (5.0, 2.0)}
+    starts, groups = _solve_timeline(4, pairs, 5)
+    assert starts[:3] == pytest.approx([0.0, 1.075, 3.15])
+    assert starts[3] == 0.0
+    assert groups == [0, 0, 0, 1]
@@ -0,0 +1,87 @@
+# audio-offset-finder
+#
+# Copyright (c) 2014-24 British Broadcasting Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import pytest
+import json
+from audio_offset_finder.batch import read_pairs, run_batch
+from audio_offset_finder.cli import main
+from unittest.mock import patch
+from io import StringIO
+
+
+def test_read_pairs():
+    lines = [
+        "a.mp3,b.mp3",
+        "",
+        "# comment",
+        '{"within": "c.mp3", "find_offset_of": "d.mp3"}',
+        "find_offset_of, within",
+        "e.mp3, f.mp3",
+        "g.mp3",
+        '{"within": "h.mp3"}',
+    ]
+    pairs = list(read_pairs(lines))
+    assert pairs[:3] == [
+        {"within": "a.mp3", "find_offset_of": "b.mp3"},
+        {"within": "c.mp3", "find_offset_of": "d.mp3"},
+        {"within": "f.mp3", "find_offset_of": "e.mp3"},
+    ]
+    assert pairs[3]["line"] == 7 and "error" in pairs[3]
+    assert pairs[4]["line"] == 8 and "error" in pairs[4]
+
+
+def test_run_batch():
+    pairs = [
+        {"within": "tests/audio/timbl_1.mp3", "find_offset_of": "tests/audio/timbl_2.mp3"},
+        {"within": "tests/audio/timbl_1.mp3", "find_offset_of": "tests/audio/dummy.mp3"},
+        {"line": 3, "error": "Could not parse line"},
+        {"within": "tests/audio/timbl_2.mp3", "find_offset_of": "tests/audio/timbl_1.mp3"},
+    ]
+    results = list(run_batch(iter(pairs), jobs=2, hop_length=160, trim=35))
+    assert len(results) == 4
+    results = {(r.get("within"), r.get("find_offset_of")): r for r in results}
+    assert results[("tests/audio/timbl_1.mp3", "tests/audio/timbl_2.mp3")]["time_offset"] == pytest.approx(12.26)
+    assert results[("tests/audio/timbl_2.mp3", "tests/audio/timbl_1.mp3")]["time_offset"] == pytest.approx(-12.26)
+    assert results[("tests/audio/timbl_1.mp3", "tests/audio/dummy.mp3")]["error"].startswith("FFMpeg failed:")
+    assert results[(None, None)]["line"] == 3
+
+
+def test_batch_tool():
+    pairs = "within,find_offset_of\ntests/audio/timbl_1.mp3,tests/audio/timbl_2.mp3\n"
+    with patch("sys.stdin", new=StringIO(pairs)), patch("sys.stdout", new=StringIO()) as fakeStdout:
+        assert main("--batch - --jobs 1 --resolution 160 --trim 35".split()) is None
+        lines = fakeStdout.getvalue().strip().split("\n")
+    assert len(lines) == 1
+    assert json.loads(lines[0])["time_offset"] == pytest.approx(12.26)
+
+    # Search options are applied to every pair
+    pairs = "tests/audio/timbl_1.mp3,tests/audio/timbl_2.mp3\n"
+    args = "--batch - --jobs 1 --resolution 160 --expected-offset 10 --max-offset 5 --coarse-factor 4 --candidates 2 --profile"
+    with patch("sys.stdin", new=StringIO(pairs)), patch("sys.stdout", new=StringIO()) as fakeStdout:
+        assert main(args.split()) is None
+        results = json.loads(fakeStdout.getvalue())
+    assert results["time_offset"] == pytest.approx(12.26)
+    assert results["profile"]["lags_evaluated"] < 2 * 5 / 0.02  # Only offsets around the expected offset are searched
+
+    for args in (
+        "--batch - --within tests/audio/timbl_1.mp3",
+        "--batch - --timeline",
+        "--batch - --follow",
+        "--batch - --expected-offset 10",
+        "--batch - --min-score 10 --max-offset 5",
+    ):
+        with pytest.raises(SystemExit):
+            main(args.split())
@@ -0,0 +1,76 @@
+# audio-offset-finder
+#
+# Copyright (c) 2014-24 British Broadcasting Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import pytest
+import numpy as np
+import os
+import tempfile
+from audio_offset_finder.audio_offset_finder import find_offset_between_files
+from audio_offset_finder.cache import FeatureCache
+from unittest.mock import patch
+
+
+def path(test_file):
+    return os.path.abspath(os.path.join(os.path.dirname(__file__), "audio", test_file))
+
+
+def test_feature_cache():
+    with tempfile.TemporaryDirectory() as temp_dir:
+        cache = FeatureCache(temp_dir, max_size=2 * 80 * 8 + 1000)
+        key1 = cache.key(path("timbl_1.mp3"), fs=8000, hop_length=128)
+        assert key1 != cache.key(path("timbl_1.mp3"), fs=8000, hop_length=160)
+        assert key1 != cache.key(path("timbl_2.mp3"), fs=8000, hop_length=128)
+        assert key1 == FeatureCache(temp_dir, hash_content=True).key(path("timbl_1.mp3"), hop_length=128, fs=8000)
+        assert key1 != FeatureCache(temp_dir, hash_content=False).key(path("timbl_1.mp3"), fs=8000, hop_length=128)
+
+        assert cache.get(key1) is None
+        features = np.arange(80, dtype=float).reshape(40, 2)
+        cache.put(key1, features)
+        np.testing.assert_array_equal(cache.get(key1), features)
+
+        # Adding a third entry should evict the least recently used one
+        cache.put("key2", features)
+        os.utime(cache._path("key2"), (0, 0))
+        cache.put("key3", features)
+        assert cache.get("key2") is None
+        assert cache.get(key1) is not None
+        assert cache.get("key3") is not None
+
+        # Empty or truncated entries are cache misses, and are overwritten by the next put()
+        open(cache._path("key4"), "wb").close()
+        assert cache.get("key4") is None
+        with open(cache._path("key5"), "wb") as f:
+            np.save(f, features)
+            f.truncate(100)
+        assert cache.get("key5") is None
+        cache.put("key4", features)
+        np.testing.assert_array_equal(cache.get("key4"), features)
+
+
+def test_find_offset_between_files_with_cache():
+    with tempfile.TemporaryDirectory() as temp_dir:
+        cache = FeatureCache(temp_dir)
+        results = find_offset_between_files(path("timbl_1.mp3"), path("timbl_2.mp3"), hop_length=160, trim=35, cache=cache)
+        assert results["time_offset"] == pytest.approx(12.26)
+        assert len(os.listdir(temp_dir)) == 2
+
+        # Both files' features should now come from the cache, without decoding anything
+        with patch("audio_offset_finder.audio_offset_finder._load_audio", side_effect=AssertionError("decoded")):
+            cached_results = find_offset_between_files(
+                path("timbl_1.mp3"), path("timbl_2.mp3"), hop_length=160, trim=35, cache=cache
+            )
+        assert cached_results["time_offset"] == results["time_offset"]
+        assert cached_results["standard_score"] == pytest.approx(results["standard_score"])
@@ -0,0 +1,93 @@
+# audio-offset-finder
+#
+# Copyright (c) 2014-24 British Broadcasting Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import pytest
+import numpy as np
+import os
+import tempfile
+from audio_offset_finder.audio_offset_finder import decode_audio
+from audio_offset_finder.cache import FeatureCache
+from audio_offset_finder.index import FingerprintIndex, fingerprints
+from scipy.io import wavfile
+from unittest.mock import patch
+
+
+def path(test_file):
+    return os.path.abspath(os.path.join(os.path.dirname(__file__), "audio", test_file))
+
+
+def test_fingerprints():
+    rng = np.random.default_rng(3)
+    features = rng.standard_normal((100, 26))
+    frames, hashes = fingerprints(features)
+    assert len(frames) == len(hashes) == 84
+    assert 2**16 <= hashes.max() < 2**32
+
+    # Scaling and shifting each coefficient (as standardisation does) shouldn't change the fingerprints
+    scaled_frames, scaled_hashes = fingerprints(features * rng.uniform(0.5, 2, 26) + rng.standard_normal(26))
+    np.testing.assert_array_equal(scaled_hashes, hashes)
+
+    frames, hashes = fingerprints(features, step=4)
+    np.testing.assert_array_equal(frames, np.arange(0, 84, 4))
+
+    # Frames in which nothing changes aren't fingerprinted
+    features[40:60] = 0
+    frames, hashes = fingerprints(features)
+    assert not np.any((frames > 40) & (frames < 52))
+
+
+def test_fingerprint_specificity():
+    # Few of the fingerprints of a clip should occur anywhere in a large collection of unrelated recordings, so that
+    # looking them up in an index of it returns few postings
+    rng = np.random.default_rng(4)
+    _, collection = fingerprints(np.cumsum(rng.standard_normal((200000, 26)), axis=0))
+    _, clip = fingerprints(np.cumsum(rng.standard_normal((2000, 26)), axis=0))
+    assert np.isin(clip, collection).mean() < 0.01
+
+
+def test_fingerprint_index():
+    with tempfile.TemporaryDirectory() as temp_dir:
+        index_path = os.path.join(temp_dir, "index.db")
+        with FingerprintIndex(index_path, hop_length=160) as index:
+            assert index.add(path("timbl_1.mp3"))
+            assert index.add(path("r4_excerpt.ogg"))
+            assert not index.add(path("timbl_1.mp3"))
+            assert len(index) == 2
+
+        with pytest.raises(ValueError):
+            FingerprintIndex(index_path, hop_length=128)
+
+        with FingerprintIndex(index_path) as index:
+            assert index.hop_length == 160
+            assert index.recordings() == [path("timbl_1.mp3"), path("r4_excerpt.ogg")]
+            # An excerpt of a recording with added noise is found as well as a different encoding of part of it
+            audio = decode_audio(path("timbl_1.mp3"), 8000)[8000 * 10 : 8000 * 40].astype(float)
+            audio += np.random.default_rng(1).standard_normal(len(audio)) * audio.std() * 0.03
+            excerpt = os.path.join(temp_dir, "excerpt.wav")
+            wavfile.write(excerpt, 8000, audio.astype(np.int16))
+            for clip, offset in ((path("timbl_2.mp3"), 12.26), (excerpt, 10.0)):
+                results = index.query(clip)
+                assert results[0]["recording"] == path("timbl_1.mp3")
+                assert results[0]["time_offset"] == pytest.approx(offset)
+                assert results[0]["votes"] >= 2
+                assert len(set((r["recording"], r["time_offset"]) for r in results)) == len(results)
+
+            # Only the clip is trimmed, and the parts of the recordings used to verify the candidates are cached too
+            cache = FeatureCache(os.path.join(temp_dir, "cache"))
+            results = index.query(path("timbl_2.mp3"), trim=20, cache=cache)
+            assert results[0]["time_offset"] == pytest.approx(12.26)
+            with patch("audio_offset_finder.audio_offset_finder._load_audio", side_effect=AssertionError):
+                assert index.query(path("timbl_2.mp3"), trim=20, cache=cache) == results
@@ -0,0 +1,99 @@
+# audio-offset-finder
+#
+# Copyright (c) 2014-24 British Broadcasting Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import pytest
+import base64
+import json
+import os
+import threading
+import urllib.error
+import urllib.request
+from audio_offset_finder.audio_offset_finder import decode_audio
+from audio_offset_finder.server import OffsetServer, _parse_request
+
+
+def path(test_file):
+    return os.path.abspath(os.path.join(os.path.dirname(__file__), "audio", test_file))
+
+
+def request(server, url, body=None):
+    data = None if body is None else json.dumps(body).encode()
+    try:
+        with urllib.request.urlopen("http://127.0.0.1:%d%s" % (server.server_address[1], url), data) as response:
+            return response.status, json.loads(response.read())
+    except urllib.error.HTTPError as e:
+        return e.code, json.loads(e.read())
+
+
+@pytest.fixture
+def server():
+    with OffsetServer(("127.0.0.1", 0), jobs=1, max_queue=0, quiet=True) as server:
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        yield server
+        server.shutdown()
+        thread.join()
+
+
+def test_server(server):
+    assert request(server, "/health") == (200, {"status": "ok"})
+
+    body = {"within": path("timbl_1.mp3"), "find_offset_of": path("timbl_2.mp3"), "hop_length": 160, "trim": 35}
+    status, results = request(server, "/offset", body)
+    assert status == 200
+    assert results["time_offset"] == pytest.approx(12.26)
+    assert "profile" not in results
+
+    # The reference's MFCCs should now be held by the worker
+    status, results = request(server, "/offset", dict(body, profile=True))
+    assert results["time_offset"] == pytest.approx(12.26)
+    assert results["profile"]["cache_hits"] == {"1": True, "2": False}
+
+    # ...whatever the search parameters
+    status, results = request(server, "/offset", dict(body, profile=True, max_frames=1000, expected_offset=12, max_offset=2))
+    assert results["time_offset"] == pytest.approx(12.26)
+    assert results["profile"]["cache_hits"] == {"1": True, "2": False}
+
+    pcm = decode_audio(path("timbl_2.mp3"), 8000).astype("<i2").tobytes()
+    pcm_body = {"within": path("timbl_1.mp3"), "find_offset_of_pcm": base64.b64encode(pcm).decode(), "hop_length": 160}
+    status, results = request(server, "/offset", dict(pcm_body, trim=35))
+    assert status == 200
+    assert results["time_offset"] == pytest.approx(12.26)
+
+    status, results = request(server, "/offset", dict(body, find_offset_of=path("dummy.mp3")))
+    assert status == 422
+    assert results["error"].startswith("FFMpeg failed:")
+    assert request(server, "/offset", {"within": path("timbl_1.mp3")})[0] == 400
+    assert request(server, "/offset", dict(body, unknown=1))[0] == 400
+    assert request(server, "/unknown")[0] == 404
+
+    status, metrics = request(server, "/metrics")
+    assert metrics["requests"] == 5
+    assert metrics["completed"] == 4
+    assert metrics["failed"] == 1
+    assert metrics["queue_depth"] == 0
+    assert metrics["stages"]["correlation"]["count"] == 4
+    assert metrics["stages"]["queue"]["max_seconds"] >= 0
+
+
+def test_server_backpressure(server):
+    body = {"within": path("timbl_1.mp3"), "find_offset_of": path("timbl_2.mp3"), "hop_length": 160}
+    # With one worker and no queue, a second request can't be accepted until the first has finished
+    future = server.submit(_parse_request(body))
+    assert server.submit(_parse_request(body)) is None
+    assert future.result()["time_offset"] == pytest.approx(12.26)
+    assert server.metrics()["rejected"] == 1
+    assert server.submit(_parse_request(body)).result()["time_offset"] == pytest.approx(12.26)
@@ -0,0 +1,91 @@
+# audio-offset-finder
+#
+# Copyright (c) 2014-24 British Broadcasting Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import pytest
+import json
+import numpy as np
+import os
+from audio_offset_finder.audio_offset_finder import decode_audio, mfcc, stream_audio
+from audio_offset_finder.streaming import StreamingOffsetFinder
+from audio_offset_finder.cli import main
+from unittest.mock import patch
+from io import StringIO
+
+
+def path(test_file):
+    return os.path.abspath(os.path.join(os.path.dirname(__file__), "audio", test_file))
+
+
+def test_stream_audio():
+    chunks = list(stream_audio(path("timbl_2.mp3"), 8000, 3000))
+    assert all(len(chunk) == 3000 for chunk in chunks[:-1])
+    assert 0 < len(chunks[-1]) <= 3000
+    assert sum(len(chunk) for chunk in chunks) == len(decode_audio(path("timbl_2.mp3"), 8000))
+
+    with pytest.raises(Exception) as exception:
+        list(stream_audio(path("dummy.mp3"), 8000, 3000))
+    assert exception.value.args[0].startswith("FFMpeg failed:\n")
+
+
+def test_streaming_offset_finder():
+    reference = decode_audio(path("timbl_1.mp3"), 8000).astype(float)
+    finder = StreamingOffsetFinder(reference, 8000, hop_length=160, max_frames=1000, min_frames=300)
+    estimates = []
+    for chunk in stream_audio(path("timbl_3.mp3"), 8000, 1234):
+        results = finder.push(chunk)
+        if results is not None:
+            estimates.append(results)
+        assert len(finder._spectra) <= 1000
+    assert len(estimates) > 10
+    assert estimates[0]["stream_time"] == pytest.approx(300 * 160 / 8000, abs=0.2)
+    for results in estimates:
+        assert results["time_offset"] == pytest.approx(12.24)
+        assert results["standard_score"] > 10
+        assert results["reference_time"] == pytest.approx(results["stream_time"] + 12.24, abs=0.05)
+    assert finder.latest_estimate is estimates[-1]
+
+    # A stream that starts before the reference gives a negative offset
+    finder = StreamingOffsetFinder(reference[8000 * 20 :], 8000, hop_length=160, min_frames=300)
+    for start in range(0, len(reference), 5000):
+        finder.push(reference[start : start + 5000])
+    assert finder.latest_estimate["time_offset"] == pytest.approx(-20.0)
+
+    with pytest.raises(ValueError, match="min_frames"):
+        StreamingOffsetFinder(reference, 8000, hop_length=160, max_frames=300, min_frames=500)
+    with pytest.raises(ValueError, match="too short"):
+        StreamingOffsetFinder(reference[: 8000 * 10], 8000, hop_length=160)
+
+
+def test_streamed_mfccs():
+    # The frames calculated as the stream arrives are the same as those calculated for all of it at once, even though
+    # the loudest part of the stream arrives after the first frames
+    audio = decode_audio(path("timbl_2.mp3"), 8000).astype(np.float32)
+    audio[: 8000 * 25] *= 0.01
+    finder = StreamingOffsetFinder(decode_audio(path("timbl_1.mp3"), 8000), 8000, hop_length=160, max_frames=800)
+    for start in range(0, len(audio), 1234):
+        finder.push(audio[start : start + 1234])
+    assert len(finder._spectra) == 800
+    expected = mfcc(audio, win_length=256, nfft=512, fs=8000, hop_length=160, numcep=26)[0]
+    np.testing.assert_allclose(finder._mfcc(), expected[finder._total_frames - 800 : finder._total_frames], atol=1e-3)
+
+
+def test_follow():
+    args = "--find-offset-of tests/audio/timbl_2.mp3 --within tests/audio/timbl_1.mp3 --resolution 160 --follow --json"
+    with patch("sys.stdout", new=StringIO()) as fakeStdout:
+        assert main(args.split()) is None
+        lines = [json.loads(line) for line in fakeStdout.getvalue().strip().split("\n")]
+    assert len(lines) > 1
+    assert lines[-1]["time_offset"] == pytest.approx(12.26)
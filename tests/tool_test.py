@@ -60,6 +60,33 @@ def test_tool():
         assert error.value.code > 0, "missing 'offset-of' file"
 
 
+def test_startup_time():
+    import subprocess
+    import sys
+    import time
+
+    # Printing the help shouldn't import any of the heavyweight modules
+    script = (
+        "import sys\n"
+        "from audio_offset_finder.cli import main\n"
+        "try:\n"
+        "    main(['--help'])\n"
+        "except SystemExit:\n"
+        "    pass\n"
+        "print(sorted(m for m in sys.modules if m.split('.')[0] in ('numpy', 'scipy', 'librosa', 'matplotlib')), file=sys.stderr)"
+    )
+    assert subprocess.run([sys.executable, "-c", script], capture_output=True, text=True, check=True).stderr.strip() == "[]"
+
+    def elapsed(args):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, "-m", "audio_offset_finder.cli"] + args.split(), capture_output=True, check=True)
+        return time.perf_counter() - start
+
+    help_time = elapsed("--help")
+    result_time = elapsed("--find-offset-of tests/audio/timbl_2.mp3 --within tests/audio/timbl_1.mp3 --trim 35")
+    assert help_time < result_time / 2
+
+
 def test_json():
     import json
 
@@ -71,3 +98,186 @@ def test_json():
         assert len(json_array) == 2
         assert pytest.approx(json_array["time_offset"]) == 12.26
         assert pytest.approx(json_array["standard_score"], rel=1e-2) == 28.99
+
+
+def test_profile():
+    import json
+
+    args = (
+        "--find-offset-of tests/audio/timbl_2.mp3 --within tests/audio/timbl_1.mp3 --resolution 160 --trim 35 --json "
+        "--profile"
+    )
+    with patch("sys.stdout", new=StringIO()) as fakeStdout:
+        main(args.split())
+        json_array = json.loads(fakeStdout.getvalue().strip())
+    assert pytest.approx(json_array["time_offset"]) == 12.26
+    profile = json_array["profile"]
+    assert set(profile["stage_seconds"]) == {
+        "decode_1",
+        "mfcc_1",
+        "standardise_1",
+        "decode_2",
+        "mfcc_2",
+        "standardise_2",
+        "correlation",
+        "total",
+    }
+    assert profile["decoded_samples"] == {"1": 35 * 8000, "2": 35 * 8000}
+    assert profile["cache_hits"] == {"1": False, "2": False}
+    assert profile["lags_evaluated"] > profile["correlated_frames"] > 0
+
+    with patch("sys.stdout", new=StringIO()) as fakeStdout:
+        main(args.replace(" --json", "").split())
+        assert "Time for correlation:" in fakeStdout.getvalue()
+
+
+def test_timeline():
+    import json
+
+    args = (
+        "--find-offset-of tests/audio/timbl_2.mp3 --within tests/audio/timbl_1.mp3 --resolution 160 --timeline "
+        "--window 10 --stride 5"
+    )
+    with patch("sys.stdout", new=StringIO()) as fakeStdout:
+        main((args + " --json").split())
+        results = json.loads(fakeStdout.getvalue())
+    assert len(results["windows"]) == 6
+    for window in results["windows"]:
+        assert pytest.approx(window["time_offset"]) == 12.26
+    assert results["drift"] == pytest.approx(0, abs=1e-6)
+
+    with patch("sys.stdout", new=StringIO()) as fakeStdout:
+        main(args.split())
+        assert "Drift: " in fakeStdout.getvalue()
+
+
+def test_tracks():
+    import json
+
+    args = "--find-offset-of tests/audio/timbl_2.mp3 --within tests/audio/timbl_1.mp3 --resolution 160 --trim 35"
+    with patch("sys.stdout", new=StringIO()) as fakeStdout:
+        main((args + " --channels --json").split())
+        results = [json.loads(line) for line in fakeStdout.getvalue().splitlines()]
+    assert [channel_results["channel"] for channel_results in results] == [0, 1]  # timbl_2.mp3 is stereo
+    for channel_results in results:
+        assert pytest.approx(channel_results["time_offset"]) == 12.26
+
+    with patch("sys.stdout", new=StringIO()) as fakeStdout:
+        main((args + " --streams 0").split())
+        assert "Stream: 0\nOffset: 12.26" in fakeStdout.getvalue()
+
+    with pytest.raises(SystemExit):
+        main((args + " --streams first").split())
+
+
+def test_align():
+    import json
+
+    with patch("sys.stdout", new=StringIO()) as fakeStdout:
+        main("align tests/audio/timbl_1.mp3 tests/audio/timbl_2.mp3 --resolution 160".split())
+        results = json.loads(fakeStdout.getvalue())
+    assert [entry["start"] for entry in results["files"]] == pytest.approx([0.0, 12.26])
+    assert len(results["pairs"]) == 1
+
+    with pytest.raises(SystemExit):
+        main("align tests/audio/timbl_1.mp3".split())
+
+
+def test_index():
+    import json
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        index_path = os.path.join(temp_dir, "index.db")
+        with patch("sys.stdout", new=StringIO()) as fakeStdout:
+            assert main(["index", "build", index_path, "tests/audio/timbl_1.mp3", "--resolution", "160"]) is None
+            assert "Added: tests/audio/timbl_1.mp3" in fakeStdout.getvalue()
+        with patch("sys.stdout", new=StringIO()) as fakeStdout:
+            assert main(["index", "query", index_path, "tests/audio/timbl_2.mp3", "--json"]) is None
+            results = json.loads(fakeStdout.getvalue().split("\n")[0])
+        assert results["recording"] == os.path.abspath("tests/audio/timbl_1.mp3")
+        assert pytest.approx(results["time_offset"]) == 12.26
+
+        with pytest.raises(SystemExit):
+            main(["index", "search", index_path])
+
+
+def test_cache_dir():
+    import json
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        args = (
+            "--find-offset-of tests/audio/timbl_2.mp3 --within tests/audio/timbl_1.mp3 --resolution 160 --trim 35 --json "
+            "--cache-dir "
+        ) + temp_dir
+        for _ in range(2):
+            with patch("sys.stdout", new=StringIO()) as fakeStdout:
+                main(args.split())
+                json_array = json.loads(fakeStdout.getvalue().strip())
+                assert pytest.approx(json_array["time_offset"]) == 12.26
+        assert len(os.listdir(temp_dir)) == 2
+
+
+def test_min_score():
+    args = (
+        "--find-offset-of tests/audio/timbl_2.mp3 --within tests/audio/timbl_1.mp3 --resolution 160 --trim 35 "
+        "--min-score 10"
+    )
+    with patch("sys.stdout", new=StringIO()) as fakeStdout:
+        main(args.split())
+        assert "Offset: 12.26" in fakeStdout.getvalue()
+
+    with pytest.raises(SystemExit):
+        main((args + " --max-offset 20").split())
+
+
+def test_multiple_files():
+    import json
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        list_file_path = os.path.join(temp_dir, "clips.txt")
+        with open(list_file_path, "w") as list_file:
+            list_file.write("tests/audio/timbl_3.mp3\ntests/audio/dummy.mp3\n")
+        args = (
+            "--find-offset-of tests/audio/timbl_2.mp3 --within tests/audio/timbl_1.mp3 --resolution 160 --trim 35 "
+            "--find-offsets-of-list "
+        ) + list_file_path
+        with patch("sys.stdout", new=StringIO()) as fakeStdout:
+            assert main(args.split()) == 1  # because dummy.mp3 doesn't exist
+            lines = [json.loads(line) for line in fakeStdout.getvalue().strip().split("\n")]
+    assert [line["file"] for line in lines] == ["tests/audio/timbl_2.mp3", "tests/audio/timbl_3.mp3", "tests/audio/dummy.mp3"]
+    assert pytest.approx(lines[0]["time_offset"]) == 12.26
+    assert pytest.approx(lines[1]["time_offset"]) == 12.24
+    assert lines[2]["error"].startswith("FFMpeg failed:")
+
+
+def test_coarse_factor():
+    args = (
+        "--find-offset-of tests/audio/timbl_2.mp3 --within tests/audio/timbl_1.mp3 --resolution 40 --trim 35 --coarse-factor 4"
+    )
+    with patch("sys.stdout", new=StringIO()) as fakeStdout:
+        main(args.split())
+        assert "Offset: 12.25" in fakeStdout.getvalue()
+
+    # Modes that don't search at a coarser resolution first reject it
+    args = "--find-offset-of tests/audio/timbl_2.mp3 --within tests/audio/timbl_1.mp3 "
+    for mode in ("--timeline", "--streams 0", "--channels", "--follow", "--find-offset-of tests/audio/timbl_3.mp3"):
+        for option in ("--coarse-factor 4", "--candidates 2"):
+            with pytest.raises(SystemExit):
+                main((args + option + " " + mode).split())
+
+
+def test_max_offset():
+    import json
+
+    args = "--find-offset-of tests/audio/timbl_2.mp3 --within tests/audio/timbl_1.mp3 --resolution 160 --json "
+    with patch("sys.stdout", new=StringIO()) as fakeStdout:
+        main((args + "--expected-offset 10 --max-offset 5").split())
+        assert pytest.approx(json.loads(fakeStdout.getvalue())["time_offset"]) == 12.26
+
+    with pytest.raises(SystemExit):
+        main((args + "--expected-offset 10").split())
+
+    # Modes that can't restrict the search to the window reject it
+    for mode in ("--streams 0", "--channels", "--follow", "--find-offset-of tests/audio/timbl_3.mp3"):
+        with pytest.raises(SystemExit):
+            main((args + "--max-offset 1 " + mode).split())